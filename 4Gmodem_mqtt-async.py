@@ -1,6 +1,17 @@
 import asyncio
+import random
 import serial_asyncio
+from collections import Counter, deque
 from datetime import datetime
+import modem_certs
+import modem_config
+import modem_metrics
+import simcom_at
+import mqtt_chunks
+import mqtt_compress
+import mqtt_topics
+import telemetry_codec
+from mqtt_spool import Spool
 
 def extract_numeric_values(response):
     try:
@@ -11,7 +22,7 @@ def extract_numeric_values(response):
         raise ValueError(f"Invalid response format: {response}") from e
 
 class AsyncMQTTClient:
-    def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=20, ssl=False, ssl_params={}):
+    def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=20, ssl=False, ssl_params={}, spool=None, compression=None, metrics=None):
         self.client_id = client_id
         self.server_url = server
         self.port = port if port else (8883 if ssl else 1883)
@@ -27,6 +38,7 @@ class AsyncMQTTClient:
         self.lw_qos = 0
         self.lw_retain = False
         self.use_ssl = ssl
+        self.spool = spool             # mqtt_spool.Spool for messages published while disconnected
         if ssl:
             self.ssl_context = 1
             self.ca_cert = ssl_params['ca_cert']
@@ -36,150 +48,110 @@ class AsyncMQTTClient:
             self.enable_SNI = ssl_params['enable_SNI']
         self.reader = None
         self.writer = None
+        self.at = None                 # simcom_at.AsyncAT, which owns the serial reader
+        self.rx = None                 # [topic, length so far, payload, length so far] of a message being received
+        self.sequence_lock = asyncio.Lock() # held across multi-command sequences, e.g. topic/payload/publish
+        self.command_timeout = 30
+        self.publish_queue = asyncio.Queue()
+        self.publish_task = None       # background task that drains self.publish_queue
+        self.publish_waiters = set()   # tasks awaiting publish acks
+        self.max_publish_batch = 16    # publishes sent per hold of the sequence lock
+        self.subscriptions = {}        # topic -> qos, to restore after reconnecting
+        self.config = modem_config.ModemConfig() # what the modem is known to be configured with
+        self.reassembler = mqtt_chunks.Reassembler()
+        self.compression = compression # an mqtt_compress.Compressor, to compress published payloads
+        self.message_id = 0            # for chunked publishes
+        self.stream_window = 4         # chunks in flight per publish_stream()
+        self.auto_reconnect = True
+        self.reconnect_min = 1         # seconds before the first reconnect attempt
+        self.reconnect_max = 300       # longest delay between attempts
+        self.lost = asyncio.Event()    # set when the connection is lost
+        self.supervisor_task = None    # background task that reconnects
+        self.metrics = metrics         # a modem_metrics.Metrics, to record command latencies etc.
+        self.metrics_topic = None      # where to publish a summary of them, if anywhere
+        self.metrics_interval = 300    # seconds between summaries
+        self.metrics_task = None
 
-    async def _readline_stripped(self):
-        """
-        Read a line from the serial reader, handle EOF, and return the stripped string.
-        Raises EOFError if the connection is closed.
-        """
-        assert self.reader is not None, "Reader is not initialized. Call connect() first."
-        # Read a line from the serial reader
-        while True:
-            try:
-                line = await asyncio.wait_for(self.reader.readline(), timeout=10)
-            except asyncio.TimeoutError:
-                raise TimeoutError("Timed out waiting for line from serial reader")
-            if not line:  # EOF
-                raise EOFError("Serial connection closed while reading response")
-            result = line.decode(errors="ignore").strip()
-            print(f'Rx: {result}')
-            if result != "":
-                return result
-
-
-    async def _send_at_command(self, command, body="", result_handler=None, payload=None):
+    async def _send_at_command(self, command, body="", result_handler=None, payload=None, ack=False, query=False):
         """ Send an AT command to the modem and handle the response.
         Args:
             command (str): The AT command to send (without 'AT+' prefix).
             body (str): The body of the command, if any.
             result_handler (callable): A function to handle the result line.
             payload (bytes): Optional payload to send after the command.
+            ack (bool): Return the simcom_at.ATCommand as soon as the command is OK, without
+                waiting for its late result; await that with self.at.acked().
+            query (bool): The command is a query, whose (zero or more) result lines all
+                precede the OK. result_handler is then called with a list of them at the OK.
         Returns:
             The result of the command, if any.
         Raises:
             ValueError: If the command fails with an ERROR response.
             EOFError: If the connection is closed while reading the response.
         """
-        assert self.reader is not None, "Reader is not initialized. Call connect() first."
         assert self.writer is not None, "Writer is not initialized. Call connect() first."
-
-        # Construct the AT command string and send it.
-        cmd_str = 'AT+' + command + body + '\r'
-        print(f'Tx: {cmd_str}')
-        self.writer.write(cmd_str.encode())
-        await self.writer.drain() # Ensure the command is sent
-
-        # We've sent the command, now we wait for the echo. However,
-        # we may not get an echo if the command is not recognized and
-        # some commands may not echo back.
-        # In addition, we may receive unsolicited responses before the echo.
-        while True:
-            line = await self._readline_stripped()
-            if line == cmd_str.strip(): # wait for the command to be echoed back
-                break
-            elif line.startswith('+'): # unsolicited response
-                # Handle unsolicited response
-                await self._handle_unsolicited_response(line)
-            elif line == 'OK' or line == 'ERROR':
-                # If we get OK or ERROR, we can stop waiting for the echo
-                break
-            else:
-                # If we get an unexpected line, we can log it and continue
-                print(f'Unexpected response: {line}')
-
-        # If payload is needed, wait for '>' prompt
-        if payload is not None:
-            # Ensure payload is bytes
-            # Read until the '>' prompt is seen
-            try:
-                prompt = await asyncio.wait_for(self.reader.readuntil(b'>'), timeout=5)
-            except asyncio.TimeoutError:
-                raise TimeoutError("Timed out waiting for '>' prompt from modem")
-            if not prompt.endswith(b'>'):
-                raise EOFError("Serial connection closed or prompt not found while waiting for '>' prompt")
-            self.writer.write(payload) # now send the payload
-            await self.writer.drain() # Ensure the payload is sent
-
-        # Now we wait for the response
-        # Initialize result to None, it will be set if we get a result
-        result = None
-        # Read response lines
-        line = await self._readline_stripped() # Read the first response line
-        assert line != "" # Ensure we got a response
-        # Check for an early result, i.e. one that preceeds the OK or ERROR response
-        if line.startswith('+' + command + ':'):
-            # Early result, may be for OK or ERROR
-            if result_handler is None:
-                raise ValueError(f"Command {command} returned a result without a result handler", line)
-            result = result_handler(line) # stash the result
-            line = await self._readline_stripped() # get next line
-        # Check for ERROR response
-        if line == "ERROR":
+        cmd = await self.at.command(simcom_at.ATCommand('AT+' + command + body, payload, expect_result=result_handler is not None,
+                                                        query=query, ack=ack),
+                                    timeout=self.command_timeout)
+        if not cmd.ok:
+            result = result_handler(cmd.results[-1]) if cmd.results and result_handler and not query else None
             if result:
                 raise ValueError(f"Command {command} failed with result: {result}", result)
-            else:
-                raise ValueError(f"Command {command} failed with ERROR response")
-        # Check for OK response
-        if line == 'OK':
-            if result_handler and result is None: # we're still expecting an explicit result
-                # Assume that the result will come in the next line
-                line = await self._readline_stripped()  # get next line
-                assert line.startswith('+' + command + ':')
-                # Late result, only for OK
-                try:
-                    result = result_handler(line) # stash the result
-                    if result != 0:
-                        raise ValueError(f"Command {command} failed with result: {result}", result)
-                except Exception as e:
-                    print(f"Result handler exception: {e} line = {line}")
-                    raise e
-            return result
-        # Handle unsolicited responses
-        if line.startswith('+'):
-            # Handle unsolicited response
-            await self._handle_unsolicited_response(line)
-
-    async def _handle_unsolicited_response(self, response):
-        topic = b''
-        payload = b''
-        assert self.reader is not None, "Reader is not initialized. Call connect() first."
+            raise ValueError(f"Command {command} failed with ERROR response")
+        if ack:
+            return cmd
+        if query:
+            return result_handler(cmd.results)
+        if not cmd.results:
+            return None
+        if result_handler is None:
+            raise ValueError(f"Command {command} returned a result without a result handler", cmd.results[-1])
+        result = result_handler(cmd.results[-1])
+        if cmd.late and result != 0:
+            raise ValueError(f"Command {command} failed with result: {result}", result)
+        return result
+
+    def _handle_unsolicited_response(self, response, data=None):
         print(f'Unsolicited: {response}')
+        rx = self.rx
         if response.startswith('+CMQTTRXSTART:'):
+            # The topic and payload may come in several parts, which are
+            # written straight into buffers of the full size
             id, topic_total_len, payload_total_len = extract_numeric_values(response)
-            while True:
-                line = await self.reader.readline()
-                decoded = line.decode(errors="ignore").strip()
-                print(f'Rx: {decoded}')
-                if decoded.startswith('+CMQTTRXTOPIC:'):
-                    id, topic_sub_len = extract_numeric_values(decoded)
-                    topic += await self.reader.readexactly(topic_sub_len)
-                    topic_total_len -= topic_sub_len
-                    print(topic.decode(), end="")
-                elif decoded.startswith('+CMQTTRXPAYLOAD:'):
-                    id, payload_sub_len = extract_numeric_values(decoded)
-                    payload += await self.reader.readexactly(payload_sub_len)
-                    payload_total_len -= payload_sub_len
-                    print(payload.decode(), end="")
-                elif decoded.startswith('+CMQTTRXEND:'):
-                    assert topic_total_len == 0
-                    assert payload_total_len == 0
-                    if self.cb:
-                        self.cb(topic, payload)
-                    else:
-                        print(f"Received message for {topic}: {payload}")
-                    break
+            self.rx = [bytearray(topic_total_len), 0, bytearray(payload_total_len), 0]
+        elif rx and response.startswith('+CMQTTRXTOPIC:'):
+            rx[0][rx[1]:rx[1] + len(data)] = data
+            rx[1] += len(data)
+        elif rx and response.startswith('+CMQTTRXPAYLOAD:'):
+            rx[2][rx[3]:rx[3] + len(data)] = data
+            rx[3] += len(data)
+        elif rx and response.startswith('+CMQTTRXEND:'):
+            topic, topic_len, payload, payload_len = rx
+            self.rx = None
+            assert topic_len == len(topic)
+            assert payload_len == len(payload)
+            # Callbacks get bytes, not our receive buffers
+            topic = bytes(topic)
+            payload = bytes(payload)
+            # Compressed payloads are recognised by their header.
+            # Chunked payloads are only delivered once complete
+            try:
+                payload = self.reassembler.add(topic, mqtt_compress.decompress(payload))
+            except ValueError as e:
+                print(f"Dropped message for {topic}: {e}")
+                payload = None
+            if payload is None:
+                pass
+            elif self.cb:
+                # Deliver the message straight away, without holding up the reader
+                result = self.cb(topic, payload)
+                if asyncio.iscoroutine(result):
+                    asyncio.ensure_future(result)
+            else:
+                print(f"Received message for {topic}: {payload}")
         elif response.startswith('*ATREADY:'):
-            pass  # this is just an indication that the modem is ready, we can ignore it
+            # The modem is ready after (re)booting, so holds none of our configuration
+            self.config.forget_all()
         elif response.startswith('+CGEV:'):
             # Handle +CGEV unsolicited responses, e.g. network events
             pass
@@ -188,13 +160,12 @@ class AsyncMQTTClient:
             client_index, cause = extract_numeric_values(response)
             assert client_index == self.client_index, "Unexpected client index in MQTT connection lost event"
             print(f'MQTT connection lost, cause: {cause}')
-            self.connected = False
-            # You may want to implement reconnection logic here
+            self.config.forget(('CMQTTCONNECT', client_index))
+            self._connection_lost()
         elif response.startswith('+CMQTTNONET:'):
             # Handle MQTT network lost events
             print("MQTT no network")
-            self.connected = False
-            # You may want to implement reconnection logic here
+            self._connection_lost()
         elif response.startswith('+CPIN:'):
             pass  # this is just an indication that the SIM card is ready, we can ignore it
         elif response.startswith('+CME ERROR:'):
@@ -213,50 +184,178 @@ class AsyncMQTTClient:
             else:
                 credentials = f',"{self.user}"'
         self.timeout = timeout
+        self.credentials = credentials
+        self.apn = apn
+        self.clean_session = clean_session
         self.reader, self.writer = await serial_asyncio.open_serial_connection(url=port, baudrate=baudrate) # Connect to the serial port
-        await self._send_at_command('CGDCONT', f'=1,"IP","{apn}"')
-        await self._send_at_command('CGACT', f'=1,1')
-        try:
-            await self._send_at_command('CMQTTSTART', result_handler=lambda s: extract_numeric_values(s)[0])
-            await self._send_at_command('CMQTTACCQ', f'={self.client_index},"{self.client_id}",{int(self.use_ssl)}')
-            if self.use_ssl:
-                await self._send_at_command('CSSLCFG', f'="sslversion",1,{self.ssl_version}')
-                await self._send_at_command('CSSLCFG', f'="authmode",1,{self.auth_mode}')
-                await self._send_at_command('CSSLCFG', f'="ignorelocaltime",1,{int(self.ignore_local_time)}')
-                await self._send_at_command('CSSLCFG', f'="cacert",1,"{self.ca_cert}"')
-                await self._send_at_command('CSSLCFG', f'="enableSNI",1,{int(self.enable_SNI)}')
-                await self._send_at_command('CMQTTSSLCFG', f'=0,1')
-            if self.lw_topic and self.lw_msg:
-                assert 0 <= self.lw_qos <= 2
-                assert self.lw_retain == False, "retain=True is not supported by SimCOMM A76xx for last will"
-                assert 0 < len(self.lw_topic) <= 1024
-                assert 0 < len(self.lw_msg) <= 1024
-                await self._send_at_command('CMQTTWILLTOPIC', f'=0,{len(self.lw_topic)}', payload=self.lw_topic)
-                await self._send_at_command('CMQTTWILLMSG', f'=0,{len(self.lw_msg)},{self.lw_qos}', payload=self.lw_msg)
-        except ValueError as e:
-            # An immediate ERROR from CMQTTSTSTART or CMQTTACCQ implies that we're already connected.
-            # ToDo: we should really stop and restart, in case the client ID has changed.
-            if len(e.args) != 1:
-                raise e
+        self.at = simcom_at.AsyncAT(self.reader, self.writer, self._handle_unsolicited_response, log=print, metrics=self.metrics,
+                                    on_error=lambda e: self._connection_lost())
+        self.at.start()
+        self.publish_task = asyncio.create_task(self._publish_loop())
+        async with self.sequence_lock:
+            await self._start_session()
+        await self._connected()
+        if self.auto_reconnect:
+            self.supervisor_task = asyncio.create_task(self._supervise())
+        if self.metrics is not None and self.metrics_topic:
+            self.metrics_task = asyncio.create_task(self._publish_metrics())
+        return False
+
+    async def _query(self, command):
+        "Send a configuration query, returning its result lines, or None on ERROR"
         try:
-            await self._send_at_command('CMQTTCONNECT', f'=0,"tcp://{self.server_url}:{self.port}",{self.keepalive},{int(clean_session)}{credentials}',
-                                    result_handler=lambda s: extract_numeric_values(s)[1])
-        except ValueError as e:
-            # An error code of 19 from CMQTTCONNECT means "Already connected", so we can ignore it
-            # ToDo: we should really disconnect and reconnect.
-            if 19 != e.args[1]:
-                raise e
+            return await self._send_at_command(command, '?', result_handler=lambda results: results, query=True)
+        except ValueError:
+            return None
+
+    async def _query_modem_state(self):
+        "Find out which configuration the modem already holds, e.g. from a previous run"
+        for command in modem_config.QUERIES:
+            self.config.parse(command, await self._query(command))
+
+    async def _configure(self, key, command, body="", result_handler=None, payload=None):
+        "Send a configuration command, unless the modem already holds that setting"
+        if self.config.is_set(key, body):
+            return None
+        result = await self._send_at_command(command, body, result_handler=result_handler, payload=payload)
+        self.config.set(key, body)
+        return result
+
+    async def _start_session(self):
+        """
+        Bring up the PDP context and the MQTT session, sending only the
+        configuration commands that differ from what the modem already holds.
+        """
+        if not self.config.known:
+            await self._query_modem_state()
+        else:
+            # The network may have dropped the PDP context
+            self.config.parse('CGACT', await self._query('CGACT'))
+        await self._configure(('CGDCONT', 1), 'CGDCONT', f'=1,"IP","{self.apn}"')
+        await self._configure(('CGACT', 1), 'CGACT', f'=1,1')
+        for attempt in range(2):
+            try:
+                await self._configure(('CMQTTSTART',), 'CMQTTSTART', result_handler=lambda s: extract_numeric_values(s)[0])
+                await self._configure(('CMQTTACCQ', 0), 'CMQTTACCQ', f'={self.client_index},"{self.client_id}",{int(self.use_ssl)}')
+                if self.use_ssl:
+                    for name, value in (('sslversion', self.ssl_version),
+                                        ('authmode', self.auth_mode),
+                                        ('ignorelocaltime', int(self.ignore_local_time)),
+                                        ('cacert', f'"{self.ca_cert}"'),
+                                        ('enableSNI', int(self.enable_SNI))):
+                        await self._configure(('CSSLCFG', name, 1), 'CSSLCFG', f'="{name}",1,{value}')
+                    await self._configure(('CMQTTSSLCFG', 0), 'CMQTTSSLCFG', f'=0,1')
+                body = f'=0,"tcp://{self.server_url}:{self.port}",{self.keepalive},{int(self.clean_session)}{self.credentials}'
+                if self.config.is_set(('CMQTTCONNECT', 0), body):
+                    return # still connected, with the same settings, from a previous run
+                if self.lw_topic and self.lw_msg:
+                    assert 0 <= self.lw_qos <= 2
+                    assert self.lw_retain == False, "retain=True is not supported by SimCOMM A76xx for last will"
+                    assert 0 < len(self.lw_topic) <= 1024
+                    assert 0 < len(self.lw_msg) <= 1024
+                    will = (self.lw_topic, self.lw_msg, self.lw_qos)
+                    if not self.config.is_set(('CMQTTWILL', 0), will):
+                        await self._send_at_command('CMQTTWILLTOPIC', f'=0,{len(self.lw_topic)}', payload=self.lw_topic)
+                        await self._send_at_command('CMQTTWILLMSG', f'=0,{len(self.lw_msg)},{self.lw_qos}', payload=self.lw_msg)
+                        self.config.set(('CMQTTWILL', 0), will)
+                await self._configure(('CMQTTCONNECT', 0), 'CMQTTCONNECT', body,
+                                      result_handler=lambda s: extract_numeric_values(s)[1])
+                return
+            except ValueError as e:
+                # An immediate ERROR from CMQTTSTART or CMQTTACCQ, or an error code of 19
+                # ("Already connected") from CMQTTCONNECT, means that a session is left over,
+                # possibly with a different client ID, so stop it and start again.
+                leftover = len(e.args) == 1 or e.args[1] == 19
+                if attempt > 0 or not leftover:
+                    raise e
+                await self._teardown_session()
+
+    async def _teardown_session(self):
+        "Stop the MQTT session, ignoring errors as it may already be (partly) down"
+        for command, body, result_handler in (('CMQTTDISC', '=0', lambda s: extract_numeric_values(s)[1]),
+                                              ('CMQTTREL', '=0', None),
+                                              ('CMQTTSTOP', '', lambda s: extract_numeric_values(s)[0])):
+            try:
+                await self._send_at_command(command, body, result_handler=result_handler)
+            except ValueError:
+                pass
+        self.config.forget_mqtt()
+
+    async def _connected(self):
         self.connected = True
-        return False
+        if self.spool is not None:
+            # Send anything published while we were disconnected, oldest first
+            await self.spool.drain_async(lambda topic, msg, retain, qos: self.queue_publish(topic, msg, retain, qos, spool=False, compress=False))
+
+    async def reconnect(self):
+        """
+        Re-establish the MQTT session after the connection was lost, reusing
+        the PDP context and SSL configuration if still held, and re-subscribe to our topics.
+        """
+        if self.at.error is not None:
+            # The serial reader stopped; start another, whose first command
+            # fails straight away if the port itself is gone
+            print(f'Restarting the serial reader, which stopped with: {self.at.error!r}')
+            self.at.start()
+        async with self.sequence_lock:
+            await self._teardown_session()
+            await self._start_session()
+            for topic, qos in self.subscriptions.items():
+                await self._subscribe(topic, qos)
+        if self.metrics is not None:
+            self.metrics.count('reconnects')
+        await self._connected()
+
+    def _connection_lost(self):
+        self.connected = False
+        self.lost.set()
+
+    async def _supervise(self):
+        """
+        The background supervisor task. Waits for the connection to be lost,
+        then tries to reconnect after exponentially increasing, jittered delays
+        until it succeeds.
+        """
+        while True:
+            await self.lost.wait()
+            delay = self.reconnect_min
+            while True:
+                await asyncio.sleep(random.uniform(delay / 2, delay))
+                self.lost.clear()
+                try:
+                    await self.reconnect()
+                    break
+                except (ValueError, TimeoutError, OSError, EOFError) as e:
+                    print(f'Reconnect failed: {e!r}')
+                    delay = min(delay * 2, self.reconnect_max)
 
     async def disconnect(self):
+        for task in (self.supervisor_task, self.metrics_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.supervisor_task = self.metrics_task = None
         if self.connected:
+            # Let queued publishes go out first
+            await self.publish_queue.join()
+            self.publish_task.cancel()
+            try:
+                await self.publish_task
+            except asyncio.CancelledError:
+                pass
+            self.publish_task = None
             await self._send_at_command('CMQTTDISC', f'=0', result_handler=lambda s: extract_numeric_values(s)[1])
             await self._send_at_command('CMQTTREL', f'=0')
             await self._send_at_command('CMQTTSTOP', result_handler=lambda s: extract_numeric_values(s)[0])
             await self._send_at_command('CGACT', f'=0,1')
+            self.config.forget_mqtt()
+            self.config.forget(('CGACT', 1))
             assert self.writer is not None, "Writer is not initialized. Call connect() first."
-            # Close the serial connection
+            # Stop the reader task and close the serial connection
+            await self.at.stop()
             self.writer.close()
             await self.writer.wait_closed()
             self.connected = False
@@ -275,46 +374,318 @@ class AsyncMQTTClient:
     def set_callback(self, f):
         self.cb = f
 
-    async def publish(self, topic, msg, retain=False, qos=0, pub_timeout=60):
+    def queue_publish(self, topic, msg, retain=False, qos=0, pub_timeout=60, spool=True, compress=True):
+        """
+        Queue a message for publishing, without waiting for it to be sent.
+        If the client has a compressor and compress is True, the message is
+        sent compressed when that makes it smaller.
+        Returns a future that completes once the modem reports the publish as
+        done (for qos > 0, once the broker has acknowledged it). If there is a
+        spool, messages published while disconnected, and qos > 0 messages
+        that fail, are spooled to be sent on reconnection, and the future's
+        result is None.
+        """
         assert 0 <= qos <= 2
         assert 0 < len(topic) <= 1024
+        if compress and self.compression is not None:
+            msg = self.compression.compress(msg)
         assert 0 < len(msg) <= 10240
+        future = asyncio.get_running_loop().create_future()
+        spool = self.spool if spool else None
+        if spool is not None and not self.connected:
+            spool.append(topic, msg, retain, qos)
+            future.set_result(None)
+        else:
+            self.publish_queue.put_nowait((topic, msg, retain, qos, pub_timeout, spool, future))
+        self._record_queues()
+        return future
+
+    async def publish(self, topic, msg, retain=False, qos=0, pub_timeout=60, spool=True, compress=True):
+        return await self.queue_publish(topic, msg, retain, qos, pub_timeout, spool=spool, compress=compress)
+
+    async def publish_stream(self, topic, data, qos=1, pub_timeout=60):
+        """
+        Publish a payload of any size as a sequence of chunk messages (see
+        mqtt_chunks), which the receiver reassembles. A file is read one chunk
+        at a time, with at most stream_window chunks queued at once, so large
+        payloads need not fit in memory.
+        """
+        self.message_id = (self.message_id + 1) & 0xFFFF
+        in_flight = deque()
+        try:
+            for chunk in mqtt_chunks.split(data, self.message_id):
+                if len(in_flight) >= self.stream_window:
+                    await in_flight.popleft()
+                in_flight.append(self.queue_publish(topic, chunk, False, qos, pub_timeout))
+            while in_flight:
+                await in_flight.popleft()
+        finally:
+            for future in in_flight:
+                # Don't leave failures unretrieved if we gave up early
+                future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    def _publish_failed(self, item, e):
+        topic, msg, retain, qos, pub_timeout, spool, future = item
+        if future.done():
+            return
+        if spool is not None and qos > 0:
+            # Keep it for when we're reconnected
+            spool.append(topic, msg, retain, qos)
+            self._record_queues()
+            future.set_result(None)
+        else:
+            future.set_exception(e)
+
+    def _record_queues(self):
+        if self.metrics is not None:
+            self.metrics.queue('publish_queue', self.publish_queue.qsize())
+            self.metrics.queue('awaiting_ack', len(self.publish_waiters))
+            if self.spool is not None:
+                self.metrics.queue('spool_bytes', self.spool.pending_bytes())
+
+    async def _publish_metrics(self):
+        "The background task that publishes a summary of the metrics every metrics_interval seconds"
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            self._record_queues()
+            if self.connected:
+                self.queue_publish(self.metrics_topic, self.metrics.summary_json(reset=True), spool=False)
+
+    async def _publish_one(self, topic, msg, retain, qos, pub_timeout):
+        "Send one message, returning its CMQTTPUB command without waiting for the broker's acknowledgment"
         await self._send_at_command('CMQTTTOPIC', f'=0,{len(topic)}', payload=topic)
         await self._send_at_command('CMQTTPAYLOAD', f'=0,{len(msg)}', payload=msg)
-        await self._send_at_command('CMQTTPUB', f'=0,{qos},{pub_timeout},{int(retain)}', result_handler=lambda s: extract_numeric_values(s)[1])
+        return await self._send_at_command('CMQTTPUB', f'=0,{qos},{pub_timeout},{int(retain)}', ack=True)
+
+    async def _complete_publish(self, ack, item):
+        future = item[-1]
+        try:
+            ack = await self.at.acked(ack, timeout=item[4] + self.command_timeout)
+            result = extract_numeric_values(ack.ack_line)[1]
+            if result != 0:
+                raise ValueError(f"Command CMQTTPUB failed with result: {result}", result)
+            if not future.done():
+                future.set_result(result)
+        except Exception as e:
+            self._publish_failed(item, e)
+
+    async def _publish_loop(self):
+        """
+        The background publisher task. Takes whatever messages are queued (up
+        to max_publish_batch) and sends them back to back under the sequence
+        lock, so that other commands can't interleave with a topic/payload/
+        publish sequence. Each message's CMQTTPUB is pipelined: the next
+        message is sent without waiting for the previous broker acknowledgment.
+        """
+        while True:
+            batch = [await self.publish_queue.get()]
+            while len(batch) < self.max_publish_batch and not self.publish_queue.empty():
+                batch.append(self.publish_queue.get_nowait())
+            async with self.sequence_lock:
+                for item in batch:
+                    try:
+                        ack = await self._publish_one(*item[:5])
+                        task = asyncio.create_task(self._complete_publish(ack, item))
+                        self.publish_waiters.add(task)
+                        task.add_done_callback(self.publish_waiters.discard)
+                    except Exception as e:
+                        self._publish_failed(item, e)
+                    finally:
+                        self.publish_queue.task_done()
 
     async def subscribe(self, topic, qos=0):
         assert self.cb is not None
         assert 0 <= qos <= 2
         assert 0 < len(topic) <= 1024
+        self.subscriptions[topic] = qos
+        async with self.sequence_lock:
+            await self._subscribe(topic, qos)
+
+    async def _subscribe(self, topic, qos):
         await self._send_at_command('CMQTTSUB', f'=0,{len(topic)},{qos}', payload=topic, result_handler=lambda s: extract_numeric_values(s)[1])
 
     async def unsubscribe(self, topic):
         assert 0 < len(topic) <= 1024
-        await self._send_at_command('CMQTTUNSUB', f'=0,{len(topic)},1', payload=topic, result_handler=lambda s: extract_numeric_values(s)[1])
+        self.subscriptions.pop(topic, None)
+        async with self.sequence_lock:
+            await self._send_at_command('CMQTTUNSUB', f'=0,{len(topic)},1', payload=topic, result_handler=lambda s: extract_numeric_values(s)[1])
 
     async def check_msg(self):
-        # Non-blocking check for messages
-        # You may want to implement a background task for this
-        pass
+        # Incoming messages are delivered to the callback by the reader task as
+        # soon as they arrive, so there is nothing to poll for; just yield.
+        await asyncio.sleep(0)
+
+class AsyncMQTTFleet:
+    """
+    Several modems, each with its own AsyncMQTTClient, used as one client.
+    Publishes go to the connected modem with the least outstanding, so uplink
+    throughput grows with the number of modems, and a publish that fails on
+    one modem (e.g. after +CMQTTNONET) is retried on another. Subscriptions
+    are made through every modem, and a message arriving through several of
+    them is delivered once.
+    """
+
+    def __init__(self, clients, dedup_seconds=10):
+        """
+        Args:
+            clients (list): The AsyncMQTTClients, which need different client IDs.
+            dedup_seconds (float): How long a message is remembered, to recognise
+                copies arriving through the other modems.
+        """
+        self.clients = clients
+        self.cb = None
+        self.dedup_seconds = dedup_seconds
+        self.seen = {}      # (topic, payload hash) -> [time, copies delivered, Counter of arrivals per client]
+        self.next = 0       # round robin between equally loaded modems
+
+    async def connect(self, ports, **kwargs):
+        """
+        Connect each client through its modem, concurrently. Those that fail
+        are left to reconnect later, if their auto_reconnect is set.
+
+        Args:
+            ports (list): Each client's serial port, in order.
+            kwargs: Passed to each AsyncMQTTClient.connect().
+
+        Raises:
+            ConnectionError: If none of them connected.
+        """
+        assert len(ports) == len(self.clients)
+        results = await asyncio.gather(*(client.connect(port=port, **kwargs) for client, port in zip(self.clients, ports)),
+                                       return_exceptions=True)
+        for client, result in zip(self.clients, results):
+            if isinstance(result, BaseException):
+                print(f'{client.client_id} failed to connect: {result}')
+                if client.at is not None and client.auto_reconnect and client.supervisor_task is None:
+                    client.supervisor_task = asyncio.create_task(client._supervise())
+                    client.lost.set()
+        if not self.healthy():
+            raise ConnectionError("None of the modems connected")
+
+    def healthy(self):
+        "The clients which are connected, and whose modems are still responding"
+        return [client for client in self.clients if client.connected and client.at is not None and client.at.error is None]
+
+    def _pick(self, exclude=()):
+        "The healthy client with the fewest publishes outstanding, or None"
+        candidates = [client for client in self.healthy() if client not in exclude]
+        if not candidates:
+            return None
+        self.next += 1
+        return min(candidates, key=lambda client: (client.publish_queue.qsize() + len(client.publish_waiters),
+                                                   (self.clients.index(client) - self.next) % len(self.clients)))
+
+    def queue_publish(self, topic, msg, retain=False, qos=0, pub_timeout=60):
+        "As AsyncMQTTClient.queue_publish(), through the least loaded modem (without retrying on another)"
+        client = self._pick() or next((c for c in self.clients if c.spool is not None), None)
+        if client is None:
+            raise ConnectionError("No modem connected")
+        return client.queue_publish(topic, msg, retain, qos, pub_timeout)
+
+    async def publish(self, topic, msg, retain=False, qos=0, pub_timeout=60):
+        """
+        Publish through the least loaded modem, trying each of the others in
+        turn if it fails there. Only if it fails on all of them (or none is
+        connected) is it spooled, as AsyncMQTTClient.publish() would, in the
+        first client with a spool; the result is then None.
+        """
+        tried = set()
+        error = ConnectionError("No modem connected")
+        while True:
+            client = self._pick(exclude=tried)
+            if client is None:
+                break
+            try:
+                return await client.publish(topic, msg, retain, qos, pub_timeout, spool=False)
+            except (ValueError, TimeoutError, OSError, EOFError) as e:
+                print(f'Publish through {client.client_id} failed, failing over: {e}')
+                tried.add(client)
+                error = e
+        spooler = next((c for c in self.clients if c.spool is not None), None)
+        if spooler is None or (tried and qos == 0):
+            raise error
+        if spooler.compression is not None:
+            msg = spooler.compression.compress(msg)
+        spooler.spool.append(topic, msg, retain, qos)
+        spooler._record_queues()
+        return None
+
+    def set_callback(self, f):
+        self.cb = f
+        for client in self.clients:
+            client.set_callback(lambda topic, msg, client=client: self._deliver(client, topic, msg))
+
+    def _deliver(self, client, topic, msg):
+        """
+        Pass a message on unless it's a copy of one that arrived through
+        another modem. The same message arriving twice through the same modem
+        was published twice, so is delivered both times, and each modem's
+        first two copies of it are then copies of those.
+        """
+        now = asyncio.get_running_loop().time()
+        if len(self.seen) > 1000:
+            self.seen = {key: entry for key, entry in self.seen.items() if now - entry[0] < self.dedup_seconds}
+        key = (topic, hash(msg))
+        entry = self.seen.get(key)
+        if entry is None or now - entry[0] >= self.dedup_seconds:
+            entry = self.seen[key] = [now, 0, Counter()]
+        arrivals = entry[2]
+        arrivals[client] += 1
+        if arrivals[client] <= entry[1]:
+            return None
+        entry[0] = now
+        entry[1] = arrivals[client]
+        return self.cb(topic, msg)
+
+    async def subscribe(self, topic, qos=0):
+        "Subscribe through every modem; those not connected subscribe when they reconnect"
+        assert self.cb is not None
+        connected = self.healthy()
+        for client in self.clients:
+            if client not in connected:
+                client.subscriptions[topic] = qos
+        await asyncio.gather(*(client.subscribe(topic, qos) for client in connected))
+
+    async def unsubscribe(self, topic):
+        connected = self.healthy()
+        for client in self.clients:
+            if client not in connected:
+                client.subscriptions.pop(topic, None)
+        await asyncio.gather(*(client.unsubscribe(topic) for client in connected))
+
+    async def disconnect(self):
+        await asyncio.gather(*(client.disconnect() for client in self.clients), return_exceptions=True)
 
 async def upload_cert(client, filename):
-    with open(filename, 'rb') as f:
-        data = f.read()
-        await client._send_at_command('CCERTDOWN', f'="{filename}",{len(data)}', payload=data)
+    """
+    Upload a certificate to the modem, unless it already holds this version
+    of it (see modem_certs), and delete any older versions. Returns the name
+    it's stored under on the modem, for ssl_params['ca_cert'].
+    """
+    data, name = modem_certs.read_cert(filename)
+    try:
+        stored = await client._send_at_command('CCERTLIST', result_handler=modem_certs.parse_list, query=True)
+    except ValueError:
+        stored = set()
+    if name not in stored:
+        await client._send_at_command('CCERTDOWN', f'="{name}",{len(data)}', payload=data)
+        for old in modem_certs.stale(stored, name):
+            await client._send_at_command('CCERTDELE', f'="{old}"')
+    return name
 
-def sub_cb(topic, msg):
-    parts = topic.decode().split('/')
-    if parts[0] == 'BWtest' and parts[1] == 'topic':
-        print(f'sub_cb({parts}, {msg})')
-    else:
-        print(f'sub_cb({topic}, {msg})')
+topics = mqtt_topics.Dispatcher(default=lambda topic, msg: print(f'sub_cb({topic}, {msg})'))
+topics.add('BWtest/topic/#', lambda topic, msg: print(f'sub_cb({list(topics.levels(topic))}, {msg})'))
+sub_cb = topics.dispatch
 
 async def test():
     topic1 = b"BWtest/topic"
     topic2 = b"BWtest/timestamp"
-    ssl_params = {'ca_cert': 'isrgrootx1.pem', 'ssl_version': 3, 'auth_mode': 1, 'ignore_local_time': True, 'enable_SNI': True}
-    client = AsyncMQTTClient("BWtestClient0", "8d5ec6984ed54a29ac7794546055635d.s1.eu.hivemq.cloud", port=8883, user="oisl_brian", password="Oisl2023", ssl=True, ssl_params=ssl_params)
+    topic3 = b"BWtest/telemetry"
+    telemetry = telemetry_codec.Batch(telemetry_codec.BIRDBOX, max_samples=12)
+    ssl_params = {'ca_cert': modem_certs.cert_name('isrgrootx1.pem'), 'ssl_version': 3, 'auth_mode': 1, 'ignore_local_time': True, 'enable_SNI': True}
+    client = AsyncMQTTClient("BWtestClient0", "8d5ec6984ed54a29ac7794546055635d.s1.eu.hivemq.cloud", port=8883, user="oisl_brian", password="Oisl2023", ssl=True, ssl_params=ssl_params,
+                             spool=Spool('BWtest.spool'), compression=mqtt_compress.Compressor(), metrics=modem_metrics.Metrics())
+    client.metrics_topic = b"BWtest/metrics"
     client.set_last_will(b"BWtest/lastwill", b"Pi Python connection broken", qos=1)
     await client.connect()
     client.set_callback(sub_cb)
@@ -327,18 +698,24 @@ async def test():
             print(f'Publishing to {topic2}: {payload2}')
             await client.publish(topic2, payload2.encode("utf-8"), retain=True, qos=1)
             print("Publish done")
+            # A sample per interval, published a dozen at a time
+            data = telemetry.add(time=now, battery_level=60, status='up', stay_up=False, force_up=False)
+            if data:
+                await client.publish(topic3, data, qos=1)
             start_time = asyncio.get_event_loop().time()
             wait_interval = 5 # 15 * 60
             while asyncio.get_event_loop().time() - start_time < wait_interval:
                 await asyncio.sleep(1)
-                # You may want to implement message checking here
     except KeyboardInterrupt:
         pass
     except asyncio.exceptions.CancelledError:
         pass
 
+    if len(telemetry):
+        await client.publish(topic3, telemetry.flush(), qos=1)
     await client.unsubscribe(topic1)
     await client.disconnect()
+    print(client.metrics.summary())
 
 if __name__ == "__main__":
     asyncio.run(test())
\ No newline at end of file
@@ -1,6 +1,16 @@
+import random
 import serial
 import time
 from datetime import datetime
+import modem_certs
+import modem_config
+import modem_metrics
+import simcom_at
+import mqtt_chunks
+import mqtt_compress
+import mqtt_topics
+import telemetry_codec
+from mqtt_spool import Spool
 
 def extract_numeric_values(response):
     """
@@ -23,7 +33,7 @@ def extract_numeric_values(response):
 
 
 class MQTTClient:
-    def __init__(self, client_id, server, port = 0, user=None, password=None, keepalive=20, ssl=False, ssl_params={}):
+    def __init__(self, client_id, server, port = 0, user=None, password=None, keepalive=20, ssl=False, ssl_params={}, verbose=False, spool=None, metrics=None):
         """
         Initialize the MQTT client.
 
@@ -36,6 +46,10 @@ class MQTTClient:
             keepalive (int): The keepalive interval in seconds. (0 < keepalive <= 64800)
             ssl (bool): Whether to use SSL for the connection.
             ssl_params (dict): SSL parameters for the connection.
+            verbose (bool): Whether to print the modem traffic.
+            spool (mqtt_spool.Spool): Where to keep messages published while disconnected, if anywhere.
+            metrics (modem_metrics.Metrics): Where to record command latencies, bytes, URCs etc., if anywhere.
+                A summary is published to metrics_topic, if set, every metrics_interval seconds.
         """
         assert 0 < keepalive <= 64800
         self.client_id = client_id
@@ -56,6 +70,25 @@ class MQTTClient:
         self.lw_qos = 0
         self.lw_retain = False
         self.use_ssl = ssl
+        self.verbose = verbose
+        self.spool = spool
+        self.modem = None
+        self.at = None               # simcom_at.SerialAT, once connected
+        self.rx = None               # [topic, length so far, payload, length so far] of a message being received
+        self.subscriptions = {}      # topic -> qos, to restore after reconnecting
+        self.config = modem_config.ModemConfig() # what the modem is known to be configured with
+        self.reassembler = mqtt_chunks.Reassembler()
+        self.message_id = 0          # for chunked publishes
+        self.command_timeout = 30    # seconds to wait for the modem to respond to a command
+        self.auto_reconnect = True
+        self.reconnect_min = 1       # seconds before the first reconnect attempt
+        self.reconnect_max = 300     # longest delay between attempts
+        self.reconnect_delay = self.reconnect_min
+        self.next_reconnect = 0      # time.monotonic() of the next attempt
+        self.metrics = metrics
+        self.metrics_topic = None
+        self.metrics_interval = 300
+        self.next_metrics = time.monotonic() + self.metrics_interval
         if ssl:
             self.ssl_context = 1 # ToDo: just use client_index?
             self.ca_cert = ssl_params['ca_cert']
@@ -64,152 +97,100 @@ class MQTTClient:
             self.ignore_local_time = ssl_params['ignore_local_time']
             self.enable_SNI = ssl_params['enable_SNI']
 
-    def _send_at_command(self, command, body= "", result_handler=None, payload=None):
+    def _log(self, *args, **kwargs):
+        if self.verbose:
+            print(*args, **kwargs)
+
+    def _send_at_command(self, command, body= "", result_handler=None, payload=None, query=False, timeout=None):
         """
         Send an AT command to the modem and wait for the expected response.
 
         Args:
             command (str): The AT command to send.
-            expected_response (str): The expected response from the self.modem.
-            payload (bytes): Optional payload to send after the command.
-            timeout (int): Timeout in seconds to wait for the response.
+            body (str): The rest of the command line, after the command name.
+            result_handler (function): Called with the solicited result (str, after the ':').
+            payload (bytes): Optional payload to send after the '>' prompt.
+            query (bool): The command is a query, whose (zero or more) result lines all precede
+                the OK. result_handler is then called with a list of them at the OK.
+            timeout (float): Seconds to wait for the response, by default self.command_timeout.
 
         Returns:
-            str: The response from the self.modem.
-        """
-        cmd_str = 'AT+' + command + body +'\r'
-        encoded_cmd = cmd_str.encode()
-        self.modem.write(encoded_cmd)
-        #time.sleep(0.1)  # Small delay to allow modem to process
-        
-        response = None
-        result = None
+            The result handler's return value, 0 for a plain OK, or -1 for an ERROR.
 
-        # Process one line at a time until we get a response
-        while True:
-            # Process a line, according to its first character
-            word = b""
-            char = self.modem.read(1)
-            complete_line = char # bytes type
-            if b'>' == char:
-                if payload:
-                    self.modem.write(payload)
-                    #print(payload.decode(), end="")
-                    complete_line += payload # + '\n'
-            elif char == b'+':
-                # Get word
-                char = self.modem.read(1)
-                while char.isalpha():
-                    word += char
-                    char = self.modem.read(1)
-                if word.decode() == command:
-                    # Solicited response
-                    result = self.modem.readline()
-                    #char = b'\n'
-                    complete_line += word + result
-                else:
-                    # Unsolicited response
-                    complete_line += word + char + self.modem.readline()
-                    self.handle_unsolicited_response(complete_line)
-                    pass
-                # Get rest of line
-                pass
-            elif char.isalpha():
-                # Get rest of word
-                while char.isalpha():
-                    word += char
-                    char = self.modem.read(1)
-                complete_line = word + char + self.modem.readline()
-                if word == b'ERROR':
-                    response = False
-                elif word == b'OK':
-                    response = True
-                elif word == b'AT':
-                    # The echoed command line includes an extra '\r' at the end, so strip both
-                    assert complete_line.strip() == cmd_str.encode().strip()
-                    pass # ignore echo
-                else:
-                    print(f"Unknown response: {word}")
-            elif char == b'\n':
-                pass # ignore newlines
-            elif char == b'\r':
-                pass # ignore carriage returns
-            else:
-                print(f"Unexpected char: {char}")
-            
-            print(complete_line.decode(), end="")
-            
-            # Check if we have a response from the modem.
-            if response is not None:
-                # We have received either an OK or an ERROR from the modem.
-                if response == False:
-                    # There was an explicit ERROR line from the modem,
-                    # so any result must have already been received.
-                    if result is None:
-                        # There was no result, so return -1 as a generic error.
-                        return -1
-                    elif result_handler is not None:
-                        # We have a result, so pass it to the result handler
-                        print("result =", result_handler(result.strip()))
-                        return result_handler(result.strip())
-                    else:
-                        # No result handler, so return -1 as a generic error.
-                        return -1
-                else:
-                    # There was an explicit OK from the modem, but we may still have a result
-                    # still to come.
-                    if result_handler is not None:
-                        # If the caller provided a result handler then a result is expected.
-                        if result is None:
-                            # So we need to wait for the result
-                            pass
-                        else:
-                            # We already have the result, so pass it to the
-                            # result handler and return *its* result.
-                            print("result =", result_handler(result.strip()))
-                            return result_handler(result.strip())
-                    else:
-                        return 0
-
-    def handle_unsolicited_response(self, response):
+        Raises:
+            TimeoutError: If the modem didn't respond in time.
+        """
+        if payload:
+            self._log('>' + payload.decode(errors="replace"))
+        cmd = self.at.command(simcom_at.ATCommand('AT+' + command + body, payload=payload or None,
+                                                  expect_result=result_handler is not None, query=query),
+                              timeout=self.command_timeout if timeout is None else timeout)
+        results = [line[len(cmd.prefix):].strip() for line in cmd.results]
+        if query:
+            # All of a query's results precede its OK
+            return result_handler(results) if cmd.ok else -1
+        if results and result_handler is not None:
+            # Either the result came with the OK, or it explains the ERROR
+            return result_handler(results[-1])
+        return 0 if cmd.ok else -1
+
+    def handle_unsolicited_response(self, response, data=None):
         """
         Handle an unsolicited response from the modem.
 
         Args:
             response (str): The unsolicited response from the modem.
+            data (bytes): The raw data which followed it, if any, e.g. part of a received topic.
         """
-        topic = b''
-        payload = b''
-        response = response.decode().strip()
-        print(response)
+        rx = self.rx
         if response.startswith('+CMQTTRXSTART:'):
-            # MQTT message received
+            # MQTT message received, its topic and payload may come in several parts,
+            # which are written straight into buffers of the full size
             id, topic_total_len, payload_total_len = extract_numeric_values(response)
+            self.rx = [bytearray(topic_total_len), 0, bytearray(payload_total_len), 0]
+        elif rx and response.startswith('+CMQTTRXTOPIC:'):
+            rx[0][rx[1]:rx[1] + len(data)] = data
+            rx[1] += len(data)
+        elif rx and response.startswith('+CMQTTRXPAYLOAD:'):
+            rx[2][rx[3]:rx[3] + len(data)] = data
+            rx[3] += len(data)
+        elif rx and response.startswith('+CMQTTRXEND:'):
+            topic, topic_len, payload, payload_len = rx
+            self.rx = None
+            assert topic_len == len(topic)
+            assert payload_len == len(payload)
+            # Callbacks get bytes, not our receive buffers
+            topic = bytes(topic)
+            payload = bytes(payload)
+            # Compressed payloads are recognised by their header.
+            # Chunked payloads are only delivered once complete
+            try:
+                payload = self.reassembler.add(topic, mqtt_compress.decompress(payload))
+            except ValueError as e:
+                self._log(f"Dropped message for {topic}: {e}")
+                payload = None
+            if payload is None:
+                pass
+            elif self.cb:
+                self.cb(topic, payload)
+            else:
+                print(f"Received message for {topic}: {payload}")
+        elif response.startswith('+CMQTTCONNLOST:'):
+            client_index, cause = extract_numeric_values(response)
+            self._log(f'MQTT connection lost, cause: {cause}')
+            self.config.forget(('CMQTTCONNECT', client_index))
+            self.connected = False
+        elif response.startswith('+CMQTTNONET'):
+            self._log("MQTT no network")
+            self.connected = False
+        elif response.startswith('*ATREADY') or response == 'RDY':
+            # The modem has (re)booted, so holds none of our configuration
+            self.config.forget_all()
+            self.connected = False
+        elif response:
+            self._log(f"Unsolicited: {response}")
 
-            while True:
-                response = self.modem.readline().decode().strip()
-                print(response)
-                if response.startswith('+CMQTTRXTOPIC:'):
-                    # MQTT message received
-                    id, topic_sub_len = extract_numeric_values(response)
-                    topic += self.modem.read(topic_sub_len)
-                    topic_total_len -= topic_sub_len
-                    print(topic.decode(), end="") # ToDo: fix for multiples
-                elif response.startswith('+CMQTTRXPAYLOAD:'):
-                    id, payload_sub_len = extract_numeric_values(response)
-                    payload += self.modem.read(payload_sub_len)
-                    payload_total_len -= payload_sub_len
-                    print(payload.decode(), end="") # ToDo: fix for multiples
-                elif response.startswith('+CMQTTRXEND:'):
-                    assert topic_total_len == 0
-                    assert payload_total_len == 0
-                    if self.cb:
-                        self.cb(topic, payload)
-                    else:
-                        print(f"Received message for {topic}: {payload}")
-                    break
-
-    def connect(self, apn="iot.1nce.net", clean_session = True, timeout = 2): # ToDO: default timeout should be 0
+    def connect(self, apn="iot.1nce.net", clean_session = True, timeout = 2, port='/dev/ttyAMA0', baudrate=115200): # ToDO: default timeout should be 0
         """
         Connect to the MQTT broker.
 
@@ -217,6 +198,8 @@ class MQTTClient:
             apn (str): The Access Point Name for the PDP context.
             clean_session (bool): Whether to start a clean session.
             timeout (int): Timeout in seconds for the connection. (0 <= timeout)
+            port (str): The modem's serial port, or the PTY of simcom_sim.py.
+            baudrate (int): The serial port's baud rate.
 
         Returns:
             bool: True if connected to a persistent session, False otherwise.
@@ -230,21 +213,102 @@ class MQTTClient:
             credentials = ''
         self.timeout = timeout
 
-        self.modem = serial.Serial(port='/dev/ttyAMA0', baudrate=115200) #, timeout=timeout)
+        self.credentials = credentials
+        self.apn = apn
+        self.clean_session = clean_session
+
+        self.modem = serial.Serial(port=port, baudrate=baudrate) #, timeout=timeout)
+        self.at = simcom_at.SerialAT(self.modem, self.handle_unsolicited_response, log=self._log if self.verbose else None, metrics=self.metrics)
         self.context_num = 1
-        self._send_at_command('CGDCONT', f'=1,"IP","{apn}"') # Configure PDP context
-        self._send_at_command('CGACT', f'=1,{self.context_num}')  # Activate PDP context
-        self._send_at_command('CMQTTSTART', result_handler=lambda s: int(s))             # Start MQTT session
+        self._start_session()
+        self._connected()
+        return False # ToDO: return true if connected to a persistent session?
+
+    def _query_modem_state(self):
+        "Find out which configuration the modem already holds, e.g. from a previous run"
+        for command in modem_config.QUERIES:
+            results = self._send_at_command(command, '?', result_handler=lambda results: results, query=True)
+            self.config.parse(command, None if results == -1 else results)
 
-        self._send_at_command('CMQTTACCQ', f'={self.client_index},"{self.client_id}",{int(self.use_ssl)}')
+    def _pdp_active(self):
+        "Whether our PDP context is still active"
+        results = self._send_at_command('CGACT', '?', result_handler=lambda results: results, query=True)
+        self.config.parse('CGACT', None if results == -1 else results)
+        return self.config.is_set(('CGACT', self.context_num), f'=1,{self.context_num}')
+
+    def _configure(self, key, command, body="", result_handler=None, payload=None):
+        """
+        Send a configuration command, unless the modem already holds that setting.
+
+        Args:
+            key (tuple): The setting's key in self.config.
+            Others as for _send_at_command().
+
+        Returns:
+            0 if the setting was already held, otherwise the command's result.
+        """
+        if self.config.is_set(key, body):
+            return 0
+        result = self._send_at_command(command, body, result_handler=result_handler, payload=payload)
+        if result == 0:
+            self.config.set(key, body)
+        return result
+
+    def _start_session(self):
+        """
+        Bring up the PDP context and the MQTT session, sending only the
+        configuration commands that differ from what the modem already holds.
+
+        Raises:
+            ConnectionError: If the broker refused the connection.
+        """
+        if not self.config.known:
+            self._query_modem_state()
+        else:
+            self._pdp_active() # the network may have dropped the context
+        self._configure(('CGDCONT', self.context_num), 'CGDCONT', f'=1,"IP","{self.apn}"') # Configure PDP context
+        self._configure(('CGACT', self.context_num), 'CGACT', f'=1,{self.context_num}')  # Activate PDP context
+
+        for attempt in range(2):
+            result = self._start_mqtt()
+            if attempt == 0 and result == 19:
+                # "Already connected" means that a session is left over,
+                # possibly with a different client ID, so stop it and start again.
+                self._teardown_session()
+                continue
+            break
+        if result != 0:
+            raise ConnectionError(f"CMQTTCONNECT failed with result: {result}")
+
+    def _start_mqtt(self):
+        """
+        Start the MQTT service and connect to the broker.
+
+        Returns:
+            int: 0 if connected, otherwise CMQTTCONNECT's error code.
+        """
+        for attempt in range(2):
+            started = self._configure(('CMQTTSTART',), 'CMQTTSTART', result_handler=lambda s: int(s))             # Start MQTT session
+            acquired = self._configure(('CMQTTACCQ', self.client_index), 'CMQTTACCQ', f'={self.client_index},"{self.client_id}",{int(self.use_ssl)}')
+            if attempt == 0 and (started != 0 or acquired != 0):
+                # An immediate ERROR implies that a session, possibly with a
+                # different client ID, is left over, so stop it and start again.
+                self._teardown_session()
+                continue
+            break
         if self.use_ssl:
             self.ssl_context = 1 # ToDo: just use client_index?
-            self._send_at_command('CSSLCFG', f'="sslversion",{self.ssl_context},{self.ssl_version}')    # set SSL version
-            self._send_at_command('CSSLCFG', f'="authmode",{self.ssl_context},{self.auth_mode}')        # set authentication mode
-            self._send_at_command('CSSLCFG', f'="ignorelocaltime",{self.ssl_context},{int(self.ignore_local_time)}')
-            self._send_at_command('CSSLCFG', f'="cacert",{self.ssl_context},"{self.ca_cert}"')          # Set CA root certificate
-            self._send_at_command('CSSLCFG', f'="enableSNI",{self.ssl_context},{int(self.enable_SNI)}') # Set Server Name Indication
-            self._send_at_command('CMQTTSSLCFG', f'={self.client_index},{self.ssl_context}')       # Set SSL context for MQTT
+            for name, value in (('sslversion', self.ssl_version),                     # set SSL version
+                                ('authmode', self.auth_mode),                         # set authentication mode
+                                ('ignorelocaltime', int(self.ignore_local_time)),
+                                ('cacert', f'"{self.ca_cert}"'),                      # Set CA root certificate
+                                ('enableSNI', int(self.enable_SNI))):                 # Set Server Name Indication
+                self._configure(('CSSLCFG', name, self.ssl_context), 'CSSLCFG', f'="{name}",{self.ssl_context},{value}')
+            self._configure(('CMQTTSSLCFG', self.client_index), 'CMQTTSSLCFG', f'={self.client_index},{self.ssl_context}') # Set SSL context for MQTT
+
+        body = f'={self.client_index},"tcp://{self.server_url}:{self.port}",{self.keepalive},{int(self.clean_session)}{self.credentials}'
+        if self.config.is_set(('CMQTTCONNECT', self.client_index), body):
+            return 0 # still connected, with the same settings, from a previous run
 
         if self.lw_topic and self.lw_msg:
             assert 0 < len(self.lw_topic) <= 1024
@@ -252,13 +316,72 @@ class MQTTClient:
             assert self.lw_retain == False, "retain=True is not supported by SimCOMM A76xx for last will"
             assert 0 <= self.lw_qos <= 2
             # Set last will message
-            self._send_at_command('CMQTTWILLTOPIC', f'={self.client_index},{len(self.lw_topic)}', payload=self.lw_topic)  # Send topic
-            self._send_at_command('CMQTTWILLMSG', f'={self.client_index},{len(self.lw_msg)},{self.lw_qos}', payload=self.lw_msg)  # Send payload
-
-        self._send_at_command('CMQTTCONNECT', f'={self.client_index},"tcp://{self.server_url}:{self.port}",{self.keepalive},{int(clean_session)}{credentials}',
-        result_handler=lambda s: int(s.split(b',')[1]))  # Connect to the broker
+            will = (self.lw_topic, self.lw_msg, self.lw_qos)
+            if not self.config.is_set(('CMQTTWILL', self.client_index), will):
+                self._send_at_command('CMQTTWILLTOPIC', f'={self.client_index},{len(self.lw_topic)}', payload=self.lw_topic)  # Send topic
+                if self._send_at_command('CMQTTWILLMSG', f'={self.client_index},{len(self.lw_msg)},{self.lw_qos}', payload=self.lw_msg) == 0:  # Send payload
+                    self.config.set(('CMQTTWILL', self.client_index), will)
+
+        result = self._send_at_command('CMQTTCONNECT', body, result_handler=lambda s: int(s.split(',')[1]))  # Connect to the broker
+        if result == 0:
+            self.config.set(('CMQTTCONNECT', self.client_index), body)
+        return result
+
+    def _teardown_session(self):
+        "Stop the MQTT session, ignoring errors as it may already be (partly) down"
+        self._send_at_command('CMQTTDISC', f'={self.client_index}', result_handler=lambda s: int(s.split(',')[1]))
+        self._send_at_command('CMQTTREL', f'={self.client_index}')
+        self._send_at_command('CMQTTSTOP', result_handler=lambda s: int(s))
+        self.config.forget_mqtt()
+
+    def _connected(self):
         self.connected = True
-        return False # ToDO: return true if connected to a persistent session?
+        if self.spool is not None:
+            # Send anything published while we were disconnected, oldest first
+            try:
+                self.spool.drain(lambda topic, msg, retain, qos: self._publish(topic, msg, retain, qos) == 0)
+            except (TimeoutError, ValueError):
+                # What wasn't sent stays spooled for the next attempt
+                self.connected = False
+                raise
+            finally:
+                self._record_spool()
+        self.reconnect_delay = self.reconnect_min
+        self.next_reconnect = 0
+
+    def reconnect(self):
+        """
+        Re-establish the MQTT session after the connection was lost, reusing
+        the PDP context and SSL configuration if still held, and re-subscribe to our topics.
+
+        Raises:
+            ConnectionError: If the broker refused the connection.
+        """
+        self._teardown_session()
+        self._start_session()
+        for topic, qos in self.subscriptions.items():
+            self._subscribe(topic, qos)
+        if self.metrics is not None:
+            self.metrics.count('reconnects')
+        self._connected()
+
+    def _supervise(self):
+        """
+        If the connection has been lost and the backoff delay has passed,
+        try to reconnect. On failure the next attempt is scheduled after an
+        exponentially increasing, jittered delay.
+        """
+        if self.connected or not self.auto_reconnect or self.modem is None:
+            return
+        now = time.monotonic()
+        if now < self.next_reconnect:
+            return
+        try:
+            self.reconnect()
+        except (ConnectionError, TimeoutError, ValueError, serial.SerialException) as e:
+            self._log(f"Reconnect failed: {e}")
+            self.next_reconnect = now + random.uniform(self.reconnect_delay / 2, self.reconnect_delay)
+            self.reconnect_delay = min(self.reconnect_delay * 2, self.reconnect_max)
     
     def disconnect(self):
         """
@@ -266,11 +389,13 @@ class MQTTClient:
         """
         if self.connected:
             if self.client_index != None:
-                self._send_at_command('CMQTTDISC', f'={self.client_index}', result_handler=lambda s: int(s.split(b',')[1])) # disconnect from the broker
+                self._send_at_command('CMQTTDISC', f'={self.client_index}', result_handler=lambda s: int(s.split(',')[1])) # disconnect from the broker
                 self._send_at_command('CMQTTREL', f'={self.client_index}')  # release the client
                 self.client_index = None
             self._send_at_command('CMQTTSTOP', result_handler=lambda s: int(s))             # Stop MQTT session
             self._send_at_command('CGACT', f'=0,{self.context_num}') # Deactivate PDP context
+            self.config.forget_mqtt()
+            self.config.forget(('CGACT', self.context_num))
             self.modem.close()
             self.connected = False
 
@@ -312,14 +437,75 @@ class MQTTClient:
             msg (bytes): The message payload. (0 < len(msg) <= 10240)
             retain (bool): Whether to retain the message.
             qos (int): The Quality of Service level. (0 <= qos <= 2)
+
+        Returns:
+            int: 0 if published, None if spooled for later, otherwise an error code.
         """
         assert 0 <= qos <= 2
         assert 0 < len(topic) <= 1024
         assert 0 < len(msg) <= 10240
+        self._supervise()
+        if self.spool is not None and not self.connected:
+            self.spool.append(topic, msg, retain, qos)
+            self._record_spool()
+            return None
+        try:
+            result = self._publish(topic, msg, retain, qos, pub_timeout)
+        except TimeoutError as e:
+            # The modem has stopped responding, so reconnect when next supervised
+            self._log(f"Publish failed: {e}")
+            self.connected = False
+            result = -1
+        if result != 0 and self.spool is not None and qos > 0:
+            # Keep it for when we're reconnected
+            self.spool.append(topic, msg, retain, qos)
+            self._record_spool()
+            return None
+        return result
+
+    def _record_spool(self):
+        if self.metrics is not None and self.spool is not None:
+            self.metrics.queue('spool_bytes', self.spool.pending_bytes())
+
+    def publish_metrics(self):
+        """
+        Publish a summary of the metrics (see modem_metrics) to metrics_topic,
+        and start a new period.
+
+        Returns:
+            int: 0 if published, otherwise an error code.
+        """
+        self._record_spool()
+        self.next_metrics = time.monotonic() + self.metrics_interval
+        return self._publish(self.metrics_topic, self.metrics.summary_json(reset=True))
+
+    def publish_stream(self, topic, data, qos=1, pub_timeout=60):
+        """
+        Publish a payload of any size as a sequence of chunk messages (see
+        mqtt_chunks), which the receiver reassembles. A file is read one chunk
+        at a time, so need not fit in memory.
+
+        Args:
+            topic (bytes): The topic to publish to. (0 < len(topic) <= 1024)
+            data (bytes-like or file): The payload, or a seekable binary file to read it from.
+            qos (int): The Quality of Service level. (0 <= qos <= 2)
+
+        Returns:
+            int: 0 if all chunks were published (or spooled), otherwise the first error code.
+        """
+        self.message_id = (self.message_id + 1) & 0xFFFF
+        for chunk in mqtt_chunks.split(data, self.message_id):
+            result = self.publish(topic, chunk, False, qos, pub_timeout)
+            if result not in (0, None):
+                return result
+        return 0
+
+    def _publish(self, topic, msg, retain=False, qos=0, pub_timeout=60):
         # ToDo: provide error handler for topic and payload commands, below
         self._send_at_command('CMQTTTOPIC', f'={self.client_index},{len(topic)}', payload=topic)  # Send topic
         self._send_at_command('CMQTTPAYLOAD', f'={self.client_index},{len(msg)}', payload=msg)  # Send payload
-        self._send_at_command('CMQTTPUB', f'={self.client_index},{qos},{pub_timeout},{int(retain)}', result_handler=lambda s: int(s.split(b',')[1]))  # Publish the message
+        return self._send_at_command('CMQTTPUB', f'={self.client_index},{qos},{pub_timeout},{int(retain)}', result_handler=lambda s: int(s.split(',')[1]),
+                                     timeout=pub_timeout + self.command_timeout)  # Publish the message
 
     def subscribe(self, topic, qos=0):
         """
@@ -332,7 +518,11 @@ class MQTTClient:
         assert self.cb != None
         assert 0 <= qos <= 2
         assert 0 < len(topic) <= 1024
-        self._send_at_command('CMQTTSUB', f'={self.client_index},{len(topic)},{qos}', payload=topic, result_handler=lambda s: int(s.split(b',')[1]))  # Subscribe to the topic
+        self.subscriptions[topic] = qos
+        return self._subscribe(topic, qos)
+
+    def _subscribe(self, topic, qos):
+        return self._send_at_command('CMQTTSUB', f'={self.client_index},{len(topic)},{qos}', payload=topic, result_handler=lambda s: int(s.split(',')[1]))  # Subscribe to the topic
 
     def unsubscribe(self, topic):
         """
@@ -342,55 +532,79 @@ class MQTTClient:
             topic (bytes): The topic to subscribe to. (0 < len(topic) <= 1024)
         """
         assert 0 < len(topic) <= 1024
-        self._send_at_command('CMQTTUNSUB', f'={self.client_index},{len(topic)},1', payload=topic, result_handler=lambda s: int(s.split(b',')[1]))  # Subscribe to the topic
+        self.subscriptions.pop(topic, None)
+        self._send_at_command('CMQTTUNSUB', f'={self.client_index},{len(topic)},1', payload=topic, result_handler=lambda s: int(s.split(',')[1]))  # Subscribe to the topic
 
     def wait_msg(self):
         """
         Wait for a message to be received.
         """
-        msg = self.modem.readline()
-        self.handle_unsolicited_response(msg)
+        self._supervise()
+        while not self.at.poll(None):
+            pass
 
     def check_msg(self):
         """
-        Check for a message to be received.
+        Check for a message to be received, and try to reconnect if the connection has been lost.
+        Publishes the metrics summary when it's due.
         """
-        if self.modem.in_waiting > 0:
-            msg = self.modem.readline()
-            self.handle_unsolicited_response(msg)
+        self._supervise()
+        self.at.poll()
+        if self.metrics is not None and self.metrics_topic and self.connected and time.monotonic() >= self.next_metrics:
+            self.publish_metrics()
 
 def upload_cert(client, filename):
-    with open(filename, 'rb') as f:
-        data = f.read()
-        client._send_at_command('CCERTDOWN', f'="{filename}",{len(data)}', payload=data)
+    """
+    Upload a certificate to the modem, unless it already holds this version
+    of it (see modem_certs), and delete any older versions.
 
+    Args:
+        client (MQTTClient): A client connected to the modem.
+        filename (str): The certificate file.
 
-# Received messages from subscriptions will be delivered to this callback
-def sub_cb(topic, msg):
-    list = topic.decode().split('/')
-    if list[0] == 'BWtest':
-        if list[1] == 'topic':
-            print(f'sub_cb({list}, {msg})')
-    else:
-        print(f'sub_cb({topic}, {msg})')
+    Returns:
+        str: The name it's stored under on the modem, for ssl_params['ca_cert'].
+    """
+    data, name = modem_certs.read_cert(filename)
+    stored = client._send_at_command('CCERTLIST', result_handler=modem_certs.parse_list, query=True)
+    if stored == -1:
+        stored = set()
+    if name not in stored:
+        if client._send_at_command('CCERTDOWN', f'="{name}",{len(data)}', payload=data) != 0:
+            raise OSError(f"Could not upload {filename} to the modem")
+        for old in modem_certs.stale(stored, name):
+            client._send_at_command('CCERTDELE', f'="{old}"')
+    return name
+
+
+# Received messages from subscriptions will be delivered to this callback,
+# which passes them to the handler for their topic
+topics = mqtt_topics.Dispatcher(default=lambda topic, msg: print(f'sub_cb({topic}, {msg})'))
+topics.add('BWtest/topic/#', lambda topic, msg: print(f'sub_cb({list(topics.levels(topic))}, {msg})'))
+topics.add('BWtest/#', lambda topic, msg: None) # our other topics are ignored
+sub_cb = topics.dispatch
 
 
 def download():
     # Start MQTT session
-    ssl_params = {'ca_cert': 'isrgrootx1.pem', 'ssl_version': 3, 'auth_mode': 1, 'ignore_local_time': True, 'enable_SNI': True}
+    ssl_params = {'ca_cert': modem_certs.cert_name('isrgrootx1.pem'), 'ssl_version': 3, 'auth_mode': 1, 'ignore_local_time': True, 'enable_SNI': True}
     client = MQTTClient("BWtestClient0", "8d5ec6984ed54a29ac7794546055635d.s1.eu.hivemq.cloud", port = 8883, user = "oisl_brian", password = "Oisl2023", ssl=True, ssl_params=ssl_params)
     client.connect() # default APN is "iot.1nce.net"
-    upload_cert(client, 'isrgrootx1.pem')
+    print(f"Certificate stored as {upload_cert(client, 'isrgrootx1.pem')}")
     client.disconnect()
 
 def test():
     topic1 = b"BWtest/topic"
     topic2 = b"BWtest/timestamp"
+    topic3 = b"BWtest/telemetry"
     payload1 = b"Raspberry Pi Python, MQTT from SIMCom A7683E!"
+    telemetry = telemetry_codec.Batch(telemetry_codec.BIRDBOX)
     
     # Start MQTT session
-    ssl_params = {'ca_cert': 'isrgrootx1.pem', 'ssl_version': 3, 'auth_mode': 1, 'ignore_local_time': True, 'enable_SNI': True}
-    client = MQTTClient("BWtestClient0", "8d5ec6984ed54a29ac7794546055635d.s1.eu.hivemq.cloud", port = 8883, user = "oisl_brian", password = "Oisl2023", ssl=True, ssl_params=ssl_params)
+    ssl_params = {'ca_cert': modem_certs.cert_name('isrgrootx1.pem'), 'ssl_version': 3, 'auth_mode': 1, 'ignore_local_time': True, 'enable_SNI': True}
+    client = MQTTClient("BWtestClient0", "8d5ec6984ed54a29ac7794546055635d.s1.eu.hivemq.cloud", port = 8883, user = "oisl_brian", password = "Oisl2023", ssl=True, ssl_params=ssl_params, verbose=True,
+                        spool=Spool('BWtest.spool'), metrics=modem_metrics.Metrics())
+    client.metrics_topic = b"BWtest/metrics"
 
     client.set_last_will(b"BWtest/lastwill", b"Pi Python connection broken", qos=1)
 
@@ -412,6 +626,10 @@ def test():
 
             # Publish and be damned
             client.publish(topic2, payload2.encode(encoding="utf-8"), retain=True, qos=1)
+
+            # Telemetry is batched, and sent compactly encoded
+            telemetry.add(time=now, battery_level=60, status='up', stay_up=False, force_up=False)
+            client.publish(topic3, telemetry.flush(), qos=1)
             break
             start_time = time.time()
             wait_interval = 15*60  # 15 minutes
@@ -1,39 +1,56 @@
 import paho.mqtt.client as mqtt
 import time
+import telemetry_codec
+import mqtt_compress
+import mqtt_topics
 
 client_name = "pi400"
 #broker_name = "192.168.3.1" # is the Mosquitto server only accessible over WireGuard?
 #broker_name = "192.168.58.23" # is the Mosquitto server only accessible over WireGuard?
 broker_name = "Pi2B" # is the Mosquitto server only accessible over WireGuard?(no)
 
-def on_message(client, userdata, message):
+def show(topic, message):
+    try:
+        payload = mqtt_compress.decompress(message.payload) # in case it was compressed
+    except ValueError as e:
+        print(topic, "dropped:", e) # it would decompress to too much
+        return
     if message.retain:
-        print(message.topic, "=", str(message.payload.decode("utf-8")), "(retained)")
+        print(topic, "=", str(payload.decode("utf-8")), "(retained)")
     else:
-        print(message.topic, "=", str(message.payload.decode("utf-8")), "(live)")
+        print(topic, "=", str(payload.decode("utf-8")), "(live)")
     #print("message qos =", message.qos, "retain flag =", message.retain)
 
+def show_telemetry(topic, message):
+    try:
+        payload = mqtt_compress.decompress(message.payload)
+    except ValueError as e:
+        print(topic, "dropped:", e)
+        return
+    if telemetry_codec.is_telemetry(payload):
+        # Compact binary batch of samples
+        for sample in telemetry_codec.decode(payload):
+            print(topic, "=", sample)
+    else:
+        show(topic, message)
+
+# Messages are passed to the handler for their topic
+topics = mqtt_topics.Dispatcher(default=show)
+topics.add("birdboxes/+/telemetry", show_telemetry)
+
 def on_log(client, userdata, level, buf):
     #print("log: ",buf)
     return
 
 client = mqtt.Client(client_name)
-client.on_message=on_message
+client.on_message=topics.on_message
 client.on_log=on_log
 client.connect(broker_name)
 
 #client.loop_start() # start the loop in a thread
-client.subscribe("birdboxes/birdbox1/initial_status")
-client.subscribe("birdboxes/birdbox1/initial_battery_level")
-client.subscribe("birdboxes/birdbox1/initial_stay_up")
-client.subscribe("birdboxes/birdbox1/startup_time")
-client.subscribe("birdboxes/birdbox1/shutdown_time")
-client.subscribe("birdboxes/birdbox1/wake_time")
-client.subscribe("birdboxes/birdbox1/force_up")
-
-client.subscribe("birdboxes/birdbox1/status")
-client.subscribe("birdboxes/birdbox1/stay_up")
-client.subscribe("birdboxes/birdbox1/battery_level")
+# initial_status, initial_battery_level, initial_stay_up, startup_time, shutdown_time,
+# wake_time, force_up, status, stay_up, battery_level and telemetry, in one subscription
+client.subscribe("birdboxes/birdbox1/#")
 #time.sleep(4000) # wait
 #client.loop_stop() #stop the loop
 client.loop_forever()
@@ -1,7 +1,7 @@
 
 ﻿
 import serial
-import time
+import simcom_at
 
 class SimComMQTT:
     def __init__(self, port, baudrate=115200, timeout=1):
@@ -9,20 +9,21 @@ class SimComMQTT:
         self.baudrate = baudrate
         self.timeout = timeout
         self.serial = serial.Serial(port, baudrate, timeout=timeout)
+        self.at = simcom_at.SerialAT(self.serial, lambda line, data: None)
         self.mqtt_configured = False
 
-    def send_command(self, command, expected_response="OK", timeout=5):
-        """Send an AT command to the modem and wait for the expected response."""
-        self.serial.write((command + "\r\n").encode())
-        start_time = time.time()
-        response = ""
-
-        while time.time() - start_time < timeout:
-            if self.serial.in_waiting:
-                response += self.serial.read(self.serial.in_waiting).decode()
-                if expected_response in response:
-                    return response.strip()
-        raise TimeoutError(f"Command '{command}' timed out. Response: {response}")
+    def send_command(self, command, expected_response="OK", timeout=5, payload=None):
+        """Send an AT command to the modem and wait for the expected response, sending any payload at the '>' prompt."""
+        if isinstance(payload, str):
+            payload = payload.encode()
+        cmd = simcom_at.ATCommand(command, payload=payload, expected=expected_response)
+        try:
+            self.at.command(cmd, timeout)
+        except TimeoutError:
+            raise TimeoutError(f"Command '{command}' timed out. Response: {cmd.text()}")
+        if not cmd.ok:
+            raise RuntimeError(f"Command '{command}' failed. Response: {cmd.text()}")
+        return cmd.text().strip()
 
     def configure_mqtt(self, client_id, username, password, broker, port, keep_alive=60):
         """Configure the MQTT connection."""
@@ -37,18 +38,15 @@ class SimComMQTT:
         if not self.mqtt_configured:
             raise RuntimeError("MQTT not configured. Call configure_mqtt() first.")
         retain_flag = 1 if retain else 0
-        self.send_command(f"AT+CMQTTTOPIC=0,{len(topic)}")
-        self.send_command(topic, expected_response=">")
-        self.send_command(f"AT+CMQTTPAYLOAD=0,{len(payload)}")
-        self.send_command(payload, expected_response=">")
+        self.send_command(f"AT+CMQTTTOPIC=0,{len(topic)}", payload=topic)
+        self.send_command(f"AT+CMQTTPAYLOAD=0,{len(payload)}", payload=payload)
         self.send_command(f"AT+CMQTTPUB=0,{qos},{retain_flag}")
 
     def subscribe(self, topic, qos=0):
         """Subscribe to a topic."""
         if not self.mqtt_configured:
             raise RuntimeError("MQTT not configured. Call configure_mqtt() first.")
-        self.send_command(f"AT+CMQTTSUBTOPIC=0,{len(topic)},{qos}")
-        self.send_command(topic, expected_response=">")
+        self.send_command(f"AT+CMQTTSUBTOPIC=0,{len(topic)},{qos}", payload=topic)
         self.send_command("AT+CMQTTSUB=0")
 
     def receive_message(self):
@@ -1,21 +1,73 @@
-import serial
+import asyncio
+import io
 import time
+import serial
+import simcom_at
+
+def _fields(line):
+    "The integer fields of a result line such as '+IPCLOSE: 1,2' or '+RECEIVE,1,5'"
+    fields = line.split(':', 1)[1] if ':' in line else line.split(',', 1)[1]
+    return [int(f) for f in fields.split(',') if f.strip().lstrip('-').isdigit()]
 
 class SimCOMSocket:
-    def __init__(self, port, baudrate=115200, timeout=1):
+    MAX_LINKS = 10 # the A76xx has link IDs 0-9
+
+    def __init__(self, port, baudrate=115200, timeout=1, metrics=None):
         self.ser = serial.Serial(port, baudrate, timeout=timeout)
+        self.at = simcom_at.SerialAT(self.ser, self.handle_unsolicited, metrics=metrics)
         self.connected = False
+        self.net_open = False
+        self.links = {} # link ID -> SimCOMSocketInstance
+
+    def command(self, command, expected_response="OK", timeout=5, payload=None, result_prefix=None):
+        """
+        Send an AT command, returning the simcom_at.ATCommand once a line containing
+        expected_response has arrived, or if expected_response is None, once the
+        command's +COMMAND: result (or the line starting with result_prefix) has,
+        which may come after its OK. payload, if given, is sent at the '>' prompt.
+        """
+        if expected_response is None:
+            cmd = simcom_at.ATCommand(command, payload=payload, expect_result=True, result_prefix=result_prefix)
+        else:
+            cmd = simcom_at.ATCommand(command, payload=payload, expected=expected_response)
+        try:
+            self.at.command(cmd, timeout)
+        except TimeoutError:
+            raise TimeoutError(f"Timeout waiting for response to command: {command}")
+        if not cmd.ok:
+            raise Exception(f"Error response to command: {command}: {cmd.text()}")
+        return cmd
+
+    def send_at_command(self, command, expected_response="OK", timeout=5, payload=None):
+        return self.command(command, expected_response, timeout, payload).text()
+
+    def handle_unsolicited(self, line, data):
+        "Pass socket notifications on to the socket with that link ID"
+        if line.startswith('+CIPEVENT:') or line.startswith('+NETCLOSE:'):
+            # The network has gone, and every socket with it
+            self.net_open = False
+            for sock in list(self.links.values()):
+                sock._closed()
+            return
+        for prefix in ('+CIPRXGET: 1,', '+RECEIVE,', '+IPCLOSE:'):
+            if line.startswith(prefix):
+                break
+        else:
+            return
+        fields = _fields(line)
+        sock = self.links.get(fields[1] if prefix == '+CIPRXGET: 1,' else fields[0])
+        if sock is None:
+            return
+        if prefix == '+CIPRXGET: 1,':
+            sock.readable = True # the modem has data buffered for it
+        elif prefix == '+RECEIVE,':
+            sock.rx += data
+        else:
+            sock._closed()
 
-    def send_at_command(self, command, expected_response="OK", timeout=5):
-        self.ser.write((command + "\r\n").encode())
-        end_time = time.time() + timeout
-        response = ""
-        while time.time() < end_time:
-            if self.ser.in_waiting > 0:
-                response += self.ser.read(self.ser.in_waiting).decode()
-                if expected_response in response:
-                    return response
-        raise Exception(f"Timeout waiting for response to command: {command}")
+    def poll(self, timeout=0):
+        "Handle any socket notifications that arrive within timeout seconds"
+        return self.at.poll(timeout)
 
     def connect(self, apn):
         self.send_at_command("AT+CSQ")
@@ -25,39 +77,372 @@ class SimCOMSocket:
         self.send_at_command("AT+CGACT=1,1")
         self.connected = True
 
+    def netopen(self):
+        "Open the network for sockets, unless it already is; it's shared by all of them"
+        if self.net_open:
+            return
+        self.send_at_command('AT+CIPRXGET=1') # buffer received data in the modem until we ask for it
+        self.send_at_command('AT+NETOPEN', '+NETOPEN: 0', timeout=30)
+        self.net_open = True
+
+    def netclose(self):
+        "Close every socket, and the network"
+        for sock in list(self.links.values()):
+            sock.close()
+        if self.net_open:
+            self.send_at_command('AT+NETCLOSE', '+NETCLOSE: 0')
+            self.net_open = False
+
+    def _allocate(self, sock):
+        "Assign a free link ID to a socket"
+        for link in range(self.MAX_LINKS):
+            if link not in self.links:
+                self.links[link] = sock
+                return link
+        raise OSError(f"All {self.MAX_LINKS} modem sockets are in use")
+
+    def _release(self, sock):
+        if self.links.get(sock.link) is sock:
+            del self.links[sock.link]
+
     def socket(self, socket_type, use_tls=False):
         if not self.connected:
             raise Exception("Modem not connected")
-        return SimCOMSocketInstance(self.ser, socket_type, use_tls)
+        return SimCOMSocketInstance(self, socket_type, use_tls)
 
 class SimCOMSocketInstance:
-    def __init__(self, ser, socket_type, use_tls):
-        self.ser = ser
+    def __init__(self, modem, socket_type, use_tls):
+        self.modem = modem
         self.socket_type = socket_type
         self.use_tls = use_tls
-        self.cid = None
+        self.link = None       # the modem's link ID, while connected
+        self.rx = bytearray()  # received data, reused from read to read
+        self.rx_pos = 0        # start of the data in self.rx not yet returned
+        self.readable = False  # the modem has told us it has data for this socket
+        self.peer_closed = False
+        self.timeout = None    # seconds recv() waits for data, None to wait indefinitely
+        self.prefetch = 16384  # keep fetching while the modem has more, up to this much
+
+    def send_at_command(self, command, expected_response="OK", timeout=5, payload=None):
+        return self.modem.send_at_command(command, expected_response, timeout, payload)
 
     def connect(self, host, port):
-        self.cid = self.send_at_command('AT+NETOPEN', '+NETOPEN: 0')
+        self.modem.netopen()
+        self.link = self.modem._allocate(self)
         protocol = "TCP" if self.socket_type == "TCP" else "UDP"
-        if self.use_tls:
-            self.send_at_command('AT+CIPSSL=1', 'OK')
-        self.send_at_command(f'AT+CIPOPEN=0,"{protocol}","{host}",{port}', 'OK')
+        try:
+            if self.use_tls:
+                self.send_at_command('AT+CIPSSL=1', 'OK')
+            # The result, +CIPOPEN: <link>,<error>, comes after the OK
+            cmd = self.modem.command(f'AT+CIPOPEN={self.link},"{protocol}","{host}",{port}', None, timeout=30)
+            error = _fields(cmd.results[-1])[1]
+            if error:
+                raise OSError(f"Could not connect to {host}:{port}, error {error}")
+        except BaseException:
+            self.modem._release(self)
+            self.link = None
+            raise
 
     def send(self, data):
-        self.send_at_command(f'AT+CIPSEND=0,{len(data)}', '>')
-        self.ser.write(data)
-        self.send_at_command("", 'SEND OK')
+        self.modem.command(f'AT+CIPSEND={self.link},{len(data)}', None, payload=data)
+
+    MAX_READ = 1500 # the most AT+CIPRXGET will return at once
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def _buffered(self):
+        return len(self.rx) - self.rx_pos
+
+    def _fetch(self):
+        """
+        Read the data the modem is holding for us into self.rx, a block at a
+        time, until it has no more or we have prefetch bytes buffered.
+        """
+        if self.rx_pos and (self.rx_pos == len(self.rx) or self.rx_pos > self.prefetch):
+            # Drop what's been consumed, keeping the buffer's allocation
+            del self.rx[:self.rx_pos]
+            self.rx_pos = 0
+        while self.readable and self._buffered() < self.prefetch:
+            # The result, +CIPRXGET: 2,<link>,<read length>,<length remaining>, is
+            # followed by exactly <read length> bytes, which the AT engine attaches to it.
+            # Other links' +CIPRXGET: 1,<link> notifications are left to handle_unsolicited
+            cmd = self.modem.command(f'AT+CIPRXGET=2,{self.link},{self.MAX_READ}', None,
+                                     result_prefix=f'+CIPRXGET: 2,{self.link},')
+            for data in cmd.data:
+                self.rx += data
+            remaining = _fields(cmd.results[-1])[3] if cmd.results else 0
+            self.readable = remaining > 0
+
+    def _wait(self):
+        "Wait until there is data to read, or the connection has closed"
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while not self._buffered():
+            if self.readable:
+                self._fetch()
+                continue
+            if self.peer_closed or self.link is None:
+                return
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise TimeoutError("Timed out waiting for data")
+            self.modem.poll(remaining)
+
+    def recv_into(self, buffer, nbytes=0):
+        """
+        Receive up to nbytes (or len(buffer)) bytes into buffer, waiting for
+        at least one unless the connection has closed.
+
+        Returns:
+            int: The number of bytes received, 0 at the end of the stream.
+        """
+        view = memoryview(buffer).cast('B')
+        nbytes = nbytes or len(view)
+        self._wait()
+        n = min(nbytes, self._buffered())
+        view[:n] = self.rx[self.rx_pos:self.rx_pos + n]
+        self.rx_pos += n
+        if self.readable and self._buffered() < self.prefetch // 2:
+            self._fetch() # top up while the caller deals with this lot
+        return n
 
     def recv(self, bufsize):
-        response = self.send_at_command(f'AT+CIPRXGET=2,0,{bufsize}', '+CIPRXGET: 2')
-        start = response.find('\r\n') + 2
-        end = response.rfind('\r\n')
-        return response[start:end].encode()
+        data = bytearray(bufsize)
+        n = self.recv_into(data)
+        del data[n:]
+        return bytes(data)
+
+    def makefile(self, mode='rb', buffering=None):
+        "A buffered binary file reading from the socket, as socket.socket.makefile() (reading only)"
+        assert mode in ('r', 'rb'), "only reading is supported"
+        return io.BufferedReader(_SocketReader(self), buffering or io.DEFAULT_BUFFER_SIZE)
+
+    def _closed(self):
+        "The connection has been closed by the peer or the network"
+        self.peer_closed = True
+        self.modem._release(self)
+
+    def close(self):
+        if self.link is None:
+            return
+        if not self.peer_closed:
+            self.modem.command(f'AT+CIPCLOSE={self.link}', None)
+        self.modem._release(self)
+        self.link = None
+
+class _SocketReader(io.RawIOBase):
+    def __init__(self, sock):
+        self.sock = sock
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self.sock.recv_into(b)
+
+class AsyncSimCOMSocket:
+    """
+    asyncio access to the modem's sockets, with open_connection() returning
+    a (StreamReader, StreamWriter-like) pair as asyncio.open_connection() does.
+    It runs over a simcom_at.AsyncAT, which can be shared with an
+    AsyncMQTTClient (pass it client.at) so that sockets and MQTT traffic use
+    the modem at the same time.
+    """
+    MAX_LINKS = 10  # the A76xx has link IDs 0-9
+    MAX_READ = 1500 # the most AT+CIPRXGET will return at once
+    MAX_SEND = 1460 # the most to send with one AT+CIPSEND
+
+    def __init__(self, at):
+        """
+        Args:
+            at (simcom_at.AsyncAT): The running AT engine adapter. Unsolicited lines that
+                aren't about sockets are passed on to its existing handler.
+        """
+        self.at = at
+        self.forward = at.on_unsolicited
+        at.on_unsolicited = self.handle_unsolicited
+        self.links = {} # link ID -> _ModemStream
+        self.net_open = False
+        self.net_lock = asyncio.Lock()
+
+    @classmethod
+    async def open(cls, port='/dev/ttyUSB0', baudrate=115200, metrics=None):
+        "Open the modem's serial port for sockets alone"
+        import serial_asyncio
+        reader, writer = await serial_asyncio.open_serial_connection(url=port, baudrate=baudrate)
+        at = simcom_at.AsyncAT(reader, writer, lambda line, data: None, metrics=metrics)
+        at.start()
+        return cls(at)
+
+    async def command(self, command, timeout=30, payload=None, expect_result=True, result_prefix=None):
+        "Send a command, by default waiting for its +COMMAND: result (or the line starting with result_prefix)"
+        cmd = await self.at.command(simcom_at.ATCommand(command, payload=payload, expect_result=expect_result,
+                                                        result_prefix=result_prefix), timeout=timeout)
+        if not cmd.ok:
+            raise OSError(f"Error response to command: {command}")
+        return cmd
+
+    def handle_unsolicited(self, line, data):
+        if line.startswith('+CIPEVENT:') or line.startswith('+NETCLOSE:'):
+            self.net_open = False
+            for stream in list(self.links.values()):
+                stream._closed()
+        elif line.startswith('+CIPRXGET: 1,') or line.startswith('+RECEIVE,') or line.startswith('+IPCLOSE:'):
+            fields = _fields(line)
+            stream = self.links.get(fields[1] if line.startswith('+CIPRXGET') else fields[0])
+            if stream is None:
+                pass
+            elif line.startswith('+CIPRXGET'):
+                stream.readable = True
+                if stream.fetcher is None:
+                    stream.fetcher = asyncio.ensure_future(self._fetch(stream))
+            elif line.startswith('+RECEIVE,'):
+                stream.reader.feed_data(data)
+            else:
+                stream._closed()
+        else:
+            self.forward(line, data)
+
+    async def _fetch(self, stream):
+        "Read everything the modem is holding for a stream into its reader"
+        try:
+            while stream.readable and not stream.closed:
+                stream.readable = False
+                # The data follows the +CIPRXGET: 2,<link>,<read length>,<length remaining> result.
+                # Other links' notifications arriving meanwhile go to handle_unsolicited
+                cmd = await self.command(f'AT+CIPRXGET=2,{stream.link},{self.MAX_READ}',
+                                         result_prefix=f'+CIPRXGET: 2,{stream.link},')
+                for data in cmd.data:
+                    stream.reader.feed_data(data)
+                if cmd.results and _fields(cmd.results[-1])[3] > 0:
+                    stream.readable = True
+        except Exception as e:
+            stream.reader.set_exception(e)
+        finally:
+            stream.fetcher = None
+            if stream.closed:
+                stream.reader.feed_eof() # held back until the data already fetched was fed
+
+    async def netopen(self):
+        "Open the network for sockets, unless it already is; it's shared by all of them"
+        async with self.net_lock:
+            if not self.net_open:
+                await self.command('AT+CIPRXGET=1', expect_result=False) # the modem holds data until we ask
+                cmd = await self.command('AT+NETOPEN')
+                if _fields(cmd.results[-1])[0]:
+                    raise OSError(f"Could not open the network: {cmd.results[-1]}")
+                self.net_open = True
+
+    async def netclose(self):
+        for stream in list(self.links.values()):
+            await stream.close()
+        if self.net_open:
+            await self.command('AT+NETCLOSE')
+            self.net_open = False
+
+    async def open_connection(self, host, port, tls=False, limit=2**16):
+        """
+        Open a TCP connection, as asyncio.open_connection().
+
+        Returns:
+            tuple: (asyncio.StreamReader, a StreamWriter-like object)
+        """
+        await self.netopen()
+        link = next((link for link in range(self.MAX_LINKS) if link not in self.links), None)
+        if link is None:
+            raise OSError(f"All {self.MAX_LINKS} modem sockets are in use")
+        stream = _ModemStream(self, link, (host, port), limit)
+        self.links[link] = stream
+        try:
+            if tls:
+                await self.command('AT+CIPSSL=1', expect_result=False)
+            # The result, +CIPOPEN: <link>,<error>, comes after the OK
+            cmd = await self.command(f'AT+CIPOPEN={link},"TCP","{host}",{port}', timeout=60)
+            error = _fields(cmd.results[-1])[1]
+            if error:
+                raise OSError(f"Could not connect to {host}:{port}, error {error}")
+        except BaseException:
+            self.links.pop(link, None)
+            raise
+        return stream.reader, stream
+
+class _ModemStream:
+    "One connection: its StreamReader, and the StreamWriter-like methods"
+
+    def __init__(self, modem, link, peer, limit):
+        self.modem = modem
+        self.link = link
+        self.peer = peer
+        self.reader = asyncio.StreamReader(limit=limit)
+        self.readable = False # the modem has told us it has data for this link
+        self.fetcher = None   # task reading it from the modem
+        self.closed = False
+        self.buffer = bytearray() # written but not yet sent
+        self.sender = None    # task sending it
+        self.error = None     # why sending failed, if it did
+        self.closer = None
+
+    def _closed(self):
+        "The connection has been closed by the peer or the network"
+        if not self.closed:
+            self.closed = True
+            if self.fetcher is None:
+                self.reader.feed_eof()
+        if self.modem.links.get(self.link) is self:
+            del self.modem.links[self.link]
+
+    def write(self, data):
+        if self.closer is not None or self.closed:
+            raise ConnectionResetError("Connection closed")
+        self.buffer += data
+        if self.sender is None:
+            self.sender = asyncio.ensure_future(self._send())
+
+    def writelines(self, data):
+        for line in data:
+            self.write(line)
+
+    async def _send(self):
+        try:
+            while self.buffer and not self.closed:
+                chunk = bytes(self.buffer[:self.modem.MAX_SEND])
+                del self.buffer[:len(chunk)]
+                await self.modem.command(f'AT+CIPSEND={self.link},{len(chunk)}', payload=chunk)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.sender = None
+
+    async def drain(self):
+        if self.sender is not None:
+            await asyncio.shield(self.sender)
+        if self.error is not None:
+            raise self.error
+
+    def can_write_eof(self):
+        return False
+
+    def get_extra_info(self, name, default=None):
+        return self.peer if name == 'peername' else default
+
+    def is_closing(self):
+        return self.closer is not None or self.closed
 
     def close(self):
-        self.send_at_command('AT+CIPCLOSE=0', 'OK')
-        self.send_at_command('AT+NETCLOSE', '+NETCLOSE: 0')
+        if self.closer is None:
+            self.closer = asyncio.ensure_future(self._close())
+        return self.closer
+
+    async def _close(self):
+        try:
+            await self.drain()
+            if not self.closed:
+                await self.modem.command(f'AT+CIPCLOSE={self.link}')
+        finally:
+            self._closed()
+
+    async def wait_closed(self):
+        await self.close()
 
 # Example usage
 if __name__ == "__main__":
@@ -71,6 +456,15 @@ if __name__ == "__main__":
     tcp_response = tcp_sock.recv(1024)
     print("TCP Response:", tcp_response)
     tcp_sock.close()
+
+    # Streaming a large download through a file object
+    tcp_sock = modem.socket(socket_type="TCP")
+    tcp_sock.connect('example.com', 80)
+    tcp_sock.send(b'GET / HTTP/1.1\r\nHost: example.com\r\nConnection: close\r\n\r\n')
+    f = tcp_sock.makefile('rb')
+    print("Status:", f.readline())
+    print("Downloaded", len(f.read()), "bytes")
+    tcp_sock.close()
     
     # UDP Example
     udp_sock = modem.socket(socket_type="UDP")
@@ -86,4 +480,26 @@ if __name__ == "__main__":
     tls_sock.send(b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
     tls_response = tls_sock.recv(1024)
     print("TLS Response:", tls_response)
-    tls_sock.close()
\ No newline at end of file
+    tls_sock.close()
+
+    # Several sockets at once, sharing the network
+    socks = [modem.socket(socket_type="TCP") for i in range(3)]
+    for sock in socks:
+        sock.connect('example.com', 80)
+    for sock in socks:
+        sock.send(b'HEAD / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+    for sock in socks:
+        print(sock.link, sock.recv(1024))
+    modem.netclose()
+
+    # asyncio streams
+    async def fetch():
+        modem = await AsyncSimCOMSocket.open(port='/dev/ttyUSB0')
+        reader, writer = await modem.open_connection('example.com', 80)
+        writer.write(b'GET / HTTP/1.1\r\nHost: example.com\r\nConnection: close\r\n\r\n')
+        await writer.drain()
+        print("Async response:", len(await reader.read()), "bytes")
+        writer.close()
+        await writer.wait_closed()
+        await modem.netclose()
+    asyncio.run(fetch())
\ No newline at end of file
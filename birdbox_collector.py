@@ -0,0 +1,150 @@
+"""
+Collects what every birdbox publishes into a telemetry_store.Store, for
+querying later, in place of MQTT_test-2.py printing each message.
+
+    python3 birdbox_collector.py --broker Pi2B --store birdbox_data
+
+subscribes to birdboxes/# and stores:
+
+    birdboxes/<device>/telemetry   the samples of each telemetry_codec batch
+    birdboxes/<device>/<topic>     other values (e.g. status, battery_level), as
+                                   {'time': when received, 'value': ...}; retained
+                                   values are old news, so are skipped
+
+Samples are buffered and written in blocks every --flush seconds. To query:
+
+    python3 birdbox_collector.py --store birdbox_data --query --device birdbox1 --topic telemetry --start 2026-10-01 --end 2026-10-19T12:00
+"""
+import argparse
+import threading
+import time
+from datetime import datetime, timezone
+import paho.mqtt.client as mqtt
+import mqtt_compress
+import mqtt_topics
+import telemetry_codec
+from telemetry_store import Store
+
+
+def parse_value(text):
+    "A value published as text, as a bool, int, float or str"
+    if text in ('true', 'false'):
+        return text == 'true'
+    for kind in (int, float):
+        try:
+            return kind(text)
+        except ValueError:
+            pass
+    return text
+
+
+class Collector:
+    def __init__(self, store):
+        """
+        Args:
+            store (telemetry_store.Store): Where to put the samples.
+        """
+        self.store = store
+        self.lock = threading.Lock() # paho calls back from its own thread
+        self.messages = 0
+        self.samples = 0
+        self.topics = mqtt_topics.Dispatcher(default=lambda topic, message: None)
+        self.topics.add('birdboxes/+/telemetry', self.on_telemetry)
+        self.topics.add('birdboxes/+/+', self.on_value)
+
+    def _append(self, device, topic, samples):
+        with self.lock:
+            self.store.append(device, topic, samples)
+            self.messages += 1
+            self.samples += len(samples)
+
+    def _payload(self, topic, message):
+        "The message's payload decompressed, or None if it would be too large"
+        try:
+            return mqtt_compress.decompress(message.payload)
+        except ValueError as e:
+            print(f"{topic}: {e}")
+            return None
+
+    def on_telemetry(self, topic, message):
+        payload = self._payload(topic, message)
+        if payload is None:
+            return
+        if not telemetry_codec.is_telemetry(payload):
+            self._value(topic, message, payload) # e.g. text from older firmware
+            return
+        try:
+            samples = telemetry_codec.decode(payload)
+        except (ValueError, IndexError) as e:
+            print(f"{topic}: can't decode telemetry: {e}")
+            return
+        self._append(self.topics.levels(topic)[1], 'telemetry', samples)
+
+    def on_value(self, topic, message):
+        if self.topics.levels(topic)[2] != 'telemetry': # which on_telemetry handles
+            payload = self._payload(topic, message)
+            if payload is not None:
+                self._value(topic, message, payload)
+
+    def _value(self, topic, message, payload):
+        if message.retain:
+            return
+        levels = self.topics.levels(topic)
+        value = parse_value(payload.decode(errors="replace"))
+        self._append(levels[1], levels[2], [{'time': int(time.time()), 'value': value}])
+
+    def flush(self):
+        with self.lock:
+            self.store.flush()
+
+    def run(self, broker, port=1883, client_name='birdbox_collector', flush_interval=60):
+        "Collect until interrupted, writing what's been received every flush_interval seconds"
+        client = mqtt.Client(client_name)
+        client.on_message = self.topics.on_message
+        # (Re)subscribe whenever connected, as the session may not have been kept
+        client.on_connect = lambda client, userdata, flags, rc: client.subscribe('birdboxes/#', qos=1)
+        client.connect(broker, port)
+        client.loop_start()
+        try:
+            while True:
+                time.sleep(flush_interval)
+                self.flush()
+                print(f"{datetime.now():%Y-%m-%d %H:%M:%S} {self.messages} messages, {self.samples} samples")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            client.loop_stop()
+            client.disconnect()
+            self.flush()
+
+
+def _timestamp(text):
+    "Seconds since the epoch of an ISO date or date and time (UTC unless it says otherwise)"
+    if text is None:
+        return None
+    t = datetime.fromisoformat(text)
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=timezone.utc)
+    return int(t.timestamp())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--broker', default='Pi2B')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--store', default='birdbox_data', help='directory of the store')
+    parser.add_argument('--flush', type=float, default=60, help='seconds between writes')
+    parser.add_argument('--query', action='store_true', help='print stored samples instead of collecting')
+    parser.add_argument('--device')
+    parser.add_argument('--topic')
+    parser.add_argument('--start', help='ISO date or date and time, UTC by default')
+    parser.add_argument('--end', help='ISO date or date and time, UTC by default')
+    args = parser.parse_args()
+
+    store = Store(args.store)
+    if args.query:
+        for device, topic, sample in store.query(args.device, args.topic, _timestamp(args.start), _timestamp(args.end)):
+            when = datetime.fromtimestamp(sample.pop('time'), timezone.utc)
+            print(f"{when:%Y-%m-%d %H:%M:%S} {device} {topic} {sample}")
+    else:
+        Collector(store).run(args.broker, args.port, flush_interval=args.flush)
@@ -1,3 +1,5 @@
+import numpy as np
+
 
 def convolve(X, H):
     "Convolve input signal X with impulse response H (or vice-versa)"
@@ -20,6 +22,170 @@ def find_correlation(X,T):
     m = max(correlation)
     return correlation.index(m), m
 
+# NumPy versions of the above, for long signals.
+# Direct convolution costs len(X)*len(H) multiply-adds, which is cheapest for
+# short impulse responses. Longer ones are convolved via the FFT, either in
+# one transform (signals of similar length) or block by block with the
+# overlap-add method (a long signal against a much shorter template).
+
+def _next_pow2(n):
+    return 1 << (n - 1).bit_length()
+
+def _fft_cost(n):
+    # Rough relative cost of a real FFT of size n, in multiply-adds
+    return 3 * n * n.bit_length()
+
+def fft_convolve(X, H):
+    "Convolve X with H using a single FFT of the full output length"
+    X = np.asarray(X, dtype=np.float64)
+    H = np.asarray(H, dtype=np.float64)
+    L = len(X) + len(H) - 1
+    nfft = _next_pow2(L)
+    return np.fft.irfft(np.fft.rfft(X, nfft) * np.fft.rfft(H, nfft), nfft)[:L]
+
+def overlap_add_convolve(X, H, nfft=None):
+    "Convolve long signal X with shorter impulse response H by overlap-add"
+    X = np.asarray(X, dtype=np.float64)
+    H = np.asarray(H, dtype=np.float64)
+    M = len(H)
+    if nfft is None:
+        nfft = _next_pow2(max(4 * M, 256))
+    assert nfft >= 2 * M - 2 # tails must not overlap more than one block
+    block = nfft - M + 1
+    blocks = -(-len(X) // block) # ceiling division
+    padded = np.zeros(blocks * block)
+    padded[:len(X)] = X
+    # Transform all the blocks at once, one per row
+    HF = np.fft.rfft(H, nfft)
+    YB = np.fft.irfft(np.fft.rfft(padded.reshape(blocks, block), nfft, axis=1) * HF, nfft, axis=1)
+    # Each row's first 'block' outputs are disjoint, and its M-1 sample tail
+    # overlaps the start of the next row's outputs.
+    Y = np.zeros((blocks + 1) * block)
+    Y[:blocks*block] = YB[:, :block].ravel()
+    tails = np.zeros((blocks, block))
+    tails[:, :M-1] = YB[:, block:]
+    Y[block:] += tails.ravel()
+    return Y[:len(X) + M - 1]
+
+def fast_convolve(X, H, method="auto"):
+    """
+    Convolve input signal X with impulse response H (or vice-versa).
+
+    Args:
+        X (array-like): Input signal.
+        H (array-like): Impulse response.
+        method (str): "direct", "fft", "overlap-add" or "auto" to choose the
+            cheapest by size.
+
+    Returns:
+        numpy.ndarray: The len(X) + len(H) - 1 output samples.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    H = np.asarray(H, dtype=np.float64)
+    if len(X) < len(H):
+        X, H = H, X # convolution is commutative, keep H the shorter
+    if method == "auto":
+        N, M = len(X), len(H)
+        nfft = _next_pow2(N + M - 1)
+        ola_nfft = _next_pow2(max(4 * M, 256))
+        ola_blocks = -(-N // (ola_nfft - M + 1))
+        costs = {
+            "direct": N * M,
+            "fft": 3 * _fft_cost(nfft),
+            "overlap-add": (2 * ola_blocks + 1) * _fft_cost(ola_nfft),
+        }
+        method = min(costs, key=costs.get)
+    if method == "direct":
+        return np.convolve(X, H)
+    elif method == "fft":
+        return fft_convolve(X, H)
+    elif method == "overlap-add":
+        return overlap_add_convolve(X, H)
+    raise ValueError(f"Unknown convolution method: {method}")
+
+def fast_correlate(X, T, method="auto"):
+    "Correlate input signal X with signal T (or vice-versa)"
+    return fast_convolve(X, np.asarray(T, dtype=np.float64)[::-1], method)
+
+def fast_find_correlation(X, T, method="auto"):
+    correlation = fast_correlate(X, T, method)
+    i = int(np.argmax(correlation))
+    return i, correlation[i]
+
+class StreamingFIR:
+    """
+    FIR filter over a stream of sample blocks, keeping its state between blocks.
+
+    Each call to process() returns exactly as many samples as it was given, and
+    the concatenated output equals the first len(X) samples of convolve(X, H)
+    for the concatenated input X.
+
+    In "direct" mode the last len(H)-1 input samples are carried over and each
+    block is filtered with np.convolve, so blocks may be of any length.
+    In "fft" mode H is split into block_size partitions that are applied in
+    the frequency domain to a delay line of past input block spectra (uniformly
+    partitioned overlap-save), so the cost per sample grows with log(block_size)
+    rather than len(H). Blocks must then be a multiple of block_size long.
+    """
+
+    def __init__(self, H, mode="direct", block_size=256):
+        """
+        Args:
+            H (array-like): Impulse response.
+            mode (str): "direct" or "fft".
+            block_size (int): Partition size for "fft" mode.
+        """
+        self.H = np.asarray(H, dtype=np.float64)
+        self.mode = mode
+        self.block_size = block_size
+        if mode == "direct":
+            pass
+        elif mode == "fft":
+            B = block_size
+            P = -(-len(self.H) // B) # number of partitions
+            partitions = np.zeros((P, B))
+            partitions.ravel()[:len(self.H)] = self.H
+            self.HF = np.fft.rfft(partitions, 2 * B, axis=1)
+        else:
+            raise ValueError(f"Unknown filter mode: {mode}")
+        self.reset()
+
+    def reset(self):
+        "Clear the filter state, as if all previous input had been zero"
+        if self.mode == "direct":
+            self.state = np.zeros(len(self.H) - 1)
+        else:
+            self.state = np.zeros(self.block_size)        # previous input block
+            self.fdl = np.zeros_like(self.HF)             # frequency-domain delay line
+            self.pos = 0                                  # newest slot in the delay line
+
+    def process(self, X):
+        "Filter the next block of samples and return the same number of output samples"
+        X = np.asarray(X, dtype=np.float64)
+        if not len(X):
+            return X[:0] # np.convolve would swap its arguments for a buffer shorter than H
+        if self.mode == "direct":
+            M = len(self.H)
+            if M == 1:
+                return X * self.H[0]
+            buffer = np.concatenate((self.state, X))
+            self.state = buffer[len(buffer) - (M - 1):]
+            return np.convolve(buffer, self.H, "valid")
+        B = self.block_size
+        assert len(X) % B == 0, "blocks must be a multiple of block_size in fft mode"
+        P = len(self.HF)
+        Y = np.empty(len(X))
+        slots = np.arange(P)
+        for i in range(0, len(X), B):
+            block = X[i:i + B]
+            self.pos = (self.pos + 1) % P
+            self.fdl[self.pos] = np.fft.rfft(np.concatenate((self.state, block)))
+            self.state = block
+            # Partition p applies to the input spectrum from p blocks ago
+            YF = np.einsum("pk,pk->k", self.fdl, self.HF[(self.pos - slots) % P])
+            Y[i:i + B] = np.fft.irfft(YF, 2 * B)[B:]
+        return Y
+
 H1 = [1.0,-0.5,-0.25,-0.125]
 X1 = [0.0, -1.0, -1.25, 2.0, 1.33, 1.33, 0.66, 0.0, -0.66]
 D1 = [1.0]
@@ -39,3 +205,23 @@ print(correlate(X1, H1))
 print(correlate(X1, X1))
 print(correlate(H1, H1))
 
+for method in ("direct", "fft", "overlap-add", "auto"):
+    assert np.allclose(fast_convolve(X1, H1, method), Y1)
+    assert np.allclose(fast_correlate(X1, H1, method), correlate(X1, H1))
+    assert np.allclose(fast_correlate(H1, X1, method), correlate(H1, X1))
+assert fast_find_correlation(X1, H1) == find_correlation(X1, H1)
+# Long captures go through overlap-add in multiple blocks
+X3 = np.sin(np.arange(5000) * 0.1)
+H3 = np.cos(np.arange(40) * 0.3)
+assert np.allclose(overlap_add_convolve(X3, H3, nfft=128), np.convolve(X3, H3))
+
+# Streaming filters should match a one-shot convolution, whatever the blocking
+for fir, sizes in ((StreamingFIR(H3), (1, 7, 0, 100, 300)),
+                   (StreamingFIR(H3, "fft", block_size=16), (16, 0, 64, 32))):
+    out = []
+    start = 0
+    for n in sizes * 10:
+        out.append(fir.process(X3[start:start + n]))
+        assert len(out[-1]) == n
+        start += n
+    assert np.allclose(np.concatenate(out), np.convolve(X3[:start], H3)[:start])
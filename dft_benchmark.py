@@ -0,0 +1,222 @@
+"""
+Benchmark the DFT, IDFT, convolution and correlation variants in dft-1.py,
+dft-2.py and convolution-1.py.
+
+For each variant and each size N (powers of 2 from 8 to 8192 by default) this
+reports the best time per call in ns/point, the peak memory allocated during
+a call (from tracemalloc) and the scaling exponent fitted to log(time) against
+log(N). Results can be saved as JSON for regression tracking, e.g.
+
+    python3 dft_benchmark.py --json bench.json
+
+The pure Python variants are O(N*N), so once a variant takes longer than
+--time-limit seconds for one call it is not run at larger sizes.
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import math
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+
+
+def load_script(filename):
+    "Import one of the hyphen-named scripts in this directory as a module, hiding its output"
+    name = filename.replace('-', '_').removesuffix('.py')
+    spec = importlib.util.spec_from_file_location(name, HERE / filename)
+    module = importlib.util.module_from_spec(spec)
+    with contextlib.redirect_stdout(io.StringIO()):
+        spec.loader.exec_module(module)
+    return module
+
+
+def variants():
+    """
+    Build the table of benchmarks.
+
+    Returns:
+        dict: name -> setup(N), where setup returns a zero argument callable
+            that runs the variant once on inputs of size N.
+    """
+    dft1 = load_script('dft-1.py')
+    dft2 = load_script('dft-2.py')
+    conv = load_script('convolution-1.py')
+    rng = random.Random(1)
+
+    def signal(N):
+        return [rng.uniform(-1.0, 1.0) for _ in range(N)]
+
+    def spectrum(N):
+        K = N//2 + 1
+        return signal(K), signal(K)
+
+    def dft1_setup(f):
+        def setup(N):
+            # The dft-1 variants check their input length against these globals
+            dft1.samples = N
+            dft1.fft_size = N//2 + 1
+            XX = signal(N)
+            return lambda: f(XX)
+        return setup
+
+    def idft1_setup(f):
+        def setup(N):
+            dft1.samples = N
+            dft1.fft_size = N//2 + 1
+            REX, IMX = spectrum(N)
+            return lambda: f(REX, IMX)
+        return setup
+
+    def dft2_setup(precision):
+        def setup(N):
+            XX = signal(N)
+            return lambda: dft2.dft(XX, precision)
+        return setup
+
+    def idft2_setup(precision):
+        def setup(N):
+            REX, IMX = spectrum(N)
+            return lambda: dft2.idft(REX, IMX, precision)
+        return setup
+
+    # Convolutions are of an N sample signal with an N/8 sample template,
+    # as when matched filtering a capture.
+    def conv_setup(f, *args):
+        def setup(N):
+            X, H = signal(N), signal(max(1, N//8))
+            return lambda: f(X, H, *args)
+        return setup
+
+    table = {
+        'dft-1.dft2': dft1_setup(dft1.dft2),
+        'dft-1.dft3': dft1_setup(dft1.dft3),
+        'dft-1.dft4': dft1_setup(dft1.dft4),
+        'dft-1.idft2': idft1_setup(dft1.idft2),
+        'dft-1.idft3': idft1_setup(dft1.idft3),
+        'dft-1.idft4': idft1_setup(dft1.idft4),
+    }
+    for precision in dft2.PRECISIONS:
+        table[f'dft-2.dft[{precision}]'] = dft2_setup(precision)
+        table[f'dft-2.idft[{precision}]'] = idft2_setup(precision)
+    table['convolution-1.convolve'] = conv_setup(conv.convolve)
+    table['convolution-1.correlate'] = conv_setup(conv.correlate)
+    for method in ('direct', 'fft', 'overlap-add', 'auto'):
+        table[f'convolution-1.fast_convolve[{method}]'] = conv_setup(conv.fast_convolve, method)
+        table[f'convolution-1.fast_correlate[{method}]'] = conv_setup(conv.fast_correlate, method)
+    return table
+
+
+def time_call(run, min_seconds=0.05, max_repeats=100):
+    "Best time of several calls, repeating until min_seconds have been spent"
+    best = math.inf
+    spent = 0.0
+    for _ in range(max_repeats):
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        best = min(best, elapsed)
+        spent += elapsed
+        if spent >= min_seconds:
+            break
+    return best
+
+
+def peak_memory(run):
+    "Peak bytes allocated during one call"
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def scaling_exponent(points):
+    "Least squares slope of log(seconds) against log(N)"
+    if len(points) < 2:
+        return None
+    xs = [math.log(N) for N, _ in points]
+    ys = [math.log(seconds) for _, seconds in points]
+    x_mean = sum(xs) / len(xs)
+    y_mean = sum(ys) / len(ys)
+    sxx = sum((x - x_mean)**2 for x in xs)
+    sxy = sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys))
+    return sxy / sxx
+
+
+def run_benchmarks(sizes, time_limit, only=None):
+    """
+    Run every variant over the given sizes.
+
+    Args:
+        sizes (list): Sizes N to run, in increasing order.
+        time_limit (float): Stop growing N for a variant once one call takes longer than this.
+        only (str): If given, only run variants whose name contains this string.
+
+    Returns:
+        dict: Machine-readable results, with run metadata.
+    """
+    results = []
+    for name, setup in variants().items():
+        if only and only not in name:
+            continue
+        points = []
+        for N in sizes:
+            run = setup(N)
+            seconds = time_call(run)
+            results.append({'variant': name, 'N': N, 'seconds': seconds,
+                            'ns_per_point': seconds * 1e9 / N,
+                            'peak_bytes': peak_memory(run)})
+            points.append((N, seconds))
+            if seconds > time_limit:
+                break
+        exponent = scaling_exponent(points)
+        for r in results:
+            if r['variant'] == name:
+                r['scaling_exponent'] = exponent
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+
+def print_table(report):
+    print(f"{'variant':<40} {'N':>6} {'ns/point':>12} {'peak bytes':>12} {'exponent':>8}")
+    for r in report['results']:
+        exponent = r['scaling_exponent']
+        exponent = f'{exponent:8.2f}' if exponent is not None else f"{'-':>8}"
+        print(f"{r['variant']:<40} {r['N']:>6} {r['ns_per_point']:12.1f} {r['peak_bytes']:>12} {exponent}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--min-n', type=int, default=8)
+    parser.add_argument('--max-n', type=int, default=8192)
+    parser.add_argument('--time-limit', type=float, default=2.0,
+                        help='seconds per call beyond which larger N is skipped')
+    parser.add_argument('--only', help='only run variants whose name contains this')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    sizes = []
+    N = args.min_n
+    while N <= args.max_n:
+        sizes.append(N)
+        N *= 2
+    report = run_benchmarks(sizes, args.time_limit, args.only)
+    print_table(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,96 @@
+"""
+Certificates stored on the modem, named by their content, so that an
+unchanged certificate is never uploaded twice.
+
+The modem can list the files it holds (AT+CCERTLIST) but not what's in them,
+so a certificate is stored under its file name with a hash of its content
+added, e.g. isrgrootx1.pem as isrgrootx1-6fde3a48.pem. If the modem lists
+that name, it already holds this version; otherwise it's uploaded and older
+versions of the same certificate are deleted, including one stored under
+the plain file name by an older upload. The clients' upload_cert() return
+the stored name, which cert_name() also gives without a modem, to use for
+ssl_params['ca_cert'].
+"""
+import hashlib
+import os
+import re
+
+MAX_SIZE = 10240    # the most one AT+CCERTDOWN will take
+CHUNK_SIZE = 4096   # for reading and hashing the file
+
+
+def read_cert(filename, chunk_size=CHUNK_SIZE):
+    """
+    Read and hash a certificate file a chunk at a time.
+
+    Returns:
+        tuple: (the content as bytes, the name to store it under on the modem)
+    """
+    digest = hashlib.sha256()
+    data = bytearray()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            data += chunk
+            if len(data) > MAX_SIZE:
+                raise ValueError(f"{filename} is larger than the modem's {MAX_SIZE} byte limit")
+    return bytes(data), stored_name(filename, digest.hexdigest())
+
+
+def stored_name(filename, digest):
+    "The name for a version of a certificate on the modem, e.g. 'isrgrootx1-6fde3a48.pem'"
+    stem, ext = os.path.splitext(os.path.basename(filename))
+    return f'{stem}-{digest[:8]}{ext}'
+
+
+def cert_name(filename):
+    "The name a certificate file is stored under on the modem, for ssl_params['ca_cert']"
+    return read_cert(filename)[1]
+
+
+def parse_list(results):
+    """
+    The file names in the result lines of AT+CCERTLIST, with or without the
+    '+CCERTLIST: ' prefix.
+    """
+    names = set()
+    for result in results:
+        if result.startswith('+CCERTLIST:'):
+            result = result[len('+CCERTLIST:'):]
+        name = result.strip().strip('"')
+        if name:
+            names.add(name)
+    return names
+
+
+def stale(names, name):
+    "Other versions of the certificate stored as name, among the names listed, hashed or not"
+    stem, ext = os.path.splitext(name)
+    pattern = re.compile(re.escape(stem[:-9]) + r'(-[0-9a-f]{8})?' + re.escape(ext) + '$')
+    return sorted(n for n in names if n != name and pattern.match(n))
+
+
+if __name__ == "__main__":
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'chain.pem')
+        with open(path, 'wb') as f:
+            f.write(b'-----BEGIN CERTIFICATE-----\n' + b'A' * 6000 + b'\n-----END CERTIFICATE-----\n')
+        data, name = read_cert(path, chunk_size=1000)
+        assert len(data) == 6055 and name == stored_name(path, hashlib.sha256(data).hexdigest()) == cert_name(path)
+        assert re.fullmatch(r'chain-[0-9a-f]{8}\.pem', name)
+
+        listed = parse_list(['+CCERTLIST: "isrgrootx1.pem"', f'+CCERTLIST: "{name}"', '"chain-0123abcd.pem"', '"chain.pem"'])
+        assert name in listed and stale(listed, name) == ['chain-0123abcd.pem', 'chain.pem']
+        assert stale({'chain-0123abcd.der', 'mychain-0123abcd.pem'}, name) == []
+
+        with open(path, 'ab') as f:
+            f.write(b'B' * MAX_SIZE)
+        try:
+            read_cert(path)
+            assert False, "too large"
+        except ValueError:
+            pass
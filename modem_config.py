@@ -0,0 +1,133 @@
+"""
+Cache of the configuration that a SIMCom A76xx modem currently holds, so that
+the modem clients only send the configuration commands that would change it.
+
+Each setting is keyed by a tuple such as ('CSSLCFG', 'authmode', 1) and holds
+the body of the command that would set it, e.g. '="authmode",1,1'. The cache
+is seeded by querying the modem (see QUERIES) when a client first connects,
+and updated as commands succeed. Settings that don't survive the MQTT service
+being stopped are forgotten with forget_mqtt(), and everything is forgotten
+if the modem reboots.
+"""
+import csv
+
+
+def split_fields(result):
+    """
+    Split the fields of a result line such as '+CGDCONT: 1,"IP","iot.1nce.net"',
+    removing any quotes.
+
+    Args:
+        result (str or bytes): The result line, with or without the '+COMMAND: ' prefix.
+
+    Returns:
+        list: The fields, as strings.
+    """
+    if isinstance(result, bytes):
+        result = result.decode(errors="replace")
+    if result.startswith('+'):
+        result = result.split(':', 1)[1]
+    return next(csv.reader([result.strip()], skipinitialspace=True), [])
+
+
+# Field order of an AT+CSSLCFG? result line, after the SSL context index
+_CSSLCFG_FIELDS = ('sslversion', 'authmode', 'ignorelocaltime', 'negotiatetime',
+                   'cacert', 'clientcert', 'clientkey', 'password', 'enableSNI')
+_CSSLCFG_QUOTED = ('cacert', 'clientcert', 'clientkey', 'password')
+
+# Settings which are lost when the MQTT service is stopped or the client released
+_MQTT_COMMANDS = ('CMQTTSTART', 'CMQTTACCQ', 'CMQTTSSLCFG', 'CMQTTWILL', 'CMQTTCONNECT')
+
+
+class ModemConfig:
+    def __init__(self):
+        self.settings = {}
+        self.known = False # whether the modem has been queried since it (or we) started
+
+    def is_set(self, key, body):
+        "Whether the modem already holds this setting"
+        return self.settings.get(key) == body
+
+    def set(self, key, body):
+        "Record that the setting has been applied"
+        self.settings[key] = body
+
+    def forget(self, key):
+        self.settings.pop(key, None)
+
+    def forget_mqtt(self):
+        "Forget the settings lost when the MQTT service stops"
+        for key in [k for k in self.settings if k[0] in _MQTT_COMMANDS]:
+            del self.settings[key]
+
+    def forget_all(self):
+        "Forget everything, e.g. after the modem has rebooted"
+        self.settings.clear()
+        self.known = False
+
+    def parse(self, command, results):
+        """
+        Record the state reported by one of the QUERIES.
+
+        Args:
+            command (str): The command queried, e.g. 'CGDCONT'.
+            results (list): The result lines, or None if the query returned ERROR.
+        """
+        if command == 'CMQTTACCQ':
+            # The query fails if the MQTT service isn't running
+            if results is None:
+                self.forget_mqtt()
+                return
+            self.set(('CMQTTSTART',), '')
+        if results is None:
+            return
+        for result in results:
+            fields = split_fields(result)
+            if not fields:
+                continue
+            index = int(fields[0])
+            if command == 'CGDCONT' and len(fields) >= 3:
+                self.set(('CGDCONT', index), f'={index},"{fields[1]}","{fields[2]}"')
+            elif command == 'CGACT' and len(fields) >= 2:
+                if fields[1] == '1':
+                    self.set(('CGACT', index), f'=1,{index}')
+                else:
+                    self.forget(('CGACT', index))
+            elif command == 'CMQTTACCQ' and len(fields) >= 3 and fields[1]:
+                self.set(('CMQTTACCQ', index), f'={index},"{fields[1]}",{fields[2]}')
+            elif command == 'CSSLCFG':
+                for name, value in zip(_CSSLCFG_FIELDS, fields[1:]):
+                    if name in _CSSLCFG_QUOTED:
+                        value = f'"{value}"'
+                    self.set(('CSSLCFG', name, index), f'="{name}",{index},{value}')
+            elif command == 'CMQTTSSLCFG' and len(fields) >= 2:
+                self.set(('CMQTTSSLCFG', index), f'={index},{fields[1]}')
+            elif command == 'CMQTTCONNECT' and len(fields) >= 4:
+                credentials = ''.join(f',"{f}"' for f in fields[4:6] if f)
+                self.set(('CMQTTCONNECT', index), f'={index},"{fields[1]}",{fields[2]},{fields[3]}{credentials}')
+        self.known = True
+
+
+# The queries which report the modem's current configuration, in the order to send them
+QUERIES = ('CGDCONT', 'CGACT', 'CMQTTACCQ', 'CSSLCFG', 'CMQTTSSLCFG', 'CMQTTCONNECT')
+
+
+if __name__ == "__main__":
+    config = ModemConfig()
+    config.parse('CGDCONT', ['+CGDCONT: 1,"IP","iot.1nce.net","0.0.0.0",0,0,0,0'])
+    config.parse('CGACT', ['+CGACT: 1,1', '+CGACT: 2,0'])
+    config.parse('CMQTTACCQ', ['+CMQTTACCQ: 0,"BWtestClient0",1', '+CMQTTACCQ: 1,""'])
+    config.parse('CSSLCFG', ['+CSSLCFG: 1,3,1,1,300,"isrgrootx1.pem","","","",1'])
+    config.parse('CMQTTCONNECT', ['+CMQTTCONNECT: 0,"tcp://example.com:8883",20,1,"user","pw"'])
+    assert config.is_set(('CGDCONT', 1), '=1,"IP","iot.1nce.net"')
+    assert config.is_set(('CGACT', 1), '=1,1')
+    assert not config.is_set(('CGACT', 2), '=1,2')
+    assert config.is_set(('CMQTTSTART',), '')
+    assert config.is_set(('CMQTTACCQ', 0), '=0,"BWtestClient0",1')
+    assert config.is_set(('CSSLCFG', 'authmode', 1), '="authmode",1,1')
+    assert config.is_set(('CSSLCFG', 'cacert', 1), '="cacert",1,"isrgrootx1.pem"')
+    assert config.is_set(('CSSLCFG', 'enableSNI', 1), '="enableSNI",1,1')
+    assert config.is_set(('CMQTTCONNECT', 0), '=0,"tcp://example.com:8883",20,1,"user","pw"')
+    config.forget_mqtt()
+    assert not config.is_set(('CMQTTSTART',), '')
+    assert config.is_set(('CGACT', 1), '=1,1')
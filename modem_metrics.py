@@ -0,0 +1,186 @@
+"""
+Instrumentation for the modem clients: how long each AT command takes, the
+bytes crossing the serial link, which URCs arrive, reconnections and queue
+depths, to see which commands dominate connection setup and message latency
+in the field.
+
+Recording is cheap enough to leave on: a few counter updates and a bisect
+per command. Latencies go into histograms with fixed log-spaced buckets, and
+the most recent commands into a ring buffer for post-mortems. summary_json()
+gives compact JSON to publish every few minutes, e.g. on
+birdboxes/<name>/metrics.
+
+The simcom_at adapters record commands, bytes and URCs when given a Metrics;
+the MQTT clients add reconnections and queue depths.
+"""
+import bisect
+import json
+import time
+from collections import Counter, deque
+
+# Upper bounds of the latency buckets, in seconds; a last bucket holds anything slower
+BUCKETS = (0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30, 60)
+
+
+class Histogram:
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        "An upper bound on the p-th percentile: the top of its bucket (or the maximum, if less)"
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {'n': self.count,
+                'total': round(self.total, 3),
+                'mean': round(self.total / self.count, 4) if self.count else None,
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'max': round(self.max, 4),
+                'buckets': self.counts}
+
+
+class Metrics:
+    def __init__(self, ring_size=128):
+        """
+        Args:
+            ring_size (int): How many of the most recent commands to keep.
+        """
+        self.ring = deque(maxlen=ring_size) # (time, command, seconds, ok)
+        self.queues = {} # name -> [current depth, largest depth]
+        self.reset()
+
+    def reset(self):
+        "Start a new period; the ring buffer and current queue depths are kept"
+        self.since = time.time()
+        self.latency = {}        # command name -> Histogram
+        self.errors = Counter()  # command name -> ERRORs and timeouts
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.urcs = Counter()    # URC type, e.g. '+CMQTTRXSTART' -> count
+        self.events = Counter()  # e.g. 'reconnects', 'connection_lost'
+        for depths in self.queues.values():
+            depths[1] = depths[0]
+
+    def command(self, name, seconds, ok=True):
+        """
+        Record a command's latency.
+
+        Args:
+            name (str): The command, e.g. 'CMQTTPUB'.
+            seconds (float): From sending it to its response.
+            ok: True if it succeeded; False for an ERROR, None if it timed out.
+        """
+        histogram = self.latency.get(name)
+        if histogram is None:
+            histogram = self.latency[name] = Histogram()
+        histogram.add(seconds)
+        if not ok:
+            self.errors[name] += 1
+        self.ring.append((time.time(), name, seconds, ok))
+
+    def sent(self, n):
+        self.bytes_sent += n
+
+    def received(self, n):
+        self.bytes_received += n
+
+    def urc(self, line):
+        "Count an unsolicited line by its type, e.g. '+RECEIVE,0,5' as '+RECEIVE'"
+        self.urcs[line.split(':', 1)[0].split(',', 1)[0]] += 1
+
+    def count(self, event, n=1):
+        self.events[event] += n
+
+    def queue(self, name, depth):
+        "Record the current depth of a queue"
+        depths = self.queues.get(name)
+        if depths is None:
+            self.queues[name] = [depth, depth]
+        else:
+            depths[0] = depth
+            if depth > depths[1]:
+                depths[1] = depth
+
+    def recent(self):
+        "The most recent commands, oldest first, as (time, command, seconds, ok)"
+        return list(self.ring)
+
+    def summary(self, reset=False):
+        """
+        Summarise the period since the last reset, with the commands taking
+        the most time in all first.
+
+        Args:
+            reset (bool): Start a new period afterwards.
+
+        Returns:
+            dict: The summary, ready for JSON.
+        """
+        now = time.time()
+        commands = sorted(self.latency.items(), key=lambda item: -item[1].total)
+        summary = {'since': round(self.since),
+                   'seconds': round(now - self.since, 1),
+                   'bytes_sent': self.bytes_sent,
+                   'bytes_received': self.bytes_received,
+                   'commands': {name: histogram.summary() for name, histogram in commands},
+                   'errors': dict(self.errors),
+                   'urcs': dict(self.urcs),
+                   'events': dict(self.events),
+                   'queues': {name: {'depth': depth, 'max': largest} for name, (depth, largest) in self.queues.items()}}
+        if reset:
+            self.reset()
+        return summary
+
+    def summary_json(self, reset=False):
+        "The summary as compact JSON bytes, to publish"
+        return json.dumps(self.summary(reset), separators=(',', ':')).encode()
+
+
+if __name__ == "__main__":
+    metrics = Metrics(ring_size=4)
+    for seconds in (0.003, 0.004, 0.03, 0.04, 0.9):
+        metrics.command('CMQTTTOPIC', seconds)
+    metrics.command('CMQTTCONNECT', 2.5)
+    metrics.command('CMQTTPUB', 61, ok=None)
+    metrics.sent(120)
+    metrics.received(300)
+    metrics.urc('+CMQTTRXSTART: 0,3,5')
+    metrics.urc('+RECEIVE,0,5')
+    metrics.urc('+RECEIVE,1,7')
+    metrics.queue('publish_queue', 3)
+    metrics.queue('publish_queue', 1)
+    metrics.count('reconnects')
+
+    summary = metrics.summary()
+    assert list(summary['commands']) == ['CMQTTPUB', 'CMQTTCONNECT', 'CMQTTTOPIC'] # most time first
+    topic = summary['commands']['CMQTTTOPIC']
+    assert topic['n'] == 5 and topic['p50'] == 0.05 and topic['p95'] == 0.9 and sum(topic['buckets']) == 5
+    assert summary['errors'] == {'CMQTTPUB': 1} and summary['urcs'] == {'+CMQTTRXSTART': 1, '+RECEIVE': 2}
+    assert summary['queues'] == {'publish_queue': {'depth': 1, 'max': 3}}
+    assert len(metrics.recent()) == 4 and metrics.recent()[-1][1] == 'CMQTTPUB'
+
+    data = metrics.summary_json(reset=True)
+    assert json.loads(data)['bytes_sent'] == 120 and len(data) < 1024
+    assert metrics.bytes_sent == 0 and metrics.queues['publish_queue'] == [1, 1] and len(metrics.recent()) == 4
+    print(f"{len(data)} byte summary")
@@ -0,0 +1,127 @@
+"""
+Splitting of large MQTT payloads into sequenced chunk messages, and their
+reassembly on the receiving side.
+
+The SIMCom A76xx limits a publish to 10240 bytes, so larger payloads (e.g.
+camera snapshots) are sent as several messages on the same topic, each
+starting with a chunk header:
+
+    magic      4 bytes  b'\\x89CHK'
+    message id 2 bytes  identifies the chunks of one payload
+    index      2 bytes  this chunk's number, from 0
+    count      2 bytes  number of chunks in the payload
+    offset     4 bytes  where this chunk's data goes in the payload
+    total      4 bytes  length of the whole payload
+
+all big-endian. Messages without the magic are passed through unchanged.
+"""
+import os
+import struct
+from collections import OrderedDict
+
+_HEADER = struct.Struct('>4sHHHII')
+MAGIC = b'\x89CHK'
+HEADER_SIZE = _HEADER.size
+MAX_PUBLISH = 10240 # largest payload the modem will publish
+
+
+def payload_size(data):
+    "The length of a bytes-like object, or of the rest of a seekable binary file"
+    if hasattr(data, 'read'):
+        position = data.tell()
+        end = data.seek(0, os.SEEK_END)
+        data.seek(position)
+        return end - position
+    return len(data)
+
+
+def split(data, message_id, max_size=MAX_PUBLISH):
+    """
+    Split a payload into chunk messages, reading a file one chunk at a time.
+
+    Args:
+        data (bytes-like or file): The payload, or a seekable binary file to read it from.
+        message_id (int): Identifies this payload's chunks. (0 <= message_id < 65536)
+        max_size (int): The largest message to produce, including the header.
+
+    Yields:
+        bytes: Each chunk message in turn.
+    """
+    chunk_size = max_size - HEADER_SIZE
+    total = payload_size(data)
+    count = max(1, -(-total // chunk_size))
+    assert count < 65536, "payload too large to chunk"
+    view = None if hasattr(data, 'read') else memoryview(data)
+    for index in range(count):
+        offset = index * chunk_size
+        if view is None:
+            chunk = data.read(chunk_size)
+        else:
+            chunk = view[offset:offset + chunk_size]
+        yield _HEADER.pack(MAGIC, message_id & 0xFFFF, index, count, offset, total) + chunk
+
+
+class Reassembler:
+    """
+    Reassembles chunked payloads, writing each chunk straight into a buffer
+    preallocated from the header's total length. Duplicate chunks (as qos 1
+    may deliver) are ignored, and chunks may arrive in any order.
+    """
+
+    def __init__(self, max_partial=8):
+        """
+        Args:
+            max_partial (int): How many incomplete payloads to keep; the oldest is discarded beyond this.
+        """
+        self.max_partial = max_partial
+        self.partial = OrderedDict() # (topic, message id) -> [buffer, chunks still missing, indices received]
+
+    def add(self, topic, msg):
+        """
+        Add a received message.
+
+        Returns:
+            The whole payload (bytes) if msg completes one, msg itself if
+            it isn't a chunk, or None if more chunks are still to come.
+        """
+        if len(msg) < HEADER_SIZE or msg[:4] != MAGIC:
+            return msg
+        magic, message_id, index, count, offset, total = _HEADER.unpack_from(msg)
+        data = memoryview(msg)[HEADER_SIZE:]
+        if count == 1:
+            return bytes(data)
+        key = (bytes(topic), message_id)
+        entry = self.partial.get(key)
+        if entry is None or len(entry[0]) != total:
+            entry = self.partial[key] = [bytearray(total), count, set()]
+            while len(self.partial) > self.max_partial:
+                self.partial.popitem(last=False)
+        buffer, missing, received = entry
+        if index in received or offset + len(data) > total:
+            return None
+        buffer[offset:offset + len(data)] = data
+        received.add(index)
+        entry[1] = missing - 1
+        if entry[1] > 0:
+            return None
+        del self.partial[key]
+        return bytes(buffer)
+
+
+if __name__ == "__main__":
+    import io
+    payload = bytes(range(256)) * 200 # 51200 bytes
+    chunks = list(split(payload, 7, max_size=1000))
+    assert all(len(c) <= 1000 for c in chunks)
+    assert list(split(io.BytesIO(payload), 7, max_size=1000)) == chunks
+
+    # Out of order, with a duplicate, interleaved with an unchunked message
+    reassembler = Reassembler()
+    assert reassembler.add(b'cam', b'plain') == b'plain'
+    results = [reassembler.add(b'cam', c) for c in chunks[::-1] + chunks[:1]]
+    assert results.count(None) == len(results) - 1
+    assert next(r for r in results if r is not None) == payload
+    assert type(next(r for r in results if r is not None)) is bytes
+
+    # Small payloads are still one message
+    assert [reassembler.add(b't', c) for c in split(b'small', 8)] == [b'small']
@@ -0,0 +1,163 @@
+"""
+Optional compression of MQTT payloads, to save cellular airtime.
+
+A compressed payload starts with a two byte header:
+
+    magic   1 byte  0xBC (never the first byte of UTF-8 text)
+    method  1 byte  high nibble: 1 = raw deflate, 2 = raw LZMA2
+                    low nibble: preset dictionary id (deflate only), 0 for none
+
+Short payloads compress badly without help, so deflate can be primed with a
+preset dictionary of text typical of our topics. Subscribers need the same
+dictionaries, so the ids in DICTIONARIES must never be reused for different
+content. A payload is only sent compressed if that makes it smaller.
+Received payloads are only decompressed up to MAX_SIZE, as a few KB of
+deflate or LZMA can expand to far more than a Pi has memory for.
+"""
+import lzma
+import zlib
+from collections import Counter
+
+MAGIC = 0xBC
+ZLIB = 1
+LZMA = 2
+_LZMA_FILTERS = [{'id': lzma.FILTER_LZMA2, 'preset': 9}]
+MAX_SIZE = 1 << 20  # the most a received payload may decompress to
+
+# Preset dictionaries by id. Deflate looks back at most 32K, and matches
+# nearer the end of the dictionary are cheaper, so the commonest text goes last.
+DICTIONARIES = {
+    1: (b'"battery_level": "status": "stay_up": "force_up": true false null '
+        b'birdboxes/birdbox1/initial_status birdboxes/birdbox1/battery_level '
+        b'birdboxes/birdbox1/startup_time birdboxes/birdbox1/shutdown_time '
+        b'birdboxes/birdbox1/wake_time birdboxes/birdbox1/stay_up '
+        b'Pi Python connection broken Raspberry Pi Python, MQTT from SIMCom A7683E! '
+        b'Pi Python at: 2025-01-01 00:00:00 Pi Python at: 2026-'),
+}
+
+
+def train_dictionary(samples, size=2048, ngram=8):
+    """
+    Build a preset dictionary from sample payloads, keeping the substrings
+    that recur most across them.
+
+    Args:
+        samples (list): Typical payloads (bytes).
+        size (int): The largest dictionary to return.
+        ngram (int): The length of substring counted.
+
+    Returns:
+        bytes: The dictionary, most common content last.
+    """
+    counts = Counter()
+    for sample in samples:
+        counts.update({sample[i:i + ngram] for i in range(len(sample) - ngram + 1)})
+    dictionary = b''
+    for gram, count in counts.most_common():
+        if count < 2 or len(dictionary) + ngram > size:
+            break
+        if gram not in dictionary:
+            dictionary = gram + dictionary
+    return dictionary
+
+
+class Compressor:
+    def __init__(self, method=ZLIB, dictionary_id=1, level=9, min_size=16):
+        """
+        Args:
+            method (int): ZLIB or LZMA. LZMA does better on large payloads, but can't use a dictionary.
+            dictionary_id (int): Which of DICTIONARIES to prime deflate with, or 0 for none.
+            level (int): The deflate compression level.
+            min_size (int): Payloads shorter than this aren't worth trying.
+        """
+        assert method in (ZLIB, LZMA)
+        assert dictionary_id == 0 or (method == ZLIB and dictionary_id in DICTIONARIES)
+        self.method = method
+        self.dictionary_id = dictionary_id
+        self.level = level
+        self.min_size = min_size
+        self.header = bytes([MAGIC, method << 4 | dictionary_id])
+
+    def compress(self, msg):
+        "Returns the compressed payload, or msg itself if compressing doesn't make it smaller"
+        if len(msg) < self.min_size:
+            return msg
+        if self.method == ZLIB:
+            if self.dictionary_id:
+                c = zlib.compressobj(self.level, zlib.DEFLATED, -15, zdict=DICTIONARIES[self.dictionary_id])
+            else:
+                c = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+            data = c.compress(msg) + c.flush()
+        else:
+            data = lzma.compress(msg, format=lzma.FORMAT_RAW, filters=_LZMA_FILTERS)
+        if len(data) + len(self.header) >= len(msg):
+            return msg
+        return self.header + data
+
+
+def is_compressed(msg):
+    return len(msg) >= 2 and msg[0] == MAGIC and msg[1] >> 4 in (ZLIB, LZMA)
+
+
+def decompress(msg, max_size=MAX_SIZE):
+    """
+    Decompress a payload if it has a compression header, otherwise (or if it
+    turns out not to be compressed after all) return it unchanged.
+
+    Raises:
+        ValueError: If it decompresses to more than max_size bytes.
+    """
+    if not is_compressed(msg):
+        return msg
+    method, dictionary_id = msg[1] >> 4, msg[1] & 0x0F
+    data = bytes(msg[2:])
+    try:
+        if method == LZMA:
+            d = lzma.LZMADecompressor(format=lzma.FORMAT_RAW, filters=_LZMA_FILTERS)
+            result = d.decompress(data, max_size + 1)
+        else:
+            if dictionary_id:
+                d = zlib.decompressobj(-15, zdict=DICTIONARIES[dictionary_id])
+            else:
+                d = zlib.decompressobj(-15)
+            result = d.decompress(data, max_size + 1)
+            if len(result) <= max_size:
+                result += d.flush()
+    except (zlib.error, lzma.LZMAError, KeyError):
+        return msg
+    if len(result) > max_size:
+        raise ValueError(f"Payload decompresses to more than {max_size} bytes")
+    return result if d.eof else msg
+
+
+if __name__ == "__main__":
+    text = b'Pi Python at: 2026-10-19 12:34:56'
+    compressor = Compressor()
+    packed = compressor.compress(text)
+    plain = Compressor(dictionary_id=0).compress(text)
+    print(f"{len(text)} bytes, {len(packed)} with dictionary, {len(plain)} without")
+    assert len(packed) < len(text) and plain == text and decompress(packed) == text
+
+    # Large repetitive payloads, either method
+    big = b''.join(b'{"battery_level": %d, "status": "up"}\n' % (i % 80) for i in range(500))
+    for c in (compressor, Compressor(LZMA, 0)):
+        assert len(c.compress(big)) < len(big) // 10 and decompress(c.compress(big)) == big
+
+    # Incompressible or short payloads go as they are, and other payloads pass through
+    noise = bytes((i * 7919) % 251 for i in range(100))
+    assert compressor.compress(noise) == noise and compressor.compress(b'hi') == b'hi'
+    assert decompress(b'\xbc\x11 not deflate') == b'\xbc\x11 not deflate'
+    assert decompress(b'plain') == b'plain'
+
+    # Payloads that would decompress to too much are rejected
+    for c in (compressor, Compressor(LZMA, 0)):
+        bomb = c.compress(bytes(MAX_SIZE + 1))
+        assert len(bomb) < 10240 and decompress(bomb, MAX_SIZE + 1) == bytes(MAX_SIZE + 1)
+        try:
+            decompress(bomb)
+            assert False, "too large"
+        except ValueError:
+            pass
+
+    trained = train_dictionary([b'birdboxes/birdbox%d/status up' % i for i in range(10)])
+    assert b'birdbox' in trained and len(trained) <= 2048
@@ -0,0 +1,296 @@
+"""
+Disk-backed store-and-forward spool for MQTT publishes made while the modem
+has no connection.
+
+Messages are appended to a log file as fixed header + topic + payload records,
+and a separate small file records how far the log has been drained. Draining
+reads the log through mmap, oldest first, and only advances the drained
+offset once a batch has been published, so nothing is lost if power fails or
+the connection drops part way through. The log is truncated once it has been
+fully drained, and compacted if the drained part comes to dominate it.
+
+QoS and retain semantics:
+  - qos 0 messages are sent at most once: a failed qos 0 publish is dropped
+    rather than retried.
+  - qos 1 and 2 messages stay in the spool until the publish succeeds.
+  - A retained message that is superseded by a later retained message on the
+    same topic is skipped, as the broker would only keep the later one.
+"""
+import mmap
+import os
+import struct
+import zlib
+
+# magic, qos, flags, topic length, payload length, crc32 of topic + payload
+_RECORD = struct.Struct('<HBBHII')
+_MAGIC = 0x5350 # 'PS'
+_RETAIN = 0x01
+
+
+class Spool:
+    def __init__(self, path, max_bytes=4*1024*1024, sync=False):
+        """
+        Open (or create) a spool.
+
+        Args:
+            path (str): The log file. The drained offset is kept in path + '.offset'.
+            max_bytes (int): Once the undrained messages exceed this, the oldest are dropped.
+            sync (bool): Whether to fsync after every append (slower, but survives power loss).
+        """
+        self.path = path
+        self.offset_path = path + '.offset'
+        self.max_bytes = max_bytes
+        self.sync = sync
+        self.file = open(path, 'a+b')
+        self.offset = self._read_offset()
+        self._recover()
+
+    def _read_offset(self):
+        try:
+            with open(self.offset_path, 'rb') as f:
+                return struct.unpack('<Q', f.read(8))[0]
+        except (FileNotFoundError, struct.error):
+            return 0
+
+    def _write_offset(self, offset):
+        tmp = self.offset_path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(struct.pack('<Q', offset))
+            if self.sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, self.offset_path)
+        self.offset = offset
+
+    def _size(self):
+        self.file.seek(0, os.SEEK_END)
+        return self.file.tell()
+
+    def _recover(self):
+        "Truncate a torn record left at the end of the log by an interrupted append"
+        end = self.offset
+        for end, *_ in self._scan(validate=True):
+            pass
+        if end < self._size():
+            self.file.truncate(end)
+        if self.offset > end:
+            self._write_offset(end)
+
+    def _scan(self, validate=False, payloads=False):
+        """
+        Iterate over the undrained records.
+
+        Args:
+            validate (bool): Whether to check each record's CRC.
+            payloads (bool): Whether to copy out each payload, rather than yield None.
+
+        Yields:
+            tuple: (end offset, start offset, qos, retain, topic, msg)
+        """
+        size = self._size()
+        pos = self.offset
+        if pos >= size:
+            return
+        with mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ) as mm:
+            while pos + _RECORD.size <= size:
+                magic, qos, flags, topic_len, msg_len, crc = _RECORD.unpack_from(mm, pos)
+                body = pos + _RECORD.size
+                end = body + topic_len + msg_len
+                if magic != _MAGIC or end > size:
+                    return
+                if validate and zlib.crc32(mm[body:end]) != crc:
+                    return
+                msg = mm[body + topic_len:end] if payloads else None
+                yield end, pos, qos, bool(flags & _RETAIN), mm[body:body + topic_len], msg
+                pos = end
+
+    def __len__(self):
+        return sum(1 for _ in self._scan())
+
+    def pending_bytes(self):
+        "The number of bytes of undrained records"
+        return self._size() - self.offset
+
+    def append(self, topic, msg, retain=False, qos=0):
+        "Add a message to the end of the spool"
+        record = _RECORD.pack(_MAGIC, qos, _RETAIN if retain else 0, len(topic), len(msg),
+                              zlib.crc32(msg, zlib.crc32(topic)))
+        self.file.seek(0, os.SEEK_END)
+        self.file.write(record + bytes(topic) + bytes(msg))
+        self.file.flush()
+        if self.sync:
+            os.fsync(self.file.fileno())
+        if self.pending_bytes() > self.max_bytes:
+            self._drop_oldest()
+
+    def _drop_oldest(self):
+        "Drop the oldest messages until the spool fits in max_bytes again"
+        excess = self.pending_bytes() - self.max_bytes
+        for end, *_ in self._scan():
+            if end - self.offset >= excess:
+                break
+        self._write_offset(end)
+        if self.offset * 2 > self._size():
+            self.compact()
+
+    def compact(self):
+        "Rewrite the log without its drained records"
+        size = self._size()
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            self.file.seek(self.offset)
+            while self.file.tell() < size:
+                f.write(self.file.read(64*1024))
+            f.flush()
+            os.fsync(f.fileno())
+        self.file.close()
+        os.replace(tmp, self.path)
+        self.file = open(self.path, 'a+b')
+        self._write_offset(0)
+
+    def batches(self, max_messages=32):
+        """
+        Iterate over the undrained messages in batches, oldest first, skipping
+        retained messages superseded by a later retained message on the same topic.
+        Call commit() with a batch's end offset once it has been published.
+
+        Yields:
+            tuple: (end offset, list of (end offset, topic, msg, retain, qos))
+        """
+        last_retained = {}
+        for end, start, qos, retain, topic, msg in self._scan():
+            if retain:
+                last_retained[topic] = start
+        batch = []
+        batch_end = self.offset
+        for end, start, qos, retain, topic, msg in self._scan(payloads=True):
+            batch_end = end
+            if retain and last_retained[topic] != start:
+                continue
+            batch.append((end, topic, msg, retain, qos))
+            if len(batch) >= max_messages:
+                yield batch_end, batch
+                batch = []
+        if batch or batch_end != self.offset:
+            yield batch_end, batch
+
+    def commit(self, offset):
+        "Mark everything before offset as drained"
+        if offset >= self._size():
+            # Fully drained, so start the log again
+            self.file.truncate(0)
+            offset = 0
+        self._write_offset(offset)
+
+    def drain(self, publish, max_messages=32):
+        """
+        Publish the spooled messages, oldest first, committing each batch
+        once it has gone. Stops at the first failed qos 1 or 2 message, which
+        stays in the spool to be retried. If publish raises, what went before
+        is committed and the exception passed on.
+
+        Args:
+            publish (function): Called as publish(topic, msg, retain, qos),
+                returning True if the message was published.
+
+        Returns:
+            bool: True if the spool was fully drained.
+        """
+        for batch_end, batch in self.batches(max_messages):
+            committed = self.offset
+            for end, topic, msg, retain, qos in batch:
+                try:
+                    published = publish(topic, msg, retain, qos)
+                except BaseException:
+                    if committed != self.offset:
+                        self.commit(committed)
+                    raise
+                if not published and qos > 0:
+                    if committed != self.offset:
+                        self.commit(committed)
+                    return False
+                committed = end
+            self.commit(batch_end)
+        return True
+
+    async def drain_async(self, publish, max_messages=32):
+        """
+        As drain(), except that publish is a coroutine function and the
+        messages in each batch are published concurrently.
+        """
+        import asyncio
+        for batch_end, batch in self.batches(max_messages):
+            results = await asyncio.gather(*(publish(topic, msg, retain, qos) for end, topic, msg, retain, qos in batch),
+                                           return_exceptions=True)
+            committed = self.offset
+            for (end, topic, msg, retain, qos), result in zip(batch, results):
+                if qos > 0 and (result is False or isinstance(result, BaseException)):
+                    # Retry from the first failure; the broker may see
+                    # duplicates of any later messages, as qos 1 permits
+                    if committed != self.offset:
+                        self.commit(committed)
+                    return False
+                committed = end
+            self.commit(batch_end)
+        return True
+
+    def close(self):
+        self.file.close()
+
+
+if __name__ == "__main__":
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'spool')
+        spool = Spool(path)
+        spool.append(b'a/retained', b'old', retain=True, qos=1)
+        for i in range(5):
+            spool.append(b'a/count', str(i).encode(), qos=1)
+        spool.append(b'a/retained', b'new', retain=True, qos=1)
+        spool.close()
+
+        # A torn write at the end is discarded on reopening
+        with open(path, 'ab') as f:
+            f.write(_RECORD.pack(_MAGIC, 1, 0, 7, 100, 0) + b'a/torn')
+        spool = Spool(path)
+        assert len(spool) == 7
+
+        # A failed qos 1 publish stops the drain, and is retried next time
+        sent = []
+        def flaky(topic, msg, retain, qos):
+            if msg == b'3' and b'3' not in [m for t, m in sent]:
+                sent.append((None, b'3'))
+                return False
+            sent.append((topic, msg))
+            return True
+        assert not spool.drain(flaky, max_messages=2)
+        assert spool.drain(flaky, max_messages=2)
+        sent = [(t, m) for t, m in sent if t]
+        assert sent == [(b'a/count', b'0'), (b'a/count', b'1'), (b'a/count', b'2'),
+                        (b'a/count', b'3'), (b'a/count', b'4'), (b'a/retained', b'new')]
+        assert len(spool) == 0 and os.path.getsize(path) == 0
+
+        # As does one that raises, without resending those before it
+        for i in range(3):
+            spool.append(b'a/count', str(i).encode(), qos=1)
+        sent = []
+        def failing(topic, msg, retain, qos):
+            if msg == b'1':
+                raise TimeoutError("modem silent")
+            sent.append(msg)
+            return True
+        try:
+            spool.drain(failing)
+            assert False, "drain() should have raised"
+        except TimeoutError:
+            pass
+        assert sent == [b'0'] and len(spool) == 2
+        assert spool.drain(lambda *message: True) and len(spool) == 0
+
+        # Old messages are dropped once max_bytes is exceeded
+        spool = Spool(path, max_bytes=200)
+        for i in range(20):
+            spool.append(b'a/count', b'%d' % i)
+        assert spool.pending_bytes() <= 200
+        assert [m for end, batch in spool.batches() for e, t, m, r, q in batch][-1] == b'19'
+        spool.close()
@@ -0,0 +1,177 @@
+"""
+Dispatch of received MQTT messages to handlers by topic, with MQTT's + and #
+wildcards, for the modem clients' callbacks and paho's on_message.
+
+Subscriptions are kept in a trie of topic levels, so finding the handlers
+for a topic takes time in proportion to its depth, however many
+subscriptions there are. The result is cached per topic (as received, str or
+bytes), along with the decoded topic and its levels, so a topic seen before
+is dispatched without decoding or splitting it again.
+
+    topics = Dispatcher()
+    topics.add('birdboxes/+/telemetry', on_telemetry)
+    topics.add('birdboxes/#', on_other)
+    client.set_callback(topics.dispatch)   # or on_message = topics.on_message for paho
+
+Handlers are called as handler(topic, msg), with the topic as a str.
+"""
+
+
+class _Node:
+    __slots__ = ('children', 'handlers')
+
+    def __init__(self):
+        self.children = {} # level -> _Node, including '+' and '#'
+        self.handlers = []
+
+
+def _decode(topic):
+    return topic.decode(errors="replace") if isinstance(topic, (bytes, bytearray)) else topic
+
+
+class Dispatcher:
+    def __init__(self, default=None, cache_size=1024):
+        """
+        Args:
+            default (function): Called as default(topic, msg) for messages no handler matches.
+            cache_size (int): The most topics to remember the handlers of.
+        """
+        self.root = _Node()
+        self.default = default
+        self.cache_size = cache_size
+        self.cache = {} # topic as received -> (topic str, levels, handlers)
+
+    def add(self, topic_filter, handler):
+        "Call handler for messages on topics matching topic_filter (str or bytes)"
+        node = self.root
+        for level in _decode(topic_filter).split('/'):
+            node = node.children.setdefault(level, _Node())
+        node.handlers.append(handler)
+        self.cache.clear()
+
+    def remove(self, topic_filter, handler=None):
+        "Stop calling handler (or all handlers) for topic_filter"
+        path = [self.root]
+        levels = _decode(topic_filter).split('/')
+        for level in levels:
+            node = path[-1].children.get(level)
+            if node is None:
+                return
+            path.append(node)
+        node = path[-1]
+        node.handlers = [] if handler is None else [h for h in node.handlers if h != handler]
+        # Prune the branch back to the last node still in use
+        for level, parent, child in zip(reversed(levels), reversed(path[:-1]), reversed(path[1:])):
+            if child.handlers or child.children:
+                break
+            del parent.children[level]
+        self.cache.clear()
+
+    def _match(self, levels):
+        handlers = []
+        nodes = [self.root]
+        for i, level in enumerate(levels):
+            next_nodes = []
+            for node in nodes:
+                children = node.children
+                # Wildcards at the first level don't match topics starting with '$', e.g. $SYS
+                if i or not level.startswith('$'):
+                    wild = children.get('#')
+                    if wild is not None:
+                        handlers += wild.handlers
+                    wild = children.get('+')
+                    if wild is not None:
+                        next_nodes.append(wild)
+                child = children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+            nodes = next_nodes
+            if not nodes:
+                break
+        for node in nodes:
+            handlers += node.handlers
+            wild = node.children.get('#') # 'a/#' matches 'a' itself too
+            if wild is not None:
+                handlers += wild.handlers
+        # A handler matching through several filters is called once
+        return list(dict.fromkeys(handlers))
+
+    def lookup(self, topic):
+        """
+        Returns:
+            tuple: (the topic as a str, its levels, the handlers matching it)
+        """
+        if isinstance(topic, bytearray):
+            topic = bytes(topic)
+        entry = self.cache.get(topic)
+        if entry is None:
+            text = _decode(topic)
+            levels = tuple(text.split('/'))
+            entry = (text, levels, self._match(levels))
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            self.cache[topic] = entry
+        return entry
+
+    def levels(self, topic):
+        "A topic's levels, e.g. ('birdboxes', 'birdbox1', 'status'), from the cache where possible"
+        return self.lookup(topic)[1]
+
+    def dispatch(self, topic, msg):
+        """
+        Call the handlers matching topic (or the default handler) with the message.
+
+        Returns:
+            int: The number of handlers called.
+        """
+        text, levels, handlers = self.lookup(topic)
+        for handler in handlers:
+            handler(text, msg)
+        if not handlers and self.default is not None:
+            self.default(text, msg)
+        return len(handlers)
+
+    def on_message(self, client, userdata, message):
+        "For paho's client.on_message"
+        self.dispatch(message.topic, message)
+
+
+if __name__ == "__main__":
+    calls = []
+    topics = Dispatcher(default=lambda topic, msg: calls.append(('default', topic)))
+    def handler(name):
+        return lambda topic, msg: calls.append((name, topic))
+    status = handler('status')
+    topics.add('birdboxes/+/status', status)
+    topics.add(b'birdboxes/#', handler('all'))
+    topics.add('birdboxes/birdbox1/status', status) # overlapping filter, same handler
+    topics.add('+/+', handler('two levels'))
+    topics.add('#', handler('everything'))
+
+    assert topics.dispatch(b'birdboxes/birdbox1/status', b'up') == 3
+    assert calls == [('everything', 'birdboxes/birdbox1/status'), ('all', 'birdboxes/birdbox1/status'),
+                     ('status', 'birdboxes/birdbox1/status')]
+    calls.clear()
+    topics.dispatch('birdboxes', b'')         # 'birdboxes/#' matches its parent level
+    topics.dispatch('BWtest/topic', b'')
+    topics.dispatch('$SYS/broker/uptime', b'') # not matched by wildcards
+    assert calls == [('everything', 'birdboxes'), ('all', 'birdboxes'),
+                     ('everything', 'BWtest/topic'), ('two levels', 'BWtest/topic'),
+                     ('default', '$SYS/broker/uptime')], calls
+    assert topics.levels(bytearray(b'birdboxes/birdbox1/status')) == ('birdboxes', 'birdbox1', 'status')
+
+    topics.remove('#')
+    topics.remove('birdboxes/+/status', status)
+    calls.clear()
+    topics.dispatch(b'birdboxes/birdbox2/status', b'')
+    assert calls == [('all', 'birdboxes/birdbox2/status')]
+    assert '#' not in topics.root.children and '+' not in topics.root.children['birdboxes'].children
+
+    # Cached lookups stay fast with many subscriptions
+    import time
+    for i in range(500):
+        topics.add(f'birdboxes/birdbox{i}/battery_level', status)
+    start = time.perf_counter()
+    for i in range(10000):
+        topics.dispatch(b'birdboxes/birdbox250/battery_level', b'80')
+    print(f"{(time.perf_counter() - start) / 10000 * 1e6:.1f} us per dispatch")
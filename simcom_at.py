@@ -0,0 +1,725 @@
+"""
+AT command engine for SIMCom modems (A76xx and relatives), shared by the MQTT
+and socket front ends.
+
+The engine itself does no I/O ("sans-I/O"): bytes received from the modem are
+fed in with receive(), which returns events, and the bytes to send are taken
+out with send() and data_to_send(). It frames lines and '>' payload prompts,
+tracks the command in flight (its echo, result lines and final OK or ERROR),
+routes the late results of pipelined commands to them in order, and attaches
+the raw data that follows result codes such as +CMQTTRXPAYLOAD to them.
+
+SerialAT and AsyncAT are thin adapters that drive the engine from a pyserial
+port or an asyncio reader/writer pair. Either can record command latencies,
+bytes and URCs in a modem_metrics.Metrics.
+
+Events returned by ATEngine.receive():
+    (COMPLETE, command)         the command in flight got its final response
+    (ACKED, command)            a pipelined command got its late result
+    (UNSOLICITED, line, data)   anything else; data is the raw data following
+                                the line, or None
+"""
+import asyncio
+import select
+import time
+from collections import deque
+
+COMPLETE = 'complete'
+ACKED = 'acked'
+UNSOLICITED = 'unsolicited'
+
+
+def _ints(text):
+    "The comma-separated integer fields of a result, e.g. '0,12,44', with None for any that aren't"
+    values = []
+    for field in text.split(','):
+        try:
+            values.append(int(field))
+        except ValueError:
+            values.append(None)
+    return values
+
+
+# Result codes which are followed by a block of raw data, and how to find its
+# length from the code's fields
+DATA_LENGTHS = (
+    ('+CMQTTRXTOPIC:', lambda f: f[1]),
+    ('+CMQTTRXPAYLOAD:', lambda f: f[1]),
+    ('+CIPRXGET:', lambda f: f[2] if f[0] == 2 and len(f) > 2 else 0), # mode 2 only
+    ('+RECEIVE,', lambda f: f[1]),
+)
+
+
+class ATCommand:
+    """
+    An AT command and its response. The engine updates it as the response
+    arrives; once done is set, ok says whether it succeeded.
+    """
+
+    def __init__(self, line, payload=None, expect_result=False, query=False, ack=False, expected=None, result_prefix=None):
+        """
+        Args:
+            line (str): The command, e.g. 'AT+CMQTTPUB=0,1,60,0'.
+            payload (bytes): Sent when the modem prompts for it with '>'.
+            expect_result (bool): A +COMMAND: result line is expected, and may come after the OK.
+            query (bool): The (zero or more) result lines all precede the OK.
+            ack (bool): The command is pipelined: it is done at its OK, and its late
+                +COMMAND: result is delivered as an ACKED event, in order with any other
+                commands pipelined before it.
+            expected (str): If given, the command is done when a line containing this
+                arrives (or at the prompt, for '>'), rather than at OK; every line up to
+                then belongs to the command. It's matched as soon as it arrives, so
+                should be the end of a line, e.g. 'SEND OK' rather than '+CIPOPEN: 0,'.
+            result_prefix (str): The start of the command's own result lines, where a
+                notification has the same +COMMAND: prefix, e.g. '+CIPRXGET: 2,0,' for a
+                read from link 0, so that '+CIPRXGET: 1,1' is left as unsolicited.
+        """
+        self.line = line
+        self.echo = line.strip()
+        name = self.echo[3:] if self.echo.startswith('AT+') else self.echo[2:]
+        for i, c in enumerate(name):
+            if c in '=?':
+                name = name[:i]
+                break
+        self.name = name
+        self.prefix = '+' + name + ':'
+        self.result_prefix = result_prefix or self.prefix
+        self.payload = payload
+        self.expect_result = expect_result
+        self.query = query
+        self.ack = ack
+        self.expected = expected
+        self.results = []    # +COMMAND: lines
+        self.response = []   # all lines, in expected mode
+        self.data = []       # raw data attached to the command's lines
+        self.prompted = False
+        self.late = False    # the result arrived after the OK
+        self.ok = None       # True on OK, False on ERROR
+        self.sent = None     # time.perf_counter() when it was sent
+        self.done = False
+        self.ack_line = None # the late result of a pipelined command
+
+    def __repr__(self):
+        return f'<ATCommand {self.echo}>'
+
+    def text(self):
+        "The response as text, in expected mode"
+        return '\r\n'.join(self.response)
+
+    def _finish(self, ok):
+        self.ok = ok
+        self.done = True
+
+    def handle(self, line, data):
+        """
+        Handle a line from the modem if it belongs to this command.
+
+        Returns:
+            bool: True if the line was consumed, False if it is someone else's.
+        """
+        if line == self.echo:
+            return True
+        if line == '>':
+            if self.payload is not None and not self.prompted:
+                self.prompted = True
+                return True
+            if self.expected == '>':
+                self._finish(True)
+                return True
+            return False
+        if self.expected is not None:
+            self.response.append(line)
+            if data is not None:
+                self.data.append(data)
+            if self.expected in line:
+                self._finish(True)
+            elif line == 'ERROR' or line.startswith('+CME ERROR:'):
+                self._finish(False)
+            return True
+        if line.startswith(self.result_prefix):
+            if self.ack:
+                return False # belongs to the oldest outstanding pipelined command
+            self.results.append(line)
+            if data is not None:
+                self.data.append(data)
+            if self.ok:
+                self.late = True
+                self._finish(True)
+            return True
+        if line == 'ERROR' or line.startswith('+CME ERROR:'):
+            self._finish(False)
+            return True
+        if line == 'OK':
+            if self.expect_result and not self.query and not self.ack and not self.results:
+                self.ok = True # still waiting for the result
+            else:
+                self._finish(True)
+            return True
+        return False
+
+
+class ATEngine:
+    def __init__(self, data_lengths=DATA_LENGTHS, trace=None):
+        """
+        Args:
+            data_lengths (tuple): (prefix, function) pairs: a line starting with prefix is
+                followed by function(fields) bytes of raw data.
+            trace (function): If given, called with each line received.
+        """
+        self.data_lengths = data_lengths
+        self.trace = trace
+        self.buffer = bytearray()
+        self.pos = 0          # start of the unparsed data in the buffer
+        self.waiting = None   # (line, data length) while a line waits for its data
+        self.pending = None   # the command in flight
+        self.acks = deque()   # pipelined commands awaiting their late results, oldest first
+        self.outbox = bytearray()
+        self.match_from = 0   # where to resume searching a partial line for the expected response
+
+    def send(self, command):
+        "Start a command, returning the bytes to write"
+        assert self.pending is None or self.pending.done, "A command is already in flight"
+        self.pending = command
+        self.match_from = 0
+        if command.ack:
+            self.acks.append(command)
+        return (command.line + '\r').encode()
+
+    def data_to_send(self):
+        "Take the bytes waiting to be written, e.g. a payload after its prompt"
+        data = bytes(self.outbox)
+        self.outbox.clear()
+        return data
+
+    def abort(self, command):
+        "Stop tracking a command, e.g. when it has timed out"
+        if self.pending is command:
+            self.pending = None
+        if command in self.acks:
+            self.acks.remove(command)
+
+    def outstanding(self):
+        "Remove and return every command still waiting for a response"
+        commands = list(self.acks)
+        if self.pending is not None and self.pending not in commands:
+            commands.insert(0, self.pending)
+        self.pending = None
+        self.acks.clear()
+        return commands
+
+    def receive(self, data):
+        "Feed in bytes from the modem, returning the events they complete"
+        if self.pos > 4096 and self.pos * 2 > len(self.buffer):
+            # Discard parsed data once it dominates the buffer
+            del self.buffer[:self.pos]
+            self.match_from = max(0, self.match_from - self.pos)
+            self.pos = 0
+        self.buffer += data
+        events = []
+        while True:
+            item = self._next()
+            if item is None:
+                break
+            self._dispatch(*item, events)
+        self._match_partial(events)
+        return events
+
+    def _match_partial(self, events):
+        """
+        Complete a command waiting for an expected response which has arrived
+        without a line end yet (e.g. 'SEND OK' or a '>' prompt), rather than
+        waiting for the rest of the line. The search resumes where the last one
+        left off, so each byte is only looked at once or twice.
+        """
+        command = self.pending
+        if command is None or command.done or command.expected is None or self.waiting is not None:
+            return
+        while self.pos < len(self.buffer) and self.buffer[self.pos] in b'\r\n':
+            self.pos += 1
+        partial = bytes(self.buffer[self.pos:self.pos + 32])
+        if command.echo.encode().startswith(partial.rstrip(b'\r')):
+            return # the echo, which may contain anything
+        if any(partial.startswith(prefix.encode()) for prefix, data_length in self.data_lengths):
+            return # must wait for its data
+        expected = command.expected.encode()
+        start = max(self.pos, self.match_from)
+        found = self.buffer.find(expected, start)
+        if found < 0:
+            self.match_from = max(self.pos, len(self.buffer) - len(expected) + 1)
+            return
+        end = found + len(expected)
+        line = self.buffer[self.pos:end].decode(errors="ignore").strip()
+        self.pos = end
+        if self.trace is not None:
+            self.trace(line)
+        self._dispatch(line, None, events)
+
+    def _next(self):
+        "Parse the next line (with its data, if any) or prompt from the buffer, or return None"
+        buffer = self.buffer
+        if self.waiting is None:
+            while self.pos < len(buffer) and buffer[self.pos] in b'\r\n':
+                self.pos += 1
+            if self.pos == len(buffer):
+                return None
+            if buffer[self.pos] == ord('>'):
+                # A payload prompt, which has no line end
+                self.pos += 1
+                if self.pos < len(buffer) and buffer[self.pos] == ord(' '):
+                    self.pos += 1
+                return '>', None
+            end = buffer.find(b'\n', self.pos)
+            if end < 0:
+                return None
+            line = buffer[self.pos:end].decode(errors="ignore").strip()
+            self.pos = end + 1
+            if self.trace is not None:
+                self.trace(line)
+            length = 0
+            for prefix, data_length in self.data_lengths:
+                if line.startswith(prefix):
+                    try:
+                        length = data_length(_ints(line[len(prefix):])) or 0
+                    except (IndexError, TypeError):
+                        length = 0
+                    break
+            if not length:
+                return line, None
+            self.waiting = (line, length)
+        line, length = self.waiting
+        if len(buffer) - self.pos < length:
+            return None
+        data = bytes(buffer[self.pos:self.pos + length])
+        self.pos += length
+        self.waiting = None
+        return line, data
+
+    def _dispatch(self, line, data, events):
+        command = self.pending
+        if command is not None and not command.done and command.handle(line, data):
+            if command.prompted and command.payload is not None:
+                self.outbox += command.payload
+                command.payload = None
+            if command.done:
+                self.pending = None
+                if command.ok is False and command in self.acks:
+                    self.acks.remove(command) # no late result will follow
+                events.append((COMPLETE, command))
+        elif self.acks and line.startswith(self.acks[0].prefix):
+            command = self.acks.popleft()
+            command.ack_line = line
+            events.append((ACKED, command))
+        else:
+            events.append((UNSOLICITED, line, data))
+
+
+class SerialAT:
+    """
+    Drives an ATEngine from a pyserial port, blocking until each command is done.
+    """
+
+    def __init__(self, port, on_unsolicited, log=None, metrics=None):
+        """
+        Args:
+            port (serial.Serial): The modem's serial port.
+            on_unsolicited (function): Called as on_unsolicited(line, data) for each unsolicited line.
+                Any exception it raises is printed, and doesn't affect the command in flight.
+            log (function): If given, called with each line sent and received.
+            metrics (modem_metrics.Metrics): If given, where to record commands, bytes and URCs.
+        """
+        self.port = port
+        self.on_unsolicited = on_unsolicited
+        self.log = log
+        self.metrics = metrics
+        self.engine = ATEngine(trace=log)
+        try:
+            self.fileno = port.fileno() # to wait in select(), where the platform allows
+        except (AttributeError, OSError, ValueError):
+            self.fileno = None
+
+    def _read(self, deadline):
+        """
+        Read whatever the port has waiting, sleeping until at least one byte
+        arrives or the deadline passes.
+        """
+        waiting = self.port.in_waiting
+        if not waiting:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            if self.fileno is not None:
+                if not select.select([self.fileno], [], [], timeout)[0]:
+                    raise TimeoutError("Timed out reading from modem")
+                waiting = self.port.in_waiting
+            elif self.port.timeout != timeout:
+                # Otherwise let the port's own timeout do the waiting
+                self.port.timeout = timeout
+        data = self.port.read(max(1, waiting))
+        if not data:
+            raise TimeoutError("Timed out reading from modem")
+        if self.metrics is not None:
+            self.metrics.received(len(data))
+        return data
+
+    def _write(self, data):
+        self.port.write(data)
+        if self.metrics is not None:
+            self.metrics.sent(len(data))
+
+    def _process(self, data):
+        "Feed data to the engine, returning the number of unsolicited lines handled"
+        events = self.engine.receive(data)
+        out = self.engine.data_to_send()
+        if out:
+            self._write(out)
+        handled = 0
+        for event in events:
+            if event[0] == UNSOLICITED:
+                if self.metrics is not None:
+                    self.metrics.urc(event[1])
+                try:
+                    self.on_unsolicited(event[1], event[2])
+                except Exception as e:
+                    # Nor may it lose the command in flight, or the events after it
+                    print(f"Unsolicited handler exception: {e!r} line = {event[1]}")
+                    if self.metrics is not None:
+                        self.metrics.count('unsolicited_errors')
+                handled += 1
+        return handled
+
+    def command(self, command, timeout=None):
+        """
+        Send a command and wait until it is done.
+
+        Args:
+            command (ATCommand): The command.
+            timeout (float): Seconds to wait, or None to wait indefinitely.
+
+        Returns:
+            ATCommand: The command, now done.
+
+        Raises:
+            TimeoutError: If the modem didn't respond in time.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if self.log is not None:
+            self.log(command.line)
+        command.sent = time.perf_counter()
+        self._write(self.engine.send(command))
+        try:
+            while not command.done:
+                self._process(self._read(deadline))
+        except BaseException:
+            self.engine.abort(command)
+            raise
+        finally:
+            if self.metrics is not None:
+                self.metrics.command(command.name, time.perf_counter() - command.sent, command.ok)
+        return command
+
+    def poll(self, timeout=0):
+        """
+        Handle any unsolicited lines that arrive within timeout seconds (None
+        to wait for at least one).
+
+        Returns:
+            int: The number of unsolicited lines handled.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        handled = 0
+        while True:
+            if timeout == 0 and not self.port.in_waiting:
+                return handled
+            try:
+                handled += self._process(self._read(deadline))
+            except TimeoutError:
+                return handled
+            if handled and not self.port.in_waiting:
+                return handled
+
+
+class AsyncAT:
+    """
+    Drives an ATEngine from an asyncio reader/writer pair. A background task
+    is the only reader: it completes commands as their responses arrive and
+    passes unsolicited lines on straight away. One command is in flight at a
+    time, but any number of pipelined (ack) commands may await their results.
+    """
+
+    def __init__(self, reader, writer, on_unsolicited, log=None, metrics=None, on_error=None):
+        """
+        Args:
+            on_unsolicited (function): Called as on_unsolicited(line, data) for each unsolicited line.
+                Any exception it raises is printed, and doesn't stop the reader.
+            log (function): If given, called with each line sent and received.
+            metrics (modem_metrics.Metrics): If given, where to record commands, bytes and URCs.
+            on_error (function): If given, called with the exception if the reader stops, e.g. on EOF.
+        """
+        self.reader = reader
+        self.writer = writer
+        self.on_unsolicited = on_unsolicited
+        self.on_error = on_error
+        self.log = log
+        self.metrics = metrics
+        self.engine = ATEngine(trace=log)
+        self.lock = asyncio.Lock() # only one command may be in flight at a time
+        self.futures = {}          # command -> [prompt, done, ack] futures
+        self.error = None          # why the reader stopped, if it has
+        self.task = None
+
+    def start(self):
+        "Start the reader, or a new one after the last one stopped"
+        if self.task is not None and not self.task.done():
+            return
+        if self.error is not None:
+            # Whatever the last reader was in the middle of is lost
+            self.engine = ATEngine(trace=self.log)
+            self.error = None
+        self.task = asyncio.create_task(self._read_loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def _resolve(self, future, result=None, error=None):
+        if future is not None and not future.done():
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    async def _read_loop(self):
+        try:
+            while True:
+                data = await self.reader.read(4096)
+                if not data:  # EOF
+                    raise EOFError("Serial connection closed while reading response")
+                metrics = self.metrics
+                if metrics is not None:
+                    metrics.received(len(data))
+                events = self.engine.receive(data)
+                out = self.engine.data_to_send()
+                if out:
+                    self.writer.write(out)
+                    if metrics is not None:
+                        metrics.sent(len(out))
+                pending = self.engine.pending
+                if pending is not None and pending.prompted and pending in self.futures:
+                    self._resolve(self.futures[pending][0], True)
+                for event in events:
+                    if event[0] == UNSOLICITED:
+                        if metrics is not None:
+                            metrics.urc(event[1])
+                        try:
+                            self.on_unsolicited(event[1], event[2])
+                        except Exception as e:
+                            # A bad line or a failing callback mustn't stop the only reader
+                            print(f"Unsolicited handler exception: {e!r} line = {event[1]}")
+                            if metrics is not None:
+                                metrics.count('unsolicited_errors')
+                        continue
+                    futures = self.futures.get(event[1])
+                    if futures is None:
+                        continue
+                    if event[0] == COMPLETE:
+                        self._resolve(futures[0], True)
+                        self._resolve(futures[1], event[1])
+                        if event[1].ok is False:
+                            self._resolve(futures[2], error=ValueError(f"Command {event[1].name} failed with ERROR response"))
+                    else:
+                        self._resolve(futures[2], event[1])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Fail the command in flight, and any pipelined ones, with the reader's error
+            self.error = e
+            self.engine.outstanding()
+            for futures in self.futures.values():
+                for future in futures:
+                    self._resolve(future, error=e)
+            if self.on_error is not None:
+                self.on_error(e)
+
+    def _forget(self, command):
+        "Stop tracking a command's futures, marking any exceptions as retrieved"
+        for future in self.futures.pop(command, ()):
+            if future is not None and future.done() and not future.cancelled():
+                future.exception()
+
+    async def command(self, command, timeout=30, prompt_timeout=5):
+        """
+        Send a command and wait until it is done (for a pipelined command,
+        until its OK; see acked()).
+
+        Returns:
+            ATCommand: The command, now done.
+
+        Raises:
+            TimeoutError: If the modem didn't respond in time.
+            EOFError: If the connection was closed.
+        """
+        async with self.lock:
+            if self.error is not None:
+                raise self.error
+            loop = asyncio.get_running_loop()
+            prompt, done = loop.create_future(), loop.create_future()
+            ack = loop.create_future() if command.ack else None
+            self.futures[command] = [prompt, done, ack]
+            try:
+                if self.log is not None:
+                    self.log(command.line)
+                command.sent = time.perf_counter()
+                line = self.engine.send(command)
+                self.writer.write(line)
+                if self.metrics is not None:
+                    self.metrics.sent(len(line))
+                await self.writer.drain()
+                if command.payload is not None:
+                    try:
+                        await asyncio.wait_for(asyncio.shield(prompt), timeout=prompt_timeout)
+                    except asyncio.TimeoutError:
+                        raise TimeoutError("Timed out waiting for '>' prompt from modem")
+                    await self.writer.drain() # the reader has written the payload
+                try:
+                    await asyncio.wait_for(asyncio.shield(done), timeout=timeout)
+                except asyncio.TimeoutError:
+                    raise TimeoutError(f"Timed out waiting for response to {command.name}")
+            except BaseException:
+                self.engine.abort(command)
+                self._forget(command)
+                raise
+            finally:
+                if self.metrics is not None:
+                    self.metrics.command(command.name, time.perf_counter() - command.sent, command.ok)
+            if ack is None or command.ok is False:
+                self._forget(command)
+            return command
+
+    async def acked(self, command, timeout=None):
+        """
+        Wait for a pipelined command's late result.
+
+        Returns:
+            ATCommand: The command, with its ack_line set.
+        """
+        try:
+            return await asyncio.wait_for(self.futures[command][2], timeout=timeout)
+        except asyncio.TimeoutError:
+            self.engine.abort(command)
+            raise TimeoutError(f"Timed out waiting for the result of {command.name}")
+        finally:
+            self._forget(command)
+            if self.metrics is not None:
+                # From sending it to its late result, e.g. a publish's PUBACK
+                self.metrics.command(command.name + ' ack', time.perf_counter() - command.sent, command.ack_line is not None)
+
+
+if __name__ == "__main__":
+    engine = ATEngine()
+
+    # Split across reads, with a result after the OK
+    command = ATCommand('AT+CMQTTCONNECT=0,"tcp://x:1883",20,1', expect_result=True)
+    assert engine.send(command) == b'AT+CMQTTCONNECT=0,"tcp://x:1883",20,1\r'
+    assert engine.receive(b'AT+CMQTTCONNECT=0,"tcp://x:1883",20,1\r\r\nO') == []
+    assert engine.receive(b'K\r\n') == [] and command.ok and not command.done
+    assert engine.receive(b'\r\n+CMQTTCONNECT: 0,0\r\n') == [(COMPLETE, command)]
+    assert command.results == ['+CMQTTCONNECT: 0,0'] and command.late
+
+    # A payload is queued at the prompt
+    command = ATCommand('AT+CMQTTTOPIC=0,3', payload=b'a/b')
+    engine.send(command)
+    assert engine.receive(b'AT+CMQTTTOPIC=0,3\r\r\n>') == [] and engine.data_to_send() == b'a/b'
+    assert engine.receive(b'\r\nOK\r\n') == [(COMPLETE, command)]
+
+    # Pipelined commands, with a received message (including a line end in its payload) in between
+    first, second = ATCommand('AT+CMQTTPUB=0,1,60,0', ack=True), ATCommand('AT+CMQTTPUB=0,1,60,0', ack=True)
+    engine.send(first)
+    assert engine.receive(b'AT+CMQTTPUB=0,1,60,0\r\r\nOK\r\n') == [(COMPLETE, first)]
+    engine.send(second)
+    events = engine.receive(b'AT+CMQTTPUB=0,1,60,0\r\r\n+CMQTTPUB: 0,0\r\n+CMQTTRXSTART: 0,3,5\r\n'
+                            b'+CMQTTRXTOPIC: 0,3\r\nx/y\r\n+CMQTTRXPAYLOAD: 0,5\r\nhe\r\no\r\n'
+                            b'+CMQTTRXEND: 0\r\nOK\r\n\r\n+CMQTTPUB: 0,0\r\n')
+    assert events == [(ACKED, first), (UNSOLICITED, '+CMQTTRXSTART: 0,3,5', None),
+                      (UNSOLICITED, '+CMQTTRXTOPIC: 0,3', b'x/y'), (UNSOLICITED, '+CMQTTRXPAYLOAD: 0,5', b'he\r\no'),
+                      (UNSOLICITED, '+CMQTTRXEND: 0', None), (COMPLETE, second), (ACKED, second)]
+
+    # Expected mode collects everything up to the expected line
+    command = ATCommand('AT+NETOPEN', expected='+NETOPEN: 0')
+    engine.send(command)
+    assert engine.receive(b'AT+NETOPEN\r\r\nOK\r\n\r\n+NETOPEN: 0\r\n') == [(COMPLETE, command)]
+    assert command.text() == 'OK\r\n+NETOPEN: 0'
+    # Another link's data notification, arriving during a read, isn't taken as the read's result
+    command = ATCommand('AT+CIPRXGET=2,0,1500', expect_result=True, result_prefix='+CIPRXGET: 2,0,')
+    engine.send(command)
+    events = engine.receive(b'AT+CIPRXGET=2,0,1500\r\r\n+CIPRXGET: 1,1\r\n\r\n+CIPRXGET: 2,0,5,0\r\nhello\r\nOK\r\n')
+    assert events == [(UNSOLICITED, '+CIPRXGET: 1,1', None), (COMPLETE, command)], events
+    assert command.results == ['+CIPRXGET: 2,0,5,0'] and command.data == [b'hello']
+    command = ATCommand('AT+CIPRXGET=2,1,1500', expect_result=True, result_prefix='+CIPRXGET: 2,1,')
+    engine.send(command)
+    events = engine.receive(b'AT+CIPRXGET=2,1,1500\r\r\n+CIPRXGET: 2,1,3,0\r\nabc\r\n+CIPRXGET: 1,0\r\nOK\r\n')
+    assert events == [(UNSOLICITED, '+CIPRXGET: 1,0', None), (COMPLETE, command)], events
+    assert command.data == [b'abc']
+
+    command = ATCommand('AT+CIPRXGET=2,0,1024', expected='OK')
+    engine.send(command)
+    engine.receive(b'\r\n+CIPRXGET: 2,0,4,0\r\n\r\nOK\r\nOK\r\n')
+    assert command.done and command.data == [b'\r\nOK']
+
+    # An expected response is matched as soon as it arrives, without its line end
+    command = ATCommand('AT+CIPSEND=0,5', payload=b'hello', expected='SEND OK')
+    engine.send(command)
+    engine.receive(b'AT+CIPSEND=0,5\r\r\n>')
+    assert engine.data_to_send() == b'hello'
+    assert engine.receive(b'\r\nOK\r\n\r\nSEND O') == [] and not command.done
+    assert engine.receive(b'K') == [(COMPLETE, command)]
+    assert engine.receive(b'\r\n') == []
+    # ... including when the buffer is compacted in between
+    command = ATCommand('AT+CIPSEND=0,5', payload=b'hello', expected='SEND OK')
+    engine.send(command)
+    engine.receive(b'AT+CIPSEND=0,5\r\r\n>')
+    assert engine.data_to_send() == b'hello'
+    assert engine.receive(b'\r\nOK\r\n' + b'+CIPEVENT: x\r\n' * 400 + b'SEND O') == [] and engine.pos > 4096
+    assert engine.receive(b'K') == [(COMPLETE, command)] and engine.pos == len(engine.buffer) == 7
+    command = ATCommand('AT+CCERTDELE="OK.pem"', expected='OK')
+    engine.send(command)
+    assert engine.receive(b'AT+CCERTDELE="OK.pem"') == [] and not command.done
+    assert engine.receive(b'\r\r\nOK') == [(COMPLETE, command)]
+
+    # Queries, and errors
+    command = ATCommand('AT+CGACT?', query=True)
+    engine.send(command)
+    engine.receive(b'+CGACT: 1,1\r\n+CGACT: 2,0\r\nOK\r\n')
+    assert command.ok and command.results == ['+CGACT: 1,1', '+CGACT: 2,0']
+    command = ATCommand('AT+CMQTTSTART', expect_result=True)
+    engine.send(command)
+    assert engine.receive(b'+CME ERROR: 3\r\n') == [(COMPLETE, command)] and command.ok is False
+
+    # A line split across a compaction of the buffer is framed whole
+    line = b'+CPIN: READY' + b'.' * 86 + b'\r\n'
+    assert len(engine.receive(line * 50 + b'+CMQTTRX')) == 50 and engine.pos > 4096
+    assert engine.receive(b'START: 0,1,2\r\n') == [(UNSOLICITED, '+CMQTTRXSTART: 0,1,2', None)]
+    assert engine.pos == len(engine.buffer) < 4096
+
+    # A failing unsolicited handler loses neither the command in flight nor later lines
+    class Port:
+        in_waiting = 0
+        timeout = None
+        def __init__(self, data):
+            self.data = data
+        def fileno(self):
+            raise OSError("no fileno")
+        def write(self, data):
+            pass
+        def read(self, n):
+            data, self.data = self.data, b''
+            return data
+    seen = []
+    def handler(line, data):
+        seen.append(line)
+        raise KeyError(line)
+    at = SerialAT(Port(b'AT+CSQ\r\r\n+CMQTTCONNLOST: 0,3\r\n+CSQ: 20,99\r\n+CPIN: READY\r\nOK\r\n'), handler)
+    command = at.command(ATCommand('AT+CSQ', expect_result=True), timeout=1)
+    assert command.ok and command.results == ['+CSQ: 20,99'] and seen == ['+CMQTTCONNLOST: 0,3', '+CPIN: READY']
@@ -0,0 +1,751 @@
+"""
+A simulated SIMCom A76xx modem on a pseudo-terminal, so that the modem clients
+can be run and benchmarked without a SIM, a modem or a network, e.g.
+
+    python3 simcom_sim.py --latency 0.1 --loss 0.01
+
+prints the PTY to pass as the clients' port=..., and serves until interrupted.
+--check runs a quick self-test and publish benchmark instead.
+
+It implements the AT subset the clients use (CGDCONT, CGACT, CSSLCFG,
+CCERTDOWN, CMQTT*, NETOPEN, CIPOPEN, CIPSEND, CIPRXGET, CIPCLOSE) with echo,
+the '>' payload prompt and the modem's URCs. MQTT goes to an in-process
+Broker, which delivers to every simulated modem sharing it, so a test can run
+a publisher and a subscriber. Sockets are real TCP connections made from this
+process, so local test servers can be used.
+
+The link is simulated with:
+
+    latency  seconds before each response reaches the client (responses stay in order)
+    jitter   up to this many seconds more, at random
+    loss     probability that a message over the air (publish, delivery, socket data)
+             is lost. QoS 0 publishes are lost silently, others are reported as failed
+    drop     probability, on each MQTT command, that the connection is lost
+             (+CMQTTCONNLOST), to exercise reconnection
+
+Random choices come from a seeded generator, so runs are reproducible.
+"""
+import argparse
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import select
+import socket
+import threading
+import time
+import tty
+from modem_config import _CSSLCFG_FIELDS, _CSSLCFG_QUOTED # the format ModemConfig parses
+
+
+def topic_matches(topic_filter, topic):
+    "Whether an MQTT topic matches a subscription, which may have + and # wildcards"
+    filter_levels = topic_filter.split('/')
+    levels = topic.split('/')
+    for i, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if i >= len(levels) or (level != '+' and level != levels[i]):
+            return False
+    return len(levels) == len(filter_levels)
+
+
+def _fields(body):
+    "The fields of a command body such as '=0,\"tcp://host:1883\",20', without quotes"
+    fields = []
+    for field in body.lstrip('=').split(','):
+        field = field.strip()
+        fields.append(field[1:-1] if field.startswith('"') and field.endswith('"') else field)
+    return fields
+
+
+class Broker:
+    """
+    Stand-in for an MQTT broker, shared by simulated modems (and anything else
+    that wants to publish or subscribe).
+    """
+
+    def __init__(self):
+        self.subscriptions = [] # (topic filter, deliver(topic, payload))
+        self.retained = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, topic_filter, deliver):
+        with self.lock:
+            self.subscriptions.append((topic_filter, deliver))
+            retained = [(t, p) for t, p in self.retained.items() if topic_matches(topic_filter, t)]
+        for topic, payload in retained:
+            deliver(topic, payload)
+
+    def unsubscribe(self, topic_filter=None, deliver=None):
+        "Remove the matching subscriptions; None matches any filter or subscriber"
+        with self.lock:
+            self.subscriptions = [(f, d) for f, d in self.subscriptions
+                                  if not ((topic_filter is None or f == topic_filter) and (deliver is None or d == deliver))]
+
+    def publish(self, topic, payload, retain=False):
+        with self.lock:
+            if retain:
+                if payload:
+                    self.retained[topic] = payload
+                else:
+                    self.retained.pop(topic, None)
+            subscribers = [d for f, d in self.subscriptions if topic_matches(f, topic)]
+        for deliver in subscribers:
+            deliver(topic, payload)
+
+
+class SimModem:
+    MAX_LINKS = 10
+    MAX_RX_PART = 1024 # received MQTT payloads are split into parts of this size
+
+    def __init__(self, broker=None, latency=0.0, jitter=0.0, loss=0.0, drop=0.0, seed=None):
+        """
+        Args:
+            broker (Broker): Where MQTT messages go. A new one by default.
+            latency (float): Seconds before each response reaches the client.
+            jitter (float): Up to this many seconds more, chosen at random.
+            loss (float): Probability that a message over the air is lost. (0 <= loss <= 1)
+            drop (float): Probability, on each MQTT command, that the MQTT connection is lost.
+            seed: Seed for the random choices, for reproducible runs.
+        """
+        self.broker = broker if broker is not None else Broker()
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.drop = drop
+        self.random = random.Random(seed)
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.outbox = [] # heap of (due, sequence, bytes)
+        self.sequence = itertools.count()
+        self.last_due = 0
+        self.out_lock = threading.Condition()
+        self.running = False
+        self.stats = {'commands': 0, 'published': 0, 'delivered': 0, 'lost': 0, 'dropped': 0,
+                      'bytes_in': 0, 'bytes_out': 0}
+        self.files = {} # certificates etc. downloaded with CCERTDOWN
+        self.reset()
+
+    def reset(self):
+        "The modem's state after power on"
+        self.echo = True
+        self.contexts = {}  # cid -> APN
+        self.active = set() # active PDP contexts
+        self.ssl = {}       # (ctx, name) -> value
+        self.mqtt_started = False
+        self.clients = {}   # index -> client state dict
+        self.net_open = False
+        self.rxget_mode = 0
+        self.sockets = {}   # link -> socket
+        self.rx = {}        # link -> bytearray held for CIPRXGET
+        self.buffer = bytearray()
+        self.payload = None # (length, callback) while reading a payload after '>'
+
+    def start(self):
+        self.running = True
+        for target in (self._read_loop, self._write_loop):
+            threading.Thread(target=target, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.running = False
+        with self.out_lock:
+            self.out_lock.notify()
+        for index in list(self.clients):
+            self._disconnect(index)
+        self._close_sockets()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # Output, which reaches the client in order after the simulated latency
+
+    def write(self, data, delay=0.0):
+        "Queue raw bytes for the client, delay seconds on top of the link latency"
+        due = time.monotonic() + self.latency + delay
+        if self.jitter:
+            due += self.random.uniform(0, self.jitter)
+        with self.out_lock:
+            due = max(due, self.last_due)
+            self.last_due = due
+            heapq.heappush(self.outbox, (due, next(self.sequence), bytes(data)))
+            self.out_lock.notify()
+
+    def send(self, *lines, delay=0.0):
+        "Queue response or URC lines"
+        self.write(b''.join(b'\r\n' + line.encode() + b'\r\n' for line in lines), delay)
+
+    def _write_loop(self):
+        while self.running:
+            with self.out_lock:
+                while self.running and not self.outbox:
+                    self.out_lock.wait()
+                if not self.running:
+                    return
+                due, _, data = self.outbox[0]
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self.out_lock.wait(wait)
+                    continue
+                heapq.heappop(self.outbox)
+            os.write(self.master, data)
+            self.stats['bytes_out'] += len(data)
+
+    def _lost(self):
+        if self.loss and self.random.random() < self.loss:
+            self.stats['lost'] += 1
+            return True
+        return False
+
+    # Input
+
+    def _read_loop(self):
+        while self.running:
+            ready, _, _ = select.select([self.master], [], [], 0.2)
+            if not ready:
+                continue
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                return
+            self.stats['bytes_in'] += len(data)
+            self.feed(data)
+
+    def feed(self, data):
+        "Handle bytes from the client"
+        self.buffer += data
+        while True:
+            if self.payload is not None:
+                length, callback = self.payload
+                if len(self.buffer) < length:
+                    return
+                payload = bytes(self.buffer[:length])
+                del self.buffer[:length]
+                self.payload = None
+                callback(payload)
+                continue
+            end = self.buffer.find(b'\r')
+            if end < 0:
+                return
+            line = self.buffer[:end].decode(errors="replace").strip()
+            del self.buffer[:end + 1]
+            if line:
+                if self.echo:
+                    self.write(line.encode() + b'\r')
+                self.command(line)
+
+    def prompt(self, length, callback):
+        "Send the '>' prompt and pass the next length bytes to callback"
+        self.payload = (int(length), callback)
+        self.write(b'\r\n>')
+
+    def command(self, line):
+        self.stats['commands'] += 1
+        upper = line.upper()
+        if not upper.startswith('AT'):
+            return self.send('ERROR')
+        if upper in ('AT', 'ATI', 'AT&W'):
+            return self.send('OK')
+        if upper in ('ATE0', 'ATE1'):
+            self.echo = upper == 'ATE1'
+            return self.send('OK')
+        if not upper.startswith('AT+'):
+            return self.send('ERROR')
+        name = upper[3:].split('=')[0].split('?')[0]
+        body = line[3 + len(name):]
+        handler = getattr(self, '_' + name.lower(), None)
+        if handler is None:
+            return self.send('ERROR')
+        if name.startswith('CMQTT') and self.clients and self.drop and self.random.random() < self.drop:
+            self.lose_connection()
+        try:
+            handler(body)
+        except (ValueError, IndexError, KeyError):
+            self.send('ERROR')
+
+    # Events to trigger from tests
+
+    def lose_connection(self, cause=3):
+        "Lose the MQTT connections, as when the network drops them"
+        for index, client in self.clients.items():
+            if client['connected']:
+                self._disconnect(index)
+                self.stats['dropped'] += 1
+                self.send(f'+CMQTTCONNLOST: {index},{cause}')
+
+    def reboot(self):
+        "Restart the modem, losing everything it held"
+        for index in list(self.clients):
+            self._disconnect(index)
+        self._close_sockets()
+        self.reset()
+        self.send('RDY', '*ATREADY: 1', '+CPIN: READY', 'SMS DONE', 'PB DONE', delay=0.5)
+
+    # General and PDP context commands
+
+    def _csq(self, body):
+        self.send('+CSQ: 20,99', 'OK')
+
+    def _creg(self, body):
+        self.send('+CREG: 0,1', 'OK')
+
+    def _cgatt(self, body):
+        if body == '?':
+            return self.send('+CGATT: 1', 'OK')
+        self.send('OK')
+
+    def _cgdcont(self, body):
+        if body == '?':
+            return self.send(*[f'+CGDCONT: {cid},"IP","{apn}","0.0.0.0",0,0,0,0' for cid, apn in sorted(self.contexts.items())], 'OK')
+        cid, pdp_type, apn = _fields(body)[:3]
+        self.contexts[int(cid)] = apn
+        self.send('OK')
+
+    def _cgact(self, body):
+        if body == '?':
+            return self.send(*[f'+CGACT: {cid},{int(cid in self.active)}' for cid in sorted(self.contexts)], 'OK')
+        state, cid = map(int, _fields(body)[:2])
+        if cid not in self.contexts:
+            return self.send('ERROR')
+        if state:
+            self.active.add(cid)
+        else:
+            self.active.discard(cid)
+        self.send('OK')
+
+    # Certificates and SSL
+
+    def _ccertdown(self, body):
+        filename, length = _fields(body)[:2]
+        def downloaded(data):
+            self.files[filename] = data
+            self.send('OK')
+        self.prompt(length, downloaded)
+
+    def _ccertlist(self, body):
+        self.send(*[f'+CCERTLIST: "{name}"' for name in sorted(self.files)], 'OK')
+
+    def _ccertdele(self, body):
+        filename = _fields(body)[0]
+        self.send('OK' if self.files.pop(filename, None) is not None else 'ERROR')
+
+    def _csslcfg(self, body):
+        if body == '?':
+            lines = []
+            for ctx in sorted({ctx for ctx, name in self.ssl}):
+                values = [f'"{self.ssl.get((ctx, name), "")}"' if name in _CSSLCFG_QUOTED else self.ssl.get((ctx, name), '0')
+                          for name in _CSSLCFG_FIELDS]
+                lines.append(f'+CSSLCFG: {ctx},' + ','.join(values))
+            return self.send(*lines, 'OK')
+        name, ctx, value = _fields(body)[:3]
+        self.ssl[(int(ctx), name)] = value
+        self.send('OK')
+
+    # MQTT
+
+    def _client(self, body):
+        index = int(_fields(body)[0])
+        if not self.mqtt_started or index not in self.clients:
+            raise KeyError(index)
+        return index, self.clients[index]
+
+    def _cmqttstart(self, body):
+        if self.mqtt_started:
+            return self.send('ERROR')
+        self.mqtt_started = True
+        self.send('OK', '+CMQTTSTART: 0')
+
+    def _cmqttstop(self, body):
+        if not self.mqtt_started:
+            return self.send('ERROR')
+        for index in list(self.clients):
+            self._disconnect(index)
+        self.clients.clear()
+        self.mqtt_started = False
+        self.send('OK', '+CMQTTSTOP: 0')
+
+    def _cmqttaccq(self, body):
+        if not self.mqtt_started:
+            return self.send('ERROR')
+        if body == '?':
+            return self.send(*[f'+CMQTTACCQ: {i},"{self.clients[i]["id"]}",{self.clients[i]["ssl"]}' if i in self.clients
+                               else f'+CMQTTACCQ: {i},""' for i in range(2)], 'OK')
+        fields = _fields(body)
+        index = int(fields[0])
+        if index in self.clients:
+            return self.send('ERROR')
+        self.clients[index] = {'id': fields[1], 'ssl': int(fields[2]) if len(fields) > 2 else 0, 'sslctx': 0,
+                               'connected': None, 'topic': b'', 'payload': b'', 'sub_topic': None,
+                               'will': None, 'subscriptions': set(), 'deliver': self._deliverer(index)}
+        self.send('OK')
+
+    def _cmqttrel(self, body):
+        index, client = self._client(body)
+        if client['connected']:
+            return self.send('ERROR')
+        del self.clients[index]
+        self.send('OK')
+
+    def _cmqttsslcfg(self, body):
+        if body == '?':
+            return self.send(*[f'+CMQTTSSLCFG: {i},{c["sslctx"]}' for i, c in sorted(self.clients.items())], 'OK')
+        fields = _fields(body)
+        index, client = self._client(body)
+        client['sslctx'] = int(fields[1])
+        self.send('OK')
+
+    def _cmqttwilltopic(self, body):
+        index, client = self._client(body)
+        self.prompt(_fields(body)[1], lambda topic: (client.update(will_topic=topic), self.send('OK')))
+
+    def _cmqttwillmsg(self, body):
+        index, client = self._client(body)
+        self.prompt(_fields(body)[1], lambda msg: (client.update(will=(client.get('will_topic'), msg)), self.send('OK')))
+
+    def _cmqttconnect(self, body):
+        if body == '?':
+            lines = []
+            for index, client in sorted(self.clients.items()):
+                lines.append(f'+CMQTTCONNECT: {index},{client["connected"]}' if client['connected'] else f'+CMQTTCONNECT: {index}')
+            return self.send(*lines, 'OK')
+        index, client = self._client(body)
+        if client['connected']:
+            return self.send('OK', f'+CMQTTCONNECT: {index},19') # already connected
+        fields = _fields(body)
+        server, keepalive, clean = fields[1], int(fields[2]), int(fields[3])
+        credentials = ''.join(f',"{f}"' for f in fields[4:6])
+        client['connected'] = f'"{server}",{keepalive},{clean}{credentials}'
+        if clean:
+            client['subscriptions'] = set()
+        # Resubscribe a persistent session
+        for topic_filter in client['subscriptions']:
+            self.broker.subscribe(topic_filter, client['deliver'])
+        self.send('OK', delay=0)
+        self.send(f'+CMQTTCONNECT: {index},0', delay=self.latency) # a round trip to the broker
+
+    def _disconnect(self, index):
+        client = self.clients[index]
+        if client.get('deliver') is not None:
+            self.broker.unsubscribe(deliver=client['deliver'])
+        if client['connected'] and client['will'] is not None:
+            self.broker.publish(client['will'][0].decode(errors="replace"), client['will'][1])
+        client['connected'] = None
+        client['deliver'] = self._deliverer(index)
+
+    def _cmqttdisc(self, body):
+        index, client = self._client(body)
+        if not client['connected']:
+            return self.send('OK', f'+CMQTTDISC: {index},11')
+        client['will'] = None # a clean disconnect doesn't publish the will
+        self._disconnect(index)
+        self.send('OK', f'+CMQTTDISC: {index},0')
+
+    def _cmqtttopic(self, body):
+        index, client = self._client(body)
+        self.prompt(_fields(body)[1], lambda topic: (client.update(topic=topic), self.send('OK')))
+
+    def _cmqttpayload(self, body):
+        index, client = self._client(body)
+        self.prompt(_fields(body)[1], lambda payload: (client.update(payload=payload), self.send('OK')))
+
+    def _cmqttpub(self, body):
+        index, client = self._client(body)
+        fields = _fields(body)
+        qos = int(fields[1])
+        retain = len(fields) > 3 and fields[3] == '1'
+        if not client['connected']:
+            return self.send('OK', f'+CMQTTPUB: {index},11')
+        topic, payload = client['topic'].decode(errors="replace"), client['payload']
+        self.send('OK')
+        # The result comes once QoS 0 is sent, or after the PUBACK's round trip otherwise
+        delay = self.latency if qos else 0
+        if self._lost():
+            return self.send(f'+CMQTTPUB: {index},{11 if qos else 0}', delay=delay)
+        self.stats['published'] += 1
+        self.broker.publish(topic, payload, retain)
+        self.send(f'+CMQTTPUB: {index},0', delay=delay)
+
+    def _cmqttsubtopic(self, body):
+        index, client = self._client(body)
+        self.prompt(_fields(body)[1], lambda topic: (client.update(sub_topic=topic), self.send('OK')))
+
+    def _cmqttsub(self, body):
+        index, client = self._client(body)
+        fields = _fields(body)
+        def subscribe(topic):
+            topic = topic.decode(errors="replace")
+            if not client['connected']:
+                return self.send('OK', f'+CMQTTSUB: {index},11')
+            if topic not in client['subscriptions']:
+                client['subscriptions'].add(topic)
+                self.broker.subscribe(topic, client['deliver'])
+            self.send('OK', f'+CMQTTSUB: {index},0')
+        if len(fields) > 1:
+            self.prompt(fields[1], subscribe)
+        else:
+            subscribe(client['sub_topic'] or b'') # after AT+CMQTTSUBTOPIC
+
+    def _cmqttunsub(self, body):
+        index, client = self._client(body)
+        def unsubscribe(topic):
+            topic = topic.decode(errors="replace")
+            client['subscriptions'].discard(topic)
+            self.broker.unsubscribe(topic, client['deliver'])
+            self.send('OK', f'+CMQTTUNSUB: {index},0')
+        self.prompt(_fields(body)[1], unsubscribe)
+
+    def _deliverer(self, index):
+        "The Broker callback for one MQTT client, which sends the message URCs"
+        def deliver(topic, payload):
+            if self._lost():
+                return
+            self.stats['delivered'] += 1
+            topic = topic.encode()
+            data = bytearray(f'\r\n+CMQTTRXSTART: {index},{len(topic)},{len(payload)}\r\n'.encode())
+            data += f'\r\n+CMQTTRXTOPIC: {index},{len(topic)}\r\n'.encode() + topic + b'\r\n'
+            for start in range(0, len(payload), self.MAX_RX_PART):
+                part = payload[start:start + self.MAX_RX_PART]
+                data += f'\r\n+CMQTTRXPAYLOAD: {index},{len(part)}\r\n'.encode() + part + b'\r\n'
+            data += f'\r\n+CMQTTRXEND: {index}\r\n'.encode()
+            self.write(data)
+        return deliver
+
+    # TCP/IP sockets
+
+    def _netopen(self, body):
+        if self.net_open:
+            return self.send('+IP ERROR: Network is already opened', 'ERROR')
+        self.net_open = True
+        self.send('OK', '+NETOPEN: 0')
+
+    def _netclose(self, body):
+        if not self.net_open:
+            return self.send('ERROR')
+        self._close_sockets()
+        self.net_open = False
+        self.send('OK', '+NETCLOSE: 0')
+
+    def _close_sockets(self):
+        for link in list(self.sockets):
+            self.sockets.pop(link).close()
+        self.rx.clear()
+
+    def _cipssl(self, body):
+        self.send('OK') # accepted, but the simulated sockets are plain TCP
+
+    def _ciprxget(self, body):
+        fields = _fields(body)
+        mode = int(fields[0])
+        if mode in (0, 1):
+            self.rxget_mode = mode
+            return self.send('OK')
+        link = int(fields[1])
+        held = self.rx.get(link)
+        if mode != 2 or held is None:
+            return self.send('ERROR')
+        data = bytes(held[:int(fields[2]) if len(fields) > 2 else 1500])
+        del held[:len(data)]
+        self.write(f'\r\n+CIPRXGET: 2,{link},{len(data)},{len(held)}\r\n'.encode() + data + b'\r\nOK\r\n')
+
+    def _cipopen(self, body):
+        fields = _fields(body)
+        link, host, port = int(fields[0]), fields[2], int(fields[3])
+        if not self.net_open or link in self.sockets or not 0 <= link < self.MAX_LINKS:
+            return self.send('ERROR')
+        self.send('OK')
+        def connect():
+            try:
+                sock = socket.create_connection((host, port), timeout=10)
+            except OSError:
+                return self.send(f'+CIPOPEN: {link},4')
+            self.sockets[link] = sock
+            self.rx[link] = bytearray()
+            self.send(f'+CIPOPEN: {link},0')
+            self._receive(link, sock)
+        threading.Thread(target=connect, daemon=True).start()
+
+    def _receive(self, link, sock):
+        "Read from a connected socket until it closes, passing on what arrives"
+        sock.settimeout(None)
+        while True:
+            try:
+                data = sock.recv(1500)
+            except OSError:
+                data = b''
+            if self.sockets.get(link) is not sock:
+                return # closed by AT+CIPCLOSE
+            if not data:
+                del self.sockets[link]
+                return self.send(f'+IPCLOSE: {link},1')
+            if self._lost():
+                continue
+            if self.rxget_mode == 1:
+                notify = not self.rx[link]
+                self.rx[link] += data
+                if notify:
+                    self.send(f'+CIPRXGET: 1,{link}')
+            else:
+                self.write(f'\r\n+RECEIVE,{link},{len(data)}\r\n'.encode() + data)
+
+    def _cipsend(self, body):
+        fields = _fields(body)
+        link = int(fields[0])
+        sock = self.sockets.get(link)
+        if sock is None:
+            return self.send('ERROR')
+        def send(data):
+            self.send('OK')
+            if not self._lost():
+                sock.sendall(data)
+            self.send(f'+CIPSEND: {link},{len(data)},{len(data)}')
+        self.prompt(fields[1], send)
+
+    def _cipclose(self, body):
+        link = int(_fields(body)[0])
+        sock = self.sockets.pop(link, None)
+        if sock is None:
+            return self.send('ERROR')
+        sock.close()
+        self.rx.pop(link, None)
+        self.send('OK', f'+CIPCLOSE: {link},0')
+
+
+def check(latency, count=200):
+    "Self-test, and time round trips of QoS 1 publishes through the broker"
+    import serial
+    import simcom_at
+    with SimModem(latency=latency, seed=1) as sim:
+        received = []
+        def unsolicited(line, data):
+            if data is not None and line.startswith('+CMQTTRXPAYLOAD:'):
+                received.append(data)
+        at = simcom_at.SerialAT(serial.Serial(sim.port, 115200, timeout=1), unsolicited)
+        def command(line, payload=None, expect_result=False, query=False):
+            cmd = simcom_at.ATCommand(line, payload=payload, expect_result=expect_result, query=query)
+            at.command(cmd, timeout=5)
+            assert cmd.ok, (line, cmd.text())
+            return cmd
+        command('AT+CGDCONT=1,"IP","iot.1nce.net"')
+        command('AT+CGACT=1,1')
+        assert command('AT+CGACT?', query=True).results == ['+CGACT: 1,1']
+        command('AT+CCERTDOWN="test.pem",5', payload=b'PEM\r\n')
+        assert sim.files == {'test.pem': b'PEM\r\n'}
+        command('AT+CMQTTSTART', expect_result=True)
+        command('AT+CMQTTACCQ=0,"sim",0')
+        assert command('AT+CMQTTCONNECT=0,"tcp://broker:1883",20,1', expect_result=True).results == ['+CMQTTCONNECT: 0,0']
+        command('AT+CMQTTSUB=0,6,1', payload=b'test/#', expect_result=True)
+        start = time.monotonic()
+        for i in range(count):
+            payload = b'message %d' % i
+            command('AT+CMQTTTOPIC=0,8', payload=b'test/sim')
+            command(f'AT+CMQTTPAYLOAD=0,{len(payload)}', payload=payload)
+            assert command('AT+CMQTTPUB=0,1,60', expect_result=True).results == ['+CMQTTPUB: 0,0']
+        at.poll(1)
+        elapsed = time.monotonic() - start
+        assert received == [b'message %d' % i for i in range(count)], len(received)
+        print(f"{count} QoS 1 publishes in {elapsed:.2f}s ({count / elapsed:.0f}/s) at {latency * 1000:.0f}ms latency")
+
+        # Sockets, against a local echo server
+        server = socket.create_server(('127.0.0.1', 0))
+        def echo():
+            conn, _ = server.accept()
+            conn.sendall(conn.recv(100))
+            conn.close()
+        threading.Thread(target=echo, daemon=True).start()
+        command('AT+CIPRXGET=1')
+        command('AT+NETOPEN', expect_result=True)
+        assert command(f'AT+CIPOPEN=0,"TCP","127.0.0.1",{server.getsockname()[1]}', expect_result=True).results == ['+CIPOPEN: 0,0']
+        command('AT+CIPSEND=0,5', payload=b'hello', expect_result=True)
+        time.sleep(0.2 + 2 * latency)
+        cmd = command('AT+CIPRXGET=2,0,1500', expect_result=True)
+        assert cmd.data == [b'hello'], cmd.data
+
+        # Lost connections are reported
+        sim.lose_connection()
+        lost = []
+        at.on_unsolicited = lambda line, data: lost.append(line)
+        at.poll(1)
+        assert '+CMQTTCONNLOST: 0,3' in lost, lost
+
+    # Several sockets receiving at once, against an echo server. With some
+    # latency, one link's data notification arrives while another is being read
+    import SimCOM_sockets
+    server = socket.create_server(('127.0.0.1', 0))
+    def serve():
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=echo, args=(conn,), daemon=True).start()
+    def echo(conn):
+        with conn:
+            for data in iter(lambda: conn.recv(4096), b''):
+                conn.sendall(data)
+    threading.Thread(target=serve, daemon=True).start()
+    with SimModem(latency=max(latency, 0.01), seed=2) as sim:
+        modem = SimCOM_sockets.SimCOMSocket(sim.port)
+        modem.connect('iot.1nce.net')
+        socks = [modem.socket('TCP') for i in range(2)]
+        for sock in socks:
+            sock.connect('127.0.0.1', server.getsockname()[1])
+            sock.settimeout(5)
+        for i in range(10):
+            for sock in socks:
+                sock.send(b'link %d, %d' % (sock.link, i))
+            for sock in socks:
+                expected = b'link %d, %d' % (sock.link, i)
+                received = b''
+                while len(received) < len(expected):
+                    received += sock.recv(100)
+                assert received == expected, (received, expected)
+
+        # A long prefetching read on one link doesn't hold up another's
+        big = bytes(range(256)) * 80
+        for start in range(0, len(big), 1460):
+            socks[0].send(big[start:start + 1460])
+        socks[1].send(b'meanwhile')
+        assert socks[0].makefile('rb').read(len(big)) == big
+        assert socks[1].recv(100) == b'meanwhile'
+        modem.netclose()
+
+    # and through the asyncio streams
+    async def streams(port):
+        modem = await SimCOM_sockets.AsyncSimCOMSocket.open(port)
+        pairs = [await modem.open_connection('127.0.0.1', server.getsockname()[1]) for i in range(2)]
+        for i in range(10):
+            for reader, writer in pairs:
+                writer.write(b'link %d, %d' % (writer.link, i))
+            for reader, writer in pairs:
+                expected = b'link %d, %d' % (writer.link, i)
+                assert await asyncio.wait_for(reader.readexactly(len(expected)), 5) == expected
+        await modem.netclose()
+        await modem.at.stop()
+    with SimModem(latency=max(latency, 0.01), seed=3) as sim:
+        asyncio.run(streams(sim.port))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many seconds more')
+    parser.add_argument('--loss', type=float, default=0.0, help='probability a message over the air is lost')
+    parser.add_argument('--drop', type=float, default=0.0, help='probability the MQTT connection drops on each command')
+    parser.add_argument('--seed', type=int, help='random seed, for reproducible runs')
+    parser.add_argument('--check', action='store_true', help='run the self-test and benchmark, then exit')
+    args = parser.parse_args()
+
+    if args.check:
+        check(args.latency)
+    else:
+        with SimModem(latency=args.latency, jitter=args.jitter, loss=args.loss, drop=args.drop, seed=args.seed) as sim:
+            print(f"Simulated modem on {sim.port}")
+            try:
+                while True:
+                    time.sleep(60)
+                    print(sim.stats)
+            except KeyboardInterrupt:
+                pass
@@ -0,0 +1,248 @@
+"""
+Compact binary encoding of birdbox telemetry for MQTT, to save airtime on a
+metered SIM.
+
+A Schema lists the fields of a sample and how each is packed:
+
+    'time'   seconds since the epoch (int, float or datetime), stored as a
+             zigzag varint delta from the previous sample in the batch
+    'uint'   unsigned varint
+    'int'    zigzag varint
+    'bool'   one bit of a flags byte shared by all of a sample's bool fields
+    'float'  4-byte little-endian float
+    ('enum', values)
+             varint index into values, or 0 followed by the string if the
+             value isn't one of them
+
+Several samples are encoded into one message:
+
+    magic      1 byte   0xB7 (never the first byte of UTF-8 text)
+    schema id  1 byte
+    count      varint   number of samples
+    base time  varint   the first 'time' field is a delta from this
+    samples    ...
+
+A batch of a dozen birdbox samples taken five minutes apart comes to about
+70 bytes, against some 30 bytes for each sample as text.
+"""
+import struct
+from datetime import datetime
+
+MAGIC = 0xB7
+_FLOAT = struct.Struct('<f')
+
+
+def encode_varint(n, out):
+    "Append an unsigned varint (7 bits per byte, least significant first) to a bytearray"
+    assert n >= 0
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def decode_varint(data, pos):
+    "Returns (value, new position)"
+    n = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _zigzag(n):
+    return (n << 1) if n >= 0 else ((-n << 1) - 1)
+
+
+def _unzigzag(n):
+    return (n >> 1) if not n & 1 else -((n + 1) >> 1)
+
+
+def _seconds(t):
+    if isinstance(t, datetime):
+        t = t.timestamp()
+    return int(t)
+
+
+class Schema:
+    def __init__(self, schema_id, fields):
+        """
+        Args:
+            schema_id (int): Identifies the schema in encoded messages. (0 <= schema_id < 256)
+            fields (list): (name, kind) pairs, in the order to pack them.
+        """
+        self.schema_id = schema_id
+        self.fields = fields
+        self.bools = [name for name, kind in fields if kind == 'bool']
+        assert len(self.bools) <= 8
+
+    def encode(self, samples):
+        """
+        Encode a batch of samples.
+
+        Args:
+            samples (list): The samples, as dicts keyed by field name.
+
+        Returns:
+            bytes: The message.
+        """
+        out = bytearray([MAGIC, self.schema_id])
+        encode_varint(len(samples), out)
+        times = [_seconds(s[name]) for s in samples for name, kind in self.fields if kind == 'time']
+        base = min(times, default=0)
+        encode_varint(base, out)
+        previous = base
+        for sample in samples:
+            if self.bools:
+                flags = 0
+                for bit, name in enumerate(self.bools):
+                    if sample[name]:
+                        flags |= 1 << bit
+                out.append(flags)
+            for name, kind in self.fields:
+                value = sample[name]
+                if kind == 'time':
+                    value = _seconds(value)
+                    encode_varint(_zigzag(value - previous), out)
+                    previous = value
+                elif kind == 'uint':
+                    encode_varint(int(value), out)
+                elif kind == 'int':
+                    encode_varint(_zigzag(int(value)), out)
+                elif kind == 'float':
+                    out += _FLOAT.pack(value)
+                elif kind != 'bool':
+                    values = kind[1]
+                    if value in values:
+                        encode_varint(values.index(value) + 1, out)
+                    else:
+                        text = str(value).encode()
+                        out.append(0)
+                        encode_varint(len(text), out)
+                        out += text
+        return bytes(out)
+
+    def decode(self, data):
+        """
+        Decode a message produced by encode().
+
+        Returns:
+            list: The samples, as dicts, with times as ints (seconds since the epoch).
+        """
+        if not is_telemetry(data) or data[1] != self.schema_id:
+            raise ValueError("Not telemetry for this schema")
+        count, pos = decode_varint(data, 2)
+        previous, pos = decode_varint(data, pos)
+        samples = []
+        for i in range(count):
+            sample = {}
+            if self.bools:
+                flags = data[pos]
+                pos += 1
+                for bit, name in enumerate(self.bools):
+                    sample[name] = bool(flags & (1 << bit))
+            for name, kind in self.fields:
+                if kind == 'bool':
+                    continue
+                if kind == 'float':
+                    sample[name] = _FLOAT.unpack_from(data, pos)[0]
+                    pos += _FLOAT.size
+                    continue
+                value, pos = decode_varint(data, pos)
+                if kind == 'time':
+                    previous += _unzigzag(value)
+                    value = previous
+                elif kind == 'int':
+                    value = _unzigzag(value)
+                elif kind != 'uint':
+                    if value:
+                        value = kind[1][value - 1]
+                    else:
+                        length, pos = decode_varint(data, pos)
+                        value = bytes(data[pos:pos + length]).decode(errors="replace")
+                        pos += length
+                sample[name] = value
+            samples.append(sample)
+        return samples
+
+
+def is_telemetry(data):
+    "Whether a payload is an encoded telemetry batch (rather than e.g. text)"
+    return len(data) >= 2 and data[0] == MAGIC
+
+
+class Batch:
+    """
+    Collects samples until there are enough to be worth a publish.
+    """
+
+    def __init__(self, schema, max_samples=12):
+        self.schema = schema
+        self.max_samples = max_samples
+        self.samples = []
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, **sample):
+        """
+        Add a sample.
+
+        Returns:
+            bytes: The encoded batch once max_samples have been added, otherwise None.
+        """
+        self.samples.append(sample)
+        if len(self.samples) >= self.max_samples:
+            return self.flush()
+        return None
+
+    def flush(self):
+        "Encode and clear the samples collected so far (None if there are none)"
+        if not self.samples:
+            return None
+        data = self.schema.encode(self.samples)
+        self.samples = []
+        return data
+
+
+# Birdbox status, as published on birdboxes/<name>/telemetry
+BIRDBOX = Schema(1, [('time', 'time'),
+                     ('battery_level', 'uint'),
+                     ('status', ('enum', ('up', 'down', 'charging', 'low_battery', 'shutdown'))),
+                     ('stay_up', 'bool'),
+                     ('force_up', 'bool')])
+
+SCHEMAS = {BIRDBOX.schema_id: BIRDBOX}
+
+
+def decode(data):
+    "Decode a telemetry batch with whichever of the known SCHEMAS it uses"
+    if not is_telemetry(data) or data[1] not in SCHEMAS:
+        raise ValueError("Unknown telemetry payload")
+    return SCHEMAS[data[1]].decode(data)
+
+
+if __name__ == "__main__":
+    batch = Batch(BIRDBOX, max_samples=12)
+    start = 1760000000
+    results = [batch.add(time=start + 300*i, battery_level=80 - i, status='up' if i % 5 else 'rebooted',
+                         stay_up=i % 2 == 0, force_up=False)
+               for i in range(12)]
+    assert results[:-1] == [None]*11
+    data = results[-1]
+    samples = decode(data)
+    assert len(samples) == 12 and samples[0]['status'] == 'rebooted' and samples[1]['status'] == 'up'
+    assert [s['time'] for s in samples] == [start + 300*i for i in range(12)]
+    assert [s['battery_level'] for s in samples] == list(range(80, 68, -1))
+    assert [s['stay_up'] for s in samples] == [i % 2 == 0 for i in range(12)]
+    text = sum(len(f'Pi Python at: {datetime.fromtimestamp(start).strftime("%Y-%m-%d %H:%M:%S")}') for i in range(12))
+    print(f"{len(data)} bytes for 12 samples, against {text} bytes as text")
+
+    # Out of order times, negative and float fields
+    schema = Schema(9, [('time', 'time'), ('t', 'int'), ('v', 'float')])
+    samples = [{'time': 100, 't': -5, 'v': 1.5}, {'time': 90, 't': 300, 'v': -2.25}]
+    assert schema.decode(schema.encode(samples)) == samples
+    assert batch.flush() is None and not is_telemetry(b'Pi Python at: ...')